@@ -10,6 +10,7 @@ from .models import (
     Project,
     Setting, 
     RunTime, 
+    StageMetric,
     Sample,
     SearchSetting, 
     ModList, 
@@ -45,6 +46,14 @@ class RunTimeInline(admin.TabularInline):
         'searchgui_proteome', 'peptideshaker_proteome', 'reporter_proteome', 'mzmine_proteome',
         'read_results_proteome', 'process_results_proteome')
 
+class StageMetricInline(admin.TabularInline):
+    model = StageMetric
+    extra = 0
+    max_num = 0
+    can_delete = False
+    readonly_fields = ('stage', 'wall_time', 'cpu_time', 'peak_rss', 'read_mb', 'write_mb',
+        'commands', 'db_queries', 'db_time', 'date_updated')
+
 class EngineStatusInline(admin.TabularInline):
     model = EngineStatus
     extra = 0
@@ -109,13 +118,14 @@ class MetaDataChoiceInline(admin.TabularInline):
         
 class QueueAdmin(admin.ModelAdmin):
 
-    inlines = (RunTimeInline, EngineStatusInline, MetaDataChoiceInline)
+    inlines = (RunTimeInline, StageMetricInline, EngineStatusInline, MetaDataChoiceInline)
     list_filter = (ProjectListFilter,)
     fieldsets = (
         (None, {
             'classes': ('wide',),
             'fields': (
                 ('project', 'job'),
+                ('worker', 'lease_expires'),
                 'filename',
                 'sample', 
                 'status', 
@@ -133,7 +143,9 @@ class QueueAdmin(admin.ModelAdmin):
                     'error', 'skip', 'job')
     list_display_links = ('id', 'project', 'filename', 'get_sample', 'status', 
                           'tag', 'error', 'skip', 'job')
-    readonly_fields = ('total_runtime', 'filename', 'date_added', 'date_finished_profile', 'date_finished_proteome')
+    # the lease belongs to the run_queue workers and isn't saved from here
+    readonly_fields = ('total_runtime', 'filename', 'date_added', 'date_finished_profile', 'date_finished_proteome',
+                       'worker', 'lease_expires')
 
     @admin.display(ordering='sample__name', description='Sample')
     def get_sample(self, obj):
@@ -163,7 +175,7 @@ class SearchSettingInline(admin.StackedInline):
                 ('perform_second_step'),
                 ('profile_type', 'profile_threshold', 'profile_method'),
                 ('multiplex'), ('run_deqms'), ('mzmine_run_mzmine'),
-                ('imput_threshold')
+                ('imput_threshold'), ('analysis_engine')
             ),
             'description': 'MetaProD specific options',
         }),    
@@ -176,7 +188,8 @@ class SearchSettingInline(admin.StackedInline):
                 ('isotope_min', 'isotope_max'),
                 ('instrument', 'fragmentation'),
                 ('psm_fdr', 'peptide_fdr', 'protein_fdr'),
-                ('digestion')
+                ('digestion'),
+                ('searchgui_combined', 'searchgui_parallel_retries')
             ),
             'description': 'SearchGUI/PeptideShaker specific options',
         }), 
@@ -236,7 +249,7 @@ class SearchSettingAdmin(admin.ModelAdmin):
                 ('profile_type', 'profile_method'),
                 ('profile_threshold', 'profile_exclude_below', 'profile_include_above'),
                 ('multiplex'), ('run_deqms'), ('mzmine_run_mzmine'),
-                ('imput_threshold')
+                ('imput_threshold'), ('analysis_engine')
             ),
             'description': 'MetaProD specific options',
         }),    
@@ -249,7 +262,8 @@ class SearchSettingAdmin(admin.ModelAdmin):
                 ('isotope_min', 'isotope_max'),
                 ('instrument', 'fragmentation'),
                 ('psm_fdr', 'peptide_fdr', 'protein_fdr'),
-                ('digestion')
+                ('digestion'),
+                ('searchgui_combined', 'searchgui_parallel_retries')
             ),
             'description': 'SearchGUI/PeptideShaker specific options',
         }), 
@@ -330,6 +344,18 @@ class RunTimeAdmin(admin.ModelAdmin):
     def project(self, obj):
         return obj.queue.project.name
         
+class StageMetricAdmin(admin.ModelAdmin):
+    list_filter = (QueueProjectListFilter, 'stage')
+    list_display = ('project', 'queue', 'stage', 'wall_time', 'cpu_time', 
+                    'peak_rss', 'read_mb', 'write_mb', 'commands',
+                    'db_queries', 'db_time', 'date_updated')
+    list_display_links = ('project', 'queue', 'stage')
+    
+    def project(self, obj):
+        if obj.queue is None:
+            return obj.project_id
+        return obj.queue.project.name
+        
 class SampleAdmin(admin.ModelAdmin):
     list_filter = (ProjectListFilter,)
     list_display = ('project', 'name')
@@ -394,6 +420,7 @@ class MetaDataChoiceAdmin(admin.ModelAdmin):
 admin.site.register(Queue, QueueAdmin)
 admin.site.register(Project, ProjectAdmin)
 admin.site.register(Setting, SettingAdmin)
+admin.site.register(StageMetric, StageMetricAdmin)
 admin.site.register(SearchSetting, SearchSettingAdmin)
 admin.site.register(ModList, ModListAdmin)
 admin.site.register(EnzymeList, EnzymeListAdmin)
@@ -1,8 +1,11 @@
-from django.db import models
+import datetime
+
+from django.db import models, connections, transaction
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django.contrib import messages
 from django.core.validators import MaxValueValidator, MinValueValidator
-from django.db.models import Case, When, Value
+from django.db.models import Case, When, Value, Q, F
 
 class QueueQuerySet(models.QuerySet):
     def order_by_status(self):
@@ -28,6 +31,61 @@ class QueueQuerySet(models.QuerySet):
                 )
             )).order_by('-status_order')
             
+    def claimable(self):
+        ''' entries no worker holds a current lease on '''
+        return self.filter(Q(worker__isnull=True) | 
+                           Q(lease_expires__lt=timezone.now()))
+    
+    def claim(self, worker, lease):
+        ''' lease the first claimable entry (by status order) to worker for
+        lease seconds and return it, or None if there is nothing to claim. 
+        
+        uses SELECT ... FOR UPDATE SKIP LOCKED where the database supports it
+        and a conditional update otherwise, so two workers can never claim the
+        same entry. taking over an expired lease counts as an error since the
+        previous worker died during the step. the job of the entry isn't
+        changed since it's how users split the queue between run_queue jobs '''
+        expires = timezone.now() + datetime.timedelta(seconds=lease)
+        
+        features = connections[self.db].features
+        if features.has_select_for_update_skip_locked:
+            # only lock the queue row and not any joined rows
+            if features.has_select_for_update_of:
+                of = ('self',)
+            else:
+                of = ()
+            with transaction.atomic(using=self.db):
+                queue = (self.claimable().order_by_status()
+                                         .select_for_update(skip_locked=True, 
+                                                            of=of)
+                                         .first())
+                if queue is None:
+                    return None
+                if queue.worker is not None:
+                    queue.error += 1
+                queue.worker = worker
+                queue.lease_expires = expires
+                queue.save(update_fields=['worker', 'lease_expires', 'error'])
+                return queue
+        
+        candidates = (self.claimable().order_by_status()
+                          .values_list('id', 'worker', 'lease_expires')[:10])
+        for queue_id, old_worker, old_expires in candidates:
+            # the update only matches if nobody claimed it since we looked
+            if old_worker is None:
+                query = Queue.objects.filter(id=queue_id, worker__isnull=True)
+                error = F('error')
+            else:
+                query = Queue.objects.filter(id=queue_id, worker=old_worker,
+                                             lease_expires=old_expires)
+                error = F('error') + 1
+            claimed = query.update(worker=worker, lease_expires=expires, 
+                                   error=error)
+            if claimed == 1:
+                return Queue.objects.get(id=queue_id)
+        
+        return None
+            
 class QueueManager(models.Manager):
     def get_by_natural_key(self, project, filename):
         return self.get(project=project, filename=filename)
@@ -37,6 +95,9 @@ class QueueManager(models.Manager):
         
     def order_by_status(self):
         return self.get_queryset().order_by_status()
+        
+    def claim(self, worker, lease):
+        return self.get_queryset().claim(worker, lease)
               
 # queue of files to run
 class Queue(models.Model):
@@ -120,6 +181,20 @@ class Queue(models.Model):
         default=0, 
         help_text="File job for HPC situations."
     )
+    # set while a run_queue worker is running a step for this file so
+    # concurrent workers don't pick the same entry. the worker renews the
+    # lease while it runs so entries held by crashed workers can be reclaimed
+    worker = models.CharField(
+        max_length=100,
+        null=True,
+        blank=True,
+        help_text="Worker currently processing this file."
+    )
+    lease_expires = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text="When the worker's claim on this file expires."
+    )
     # this is just a calculated sum of the info in the runtimex
     total_runtime = models.IntegerField(
         default=0, 
@@ -149,6 +224,30 @@ class Queue(models.Model):
         
     natural_key.dependencies = ['projects.project']
 
+    # the lease is only changed by claim, renew_lease and release, so a
+    # plain save of an entry loaded before the lease was renewed doesn't put
+    # the old expiry (or worker) back
+    LEASE_FIELDS = ('worker', 'lease_expires')
+
+    def save(self, *args, **kwargs):
+        if self._state.adding == False and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [f.name for f in self._meta.concrete_fields
+                                       if not f.primary_key and f.name not in self.LEASE_FIELDS]
+        super().save(*args, **kwargs)
+
+    def renew_lease(self, worker, lease):
+        ''' extend the lease by lease seconds. returns False if worker no 
+        longer holds it '''
+        expires = timezone.now() + datetime.timedelta(seconds=lease)
+        renewed = (Queue.objects.filter(id=self.id, worker=worker)
+                                .update(lease_expires=expires))
+        return renewed == 1
+        
+    def release(self, worker):
+        ''' give up the lease if worker still holds it '''
+        (Queue.objects.filter(id=self.id, worker=worker)
+                      .update(worker=None, lease_expires=None))
+
 class SearchSetting(models.Model):
     # these are mostly for MSGF+
     class Fragmentation(models.IntegerChoices):
@@ -183,6 +282,11 @@ class SearchSetting(models.Model):
         PSM = 1, _('PSM')
         PEAK_AREA = 2, _('Peak Area')
     
+    class AnalysisEngine(models.IntegerChoices):
+        R = 0, _('R')
+        # not offered until scripts/pemm_deqms.py matches R, see scripts/tests.py
+#        PYTHON = 1, _('Python')
+    
     class HumanFasta(models.TextChoices):
         Uniprot = 'UNIPROT', _('Uniprot')
 #        PPG = 'PPG', _('PPG')
@@ -349,6 +453,16 @@ class SearchSetting(models.Model):
         default=False,
         help_text="Use Sage Search Algorithm"
     )
+    searchgui_combined = models.BooleanField(
+        "Combined search",
+        default=True,
+        help_text="Run the selected search engines in a single SearchGUI search. Engines missing output are searched again on their own."
+    )
+    searchgui_parallel_retries = models.BooleanField(
+        "Parallel engine searches",
+        default=False,
+        help_text="Run separate search engine searches, such as retries, at the same time and split the threads between them."
+    )
     mods = models.ManyToManyField(
         'ModList', 
         related_name="SearchSettingMods",
@@ -408,6 +522,11 @@ class SearchSetting(models.Model):
         default=50,
         help_text="Percent of channels to require when filtering results before PEMM."
     )
+    analysis_engine = models.IntegerField(
+        choices=AnalysisEngine.choices,
+        default=0,
+        help_text="Run PEMM and DEqMS in R."
+    )
     profile_method = models.IntegerField(
         choices=ProfileMethod.choices,
         default=0,
@@ -520,6 +639,61 @@ class RunTime(models.Model):
     def natural_key(self):
         return (self.queue.natural_key(),)
         
+# resource use of each step. steps use the same names as the RunTime fields.
+# cpu time and disk io include the commands run by the step, while the
+# queries are those made by the step itself. steps run for the whole project,
+# such as generate_fasta and analyze_results, have no queue entry
+class StageMetric(models.Model):
+    queue = models.ForeignKey(
+        'projects.Queue', 
+        on_delete=models.CASCADE, 
+        blank=True,
+        null=True,
+    )
+    project = models.ForeignKey(
+        'projects.Project',
+        on_delete=models.CASCADE,
+        blank=True,
+        null=True,
+    )
+    stage = models.CharField(max_length=50)
+    wall_time = models.FloatField(
+        default=0,
+        help_text="Wall time in seconds."
+    )
+    cpu_time = models.FloatField(
+        default=0,
+        help_text="User and system CPU time in seconds."
+    )
+    peak_rss = models.FloatField(
+        default=0,
+        help_text="Peak resident memory in MB of the largest command, or of the worker for steps without commands."
+    )
+    read_mb = models.FloatField(
+        default=0,
+        help_text="MB read from disk."
+    )
+    write_mb = models.FloatField(
+        default=0,
+        help_text="MB written to disk."
+    )
+    commands = models.IntegerField(
+        default=0,
+        help_text="Number of commands run."
+    )
+    db_queries = models.IntegerField(
+        default=0,
+        help_text="Number of database queries."
+    )
+    db_time = models.FloatField(
+        default=0,
+        help_text="Time spent in database queries in seconds."
+    )
+    date_updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('queue', 'stage')
+
 class Project(models.Model):
     name = models.CharField(max_length=100, primary_key=True)
     description = models.CharField(max_length=250, blank=True, null=True)
@@ -590,6 +764,10 @@ class Setting(models.Model):
         default='/home/metaprod/data'
     )
     max_retries = models.IntegerField(default=1)
+    log_progress_interval = models.IntegerField(
+        default=10,
+        help_text="Seconds between repeated progress lines written to the logs. 0 writes every line."
+    )
     default = models.BooleanField(default=0)
 
 class EnzymeList(models.Model):
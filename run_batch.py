@@ -7,6 +7,13 @@ if len(sys.argv) < 1:
 
 # range of arg1 to arg2, eg run_batch.py 1 3 runs 1,2,3
 # run_batch.py start_job end_job runtime_in_hours
+# optionally add cpu_workers db_workers to have every job pull files from the
+# whole queue instead of only its own job number
+# eg run_batch.py cd1 0 3 48 4 2
+workers = ""
+if len(sys.argv) > 6:
+    workers = " %s %s" % (sys.argv[5], sys.argv[6])
+    
 for i in range(int(sys.argv[2]), int(sys.argv[3])+1):
     if os.path.exists("runqueue"):
         os.remove("runqueue")
@@ -21,6 +28,6 @@ for i in range(int(sys.argv[2]), int(sys.argv[3])+1):
     f.write("#SBATCH --ntasks=1\n")
     f.write("#SBATCH --cpus-per-task=48\n")
     f.write("#SBATCH --time=%s:00:00\n" % sys.argv[4])
-    f.write("python3 /N/slate/jcandera/metaprod_projects/ml_project/manage.py runscript run_queue --script-args %s %s\n" % (sys.argv[1], i))
+    f.write("python3 /N/slate/jcandera/metaprod_projects/ml_project/manage.py runscript run_queue --script-args %s %s%s\n" % (sys.argv[1], i, workers))
     f.close()
     os.system("sbatch runqueue")
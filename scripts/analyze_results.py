@@ -1,4 +1,5 @@
 import os
+import time
 import argparse
 import pandas as pd
 import statistics
@@ -6,20 +7,14 @@ import math
 import numpy as np
 from decimal import Decimal
 import warnings
+import multiprocessing
+from array import array
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import connections
 from django.db.models import Sum
 
-from rpy2.robjects.packages import importr
-import rpy2.robjects.packages as rpackages
-from rpy2.robjects.vectors import StrVector
-import rpy2.robjects as ro
-from rpy2.robjects import pandas2ri
-from rpy2.robjects.conversion import localconverter
-
-base = importr('base')
-utils = importr('utils')
-    
 from results.models import (
     Protein, 
     Protein, 
@@ -41,19 +36,43 @@ from projects.models import (
 )
 
 from .run_command import write_debug, settings
+from .pemm_deqms import peptides_to_proteins, diff_proteins
+from .r_environment import load_r, load_r_package
+from .stage_metrics import stage_metrics
 
 # we have protein inferences in the proteininference table
 
+# the columns that identify a peptide of a sample
+PEPTIDE_COLUMNS = ['peptide_id', 'sample', 'sequence', 'accession', 'gene', 'description', 'ppid', 'organism']
+# ratios fetched from the database at a time
+RATIO_CHUNK = 5000
+
 # in the future, support nsaf quantification for non-multiplexed, but this is much easier
 def run(*args):
     parser = argparse.ArgumentParser()
-    parser.add_argument('project_name', type=str)
+    parser.add_argument('project_name', type=str, nargs='?', default='')
+    parser.add_argument('--benchmark', type=int, default=0, 
+        help='time peptides_to_phenotypes on a synthetic project with this many samples instead')
+    parser.add_argument('--from-initial', action='store_true',
+        help='analyze the existing results/<project>_peptides_initial.tsv instead of the database')
+    parser.add_argument('--python', action='store_true',
+        help='run PEMM and DEqMS with pemm_deqms instead of R, for checking it against R')
     args2 = parser.parse_args(args)
     project = args2.project_name
+    
+    if args2.benchmark > 0:
+        for samples in sorted(set([max(1, args2.benchmark // 4), max(1, args2.benchmark // 2), args2.benchmark])):
+            benchmark_phenotypes(samples)
+        return
+
+    analyze_results(project, from_initial=args2.from_initial, python=args2.python)
 
-    analyze_results(project)
+def analyze_results(project, from_initial=False, python=False):
+    ''' run the analysis and record its resource use '''
+    with stage_metrics(None, "analyze_results", project=project):
+        return analyze_project(project, from_initial, python)
 
-def analyze_results(project):
+def analyze_project(project, from_initial=False, python=False):
     print("Starting analyze_results for %s" % (project))
 
     try:
@@ -71,165 +90,35 @@ def analyze_results(project):
     # we only store the diff proteins for full-proteome
     delete = DiffProtein.objects.filter(project=project).delete()
     
-    if searchsetting.multiplex == True:
+    initial_path = os.path.join(settings.data_folder, project, 'results', '%s_peptides_initial.tsv' % project)
+    if from_initial == True:
+        # used to make the R fixture for pemm_deqms from a peptides_initial table
+        print("Reading %s." % initial_path)
+        peptides_initial = pd.read_csv(initial_path, sep='\t')
+    elif searchsetting.multiplex == True:
         print("Updating peptide ratios for multiplexed data (this may take some time).")
     
-        psm_ratio_list, columns, labelchoices = load_ratios(project)
-    
-        peptides_n = generate_initial_peptides(psm_ratio_list, columns)
+        peptides_n, columns, labelchoices = load_peptides(project)
     
         peptides_initial = peptides_to_phenotypes(peptides_n, columns, labelchoices)
     else:
         print("Updating peptide ratios for label-free data (this may take some time).")
         peptides_initial = generate_lf_peptides(project)
         
-    if not os.path.exists(os.path.join(settings.data_folder, project, 'results')):
-        os.makedirs(os.path.join(settings.data_folder, project, 'results'))
-    peptides_initial.to_csv(os.path.join(settings.data_folder, project, 'results', '%s_peptides_initial.tsv' % project), index=False, sep='\t')
+    if from_initial == False:
+        if not os.path.exists(os.path.join(settings.data_folder, project, 'results')):
+            os.makedirs(os.path.join(settings.data_folder, project, 'results'))
+        peptides_initial.to_csv(initial_path, index=False, sep='\t')
     
-    def run_deqms_lf(phenotype):
-        print("Calculating differentially expressed proteins for %s." % phenotype)
-        
-        query = (Tag.objects.filter(project=project)
-                            .filter(t_type='Control')
-                            .values('name'))
-        if len(query) == 0:
-            print("There must be at least 1 control tag.")
-            return
-            
-        count_t = (Queue.objects.filter(project=project)
-                                .filter(tag__name=phenotype)
-                                .count())
-        if count_t == 0:
-            print("There are no samples with the %s phenotype. Skipping." % phenotype)
-            return
-            
-        ro.r('TMT_columns2_control <- data.frame(matrix(ncol=0, nrow=nrow(df.prot2)))')
-        ro.r('count_columns2_control <- data.frame(matrix(ncol=0, nrow=nrow(df.prot2)))')
-        for q in query:
-            ro.r('TMT_columns2_control = cbind(TMT_columns2_control, df.prot2[, grep("Peak.Area.*.%s$", colnames(df.prot2))])' % q['name'])
-            ro.r('count_columns2_control = cbind(count_columns2_control, df.prot2[, grep("psm.*.%s$", colnames(df.prot2), ignore.case=TRUE)])' % q['name'])
-        ro.r('TMT_columns2_treatment = df.prot2[, grep("Peak.Area.*.%s$", colnames(df.prot2))]' % phenotype)
-        ro.r('dat2 = cbind(TMT_columns2_control, TMT_columns2_treatment)')
-        ro.r('rownames(dat2) = df.prot2$accession')
-        ro.r('count_columns2_treatment = df.prot2[, grep("psm.*.%s$", colnames(df.prot2), ignore.case=TRUE)]' % phenotype)
-        ro.r('count_columns2 = cbind(count_columns2_control, count_columns2_treatment)')
-        ro.r('psm.count.table2 = data.frame(count = rowMins(as.matrix(count_columns2)), row.names =  df.prot2$accession)')
-        ro.r('control2 = rep("control", each=length(TMT_columns2_control))')
-        ro.r('treatment2 = rep("treatment", each=length(TMT_columns2_treatment))')
-        ro.r('cond2 = as.factor(c(control2, treatment2))')
-        ro.r('design2 <- model.matrix(~0+cond2)')
-        ro.r('colnames(design2) = gsub("cond2","",colnames(design2))')
-        ro.r('fit12 <- lmFit(dat2, design2)')
-        ro.r('x2 <- c("treatment-control")')
-        ro.r('contrast2 = makeContrasts(contrasts=x2, levels=design2)')
-        ro.r('fit22 <- contrasts.fit(fit12, contrasts = contrast2)')
-        ro.r('fit32 <- eBayes(fit22)')
-        ro.r('fit32$count = psm.count.table2[rownames(fit32$coefficients),"count"]')
-        ro.r('fit42 = spectraCounteBayes(fit32)')
-        ro.r('DEqMS.results2 = outputResult(fit42,coef_col = 1)')
-        ro.r('fit42$p.value = fit42$sca.p')
-        ro.r('prots2 = rownames(DEqMS.results2)')
-        ro.r('protein_info2 = protein_list[protein_list$accession %in% prots2, ]')
-        ro.r('protein_info2 <- protein_info2[order(protein_info2$accession),]')
-        ro.r('DEqMS.results2["accession"] = rownames(DEqMS.results2)')
-        ro.r('DEqMS.results2 <- DEqMS.results2[order(DEqMS.results2$accession),]')
-        ro.r('protein_info2$accession <- NULL')
-        ro.r('DEqMS.results2.final = cbind(protein_info2, DEqMS.results2)')
-        ro.r('DEqMS.results2.final <- DEqMS.results2.final[, c("accession", names(DEqMS.results2.final)[names(DEqMS.results2.final) != "accession"])]')
-        ro.r('DEqMS.results2.final["gene.1"] <- NULL')
-        DEqMS_results2_final_r = ro.r('DEqMS.results2.final')
-        # write.table(DEqMS.results2.final, file="x:/DEqMS_results2_final.tsv", sep="\t", row.names=FALSE, quote=FALSE)
-        with localconverter(ro.default_converter + pandas2ri.converter):
-            DEqMS_results2_final = ro.conversion.rpy2py(DEqMS_results2_final_r)
-        DEqMS_results2_final.to_csv(os.path.join(settings.data_folder, project, 'results', '%s_DEqMS_results_final_%s.tsv' % (project, phenotype)), index=False, sep='\t')
-        # load results to database  
-        # in this case, we're just going to link the files and not store it in a table
-        # however, we can store the diff protein results because the columns are the same each time  
-        diffprotein_list = []
-        project_ = Project.objects.get(name=project)
-        for index, row in DEqMS_results2_final.iterrows():
-            fp = FastaProtein.objects.get(accession=row['accession'])
-            diffprotein = DiffProtein(fp=fp, project=project_, logfc=row['logFC'],
-                                    p_value=row['adj.P.Val'], d_p_value=row['sca.adj.pval'])
-            diffprotein_list.append(diffprotein)
-        DiffProtein.objects.bulk_create(diffprotein_list, 5000)
-
-    def run_deqms_mp(phenotype):
-        # df.prot2 = read.table('Z:/data/colon_projects/co1/results/co1_proteins_final.tsv', sep="\t", quote="", header=TRUE)
-        print("Calculating differentially expressed proteins for %s." % phenotype)
-        
-        query = (Tag.objects.filter(project=project)
-                            .filter(t_type='Control')
-                            .values('name'))
-        if len(query) == 0:
-            print("There must be at least 1 control tag.")
-            return
-            
-        count_t = (LabelChoice.objects.filter(multiplexlabel__project__name=project)
-                                      .filter(tag__name=phenotype)
-                                      .count())
-        if count_t == 0:
-            print("There are no samples with the %s phenotype. Skipping." % phenotype)
-            return
-            
-        ro.r('TMT_columns2_control <- data.frame(matrix(ncol=0, nrow=nrow(df.prot2)))')
-        ro.r('count_columns2_control <- data.frame(matrix(ncol=0, nrow=nrow(df.prot2)))')
-        for q in query:
-            ro.r('TMT_columns2_control = cbind(TMT_columns2_control, df.prot2[, grep(".ratio.%s$", colnames(df.prot2))])' % q['name'])
-            ro.r('count_columns2_control = cbind(count_columns2_control, df.prot2[, grep("psm.*.%s$", colnames(df.prot2), ignore.case=TRUE)])' % q['name'])
-        ro.r('TMT_columns2_treatment = df.prot2[, grep(".ratio.%s$", colnames(df.prot2))]' % phenotype)
-        ro.r('dat2 = cbind(TMT_columns2_control, TMT_columns2_treatment)')
-        ro.r('rownames(dat2) = df.prot2$accession')
-        ro.r('count_columns2_treatment = df.prot2[, grep("psm.*.%s$", colnames(df.prot2), ignore.case=TRUE)]' % phenotype)
-        ro.r('count_columns2 = cbind(count_columns2_control, count_columns2_treatment)')
-        ro.r('psm.count.table2 = data.frame(count = rowMins(as.matrix(count_columns2)), row.names =  df.prot2$accession)')        
-        #ro.r('psm.count.table2 = data.frame(count = df.prot2$psm, row.names =  df.prot2$accession)')
-        # normalize
-        ro.r('dat2 = equalMedianNormalization(dat2)')
-        # drop na although with pemm, this shouldn't happen
-        ro.r('dat2 = na.omit(dat2)')
-        ro.r('control2 = rep("control", each=length(TMT_columns2_control))')
-        ro.r('treatment2 = rep("treatment", each=length(TMT_columns2_treatment))')
-        ro.r('cond2 = as.factor(c(control2, treatment2))')
-        ro.r('design2 <- model.matrix(~0+cond2)')
-        ro.r('colnames(design2) = gsub("cond2","",colnames(design2))')
-        ro.r('x2 = "treatment-control"')
-        ro.r('contrast2 = makeContrasts(contrasts=x2, levels=design2)')
-        ro.r('fit12 <- lmFit(dat2, design2)')
-        ro.r('fit22 <- contrasts.fit(fit12, contrasts = contrast2)')
-        ro.r('fit32 <- eBayes(fit22)')
-        ro.r('fit32$count = psm.count.table2[rownames(fit32$coefficients),"count"]')
-        ro.r('fit42 = spectraCounteBayes(fit32)')
-        ro.r('DEqMS.results2 = outputResult(fit42,coef_col = 1)')
-        ro.r('fit42$p.value = fit42$sca.p')
-        ro.r('prots2 = rownames(DEqMS.results2)')
-        ro.r('protein_info2 = protein_list[protein_list$accession %in% prots2, ]')
-        ro.r('protein_info2 <- protein_info2[order(protein_info2$accession),]')
-        ro.r('DEqMS.results2["accession"] = rownames(DEqMS.results2)')
-        ro.r('DEqMS.results2 <- DEqMS.results2[order(DEqMS.results2$accession),]')
-        ro.r('protein_info2$accession <- NULL')
-        ro.r('DEqMS.results2.final = cbind(protein_info2, DEqMS.results2)')
-        # move accession to the front
-        ro.r('DEqMS.results2.final <- DEqMS.results2.final[, c("accession", names(DEqMS.results2.final)[names(DEqMS.results2.final) != "accession"])]')
-        ro.r('DEqMS.results2.final["gene.1"] <- NULL')
-        DEqMS_results2_final_r = ro.r('DEqMS.results2.final')
-        # write.table(DEqMS.results2.final, file="x:/DEqMS_results2_final.tsv", sep="\t", row.names=FALSE, quote=FALSE)
-        with localconverter(ro.default_converter + pandas2ri.converter):
-            DEqMS_results2_final = ro.conversion.rpy2py(DEqMS_results2_final_r)
-        DEqMS_results2_final.to_csv(os.path.join(settings.data_folder, project, 'results', '%s_DEqMS_results_final_%s.tsv' % (project, phenotype)), index=False, sep='\t')
-        # load results to database
-        # in this case, we're just going to link the files and not store it in a table
-        # however, we can store the diff protein results because the columns are the same each time  
-        diffprotein_list = []
-        project_ = Project.objects.get(name=project)
-        for index, row in DEqMS_results2_final.iterrows():
-            fp = FastaProtein.objects.get(accession=row['accession'])
-            diffprotein = DiffProtein(fp=fp, project=project_, logfc=row['logFC'],
-                                    p_value=row['adj.P.Val'], d_p_value=row['sca.adj.pval'])
-            diffprotein_list.append(diffprotein)
-        DiffProtein.objects.bulk_create(diffprotein_list, 5000)        
-        
+    # pemm_deqms isn't a SearchSetting choice until it matches R (see
+    # scripts/tests.py) so it's only run when asked for
+    if python == True:
+        return analyze_results_python(project, searchsetting, peptides_initial)
+    
+    # rpy2 starts R when it's imported so it's only imported for the R engine
+    global ro, pandas2ri, localconverter
+    ro, pandas2ri, localconverter = load_r()
+
     print("Note: There may be some R warrnings or messages that can be ignored.")
     print("Running PEMM (this may take some time).")
     load_pemm()
@@ -249,7 +138,7 @@ def analyze_results(project):
         for q in query:
             ro.r('reference = cbind(reference, df.pep[, grep("%s", colnames(df.pep))])' % q['name'])
             # we only want the log of the Reference ratio columns and not PSM
-            ro.r('reference[grep("ratio.%s", colnames(reference))] = log2(reference[grep("ratio.%s", colnames(reference))])')
+            ro.r('reference[grep("ratio.%s", colnames(reference))] = log2(reference[grep("ratio.%s", colnames(reference))])' % (q['name'], q['name']))
             ro.r('df.pep = df.pep[, -grep("%s", colnames(df.pep))]' % q['name'])
         # find the ratio columns    
         ro.r('ratio_columns = grep(".ratio.", colnames(df.pep), ignore.case=TRUE)')
@@ -336,134 +225,355 @@ def analyze_results(project):
     # if there are more phenotypes, one would select those too
     ro.r('library(matrixStats)')
 
-    phenotypes = (Tag.objects.filter(project=project)
-                             .filter(t_type='Treatment')
-                             .values('name'))
+    phenotypes = tag_names(project, 'Treatment')
     if len(phenotypes) == 0:
         print("There must be at least 1 treatment tag.")
         return
      
-    query = (Tag.objects.filter(project=project)
-                            .filter(t_type='Control')
-                            .values('name'))
-    if len(query) == 0:
+    controls = tag_names(project, 'Control')
+    if len(controls) == 0:
         print("There must be at least 1 control tag.")
         return
-            
+    
+    phenotypes = phenotypes_with_samples(project, searchsetting.multiplex, phenotypes)
     if searchsetting.multiplex == True:
-        for pt in phenotypes:
-            run_deqms_mp(pt['name'])
+        run_deqms = run_deqms_mp
     else:
-        for pt in phenotypes:
-            run_deqms_lf(pt['name'])
+        run_deqms = run_deqms_lf
+    
+    # run one at a time in this process. forking workers from a process with
+    # R embedded hasn't been checked to be safe, so only the python engine
+    # uses run_contrasts
+    for phenotype in phenotypes:
+        results = run_deqms(project, controls, phenotype)
+        save_diff_proteins(project, phenotype, results)
 
-def load_deqms():
-    utils.chooseCRANmirror(ind=1)
-    packnames = ('BiocManager', 'matrixStats')
-    names_to_install = [x for x in packnames if not rpackages.isinstalled(x)]
+def analyze_results_python(project, searchsetting, peptides_initial):
+    ''' the PEMM and DEqMS part of analyze_results using pemm_deqms instead of R '''
+    results_folder = os.path.join(settings.data_folder, project, 'results')
+    
+    print("Running PEMM (this may take some time).")
+    peptides_final, proteins_final = peptides_to_proteins(peptides_initial, 
+                                                          searchsetting.multiplex, 
+                                                          tag_names(project, 'Reference'), 
+                                                          searchsetting.imput_threshold)
+    print('Generating final peptides.')
+    peptides_final.to_csv(os.path.join(results_folder, '%s_peptides_final.tsv' % project), index=False, sep='\t')
+    print('Generating proteins.')
+    proteins_final.to_csv(os.path.join(results_folder, '%s_proteins_final.tsv' % project), index=False, sep='\t')
+    
+    print("Running DEqMS.")
+    phenotypes = tag_names(project, 'Treatment')
+    if len(phenotypes) == 0:
+        print("There must be at least 1 treatment tag.")
+        return
+    
+    controls = tag_names(project, 'Control')
+    if len(controls) == 0:
+        print("There must be at least 1 control tag.")
+        return
+    
+    phenotypes = phenotypes_with_samples(project, searchsetting.multiplex, phenotypes)
+    for phenotype, results in run_contrasts(diff_proteins, proteins_final, searchsetting.multiplex, 
+                                            controls, phenotypes):
+        print("Calculated differentially expressed proteins for %s." % phenotype)
+        save_diff_proteins(project, phenotype, results)
 
-    if len(names_to_install) > 0:
-        utils.install_packages(StrVector(names_to_install))
-        
-    if not rpackages.isinstalled('DEqMS'):
-        biocmanager = importr("BiocManager")
-        biocmanager.install("DEqMS")
+def run_deqms_lf(project, controls, phenotype):
+    ''' the DEqMS table for phenotype against the control tags. runs after
+    df.prot2 and protein_list were loaded into R '''
+    print("Calculating differentially expressed proteins for %s." % phenotype)
+    
+    ro.r('TMT_columns2_control <- data.frame(matrix(ncol=0, nrow=nrow(df.prot2)))')
+    ro.r('count_columns2_control <- data.frame(matrix(ncol=0, nrow=nrow(df.prot2)))')
+    for control in controls:
+        ro.r('TMT_columns2_control = cbind(TMT_columns2_control, df.prot2[, grep("Peak.Area.*.%s$", colnames(df.prot2))])' % control)
+        ro.r('count_columns2_control = cbind(count_columns2_control, df.prot2[, grep("psm.*.%s$", colnames(df.prot2), ignore.case=TRUE)])' % control)
+    ro.r('TMT_columns2_treatment = df.prot2[, grep("Peak.Area.*.%s$", colnames(df.prot2))]' % phenotype)
+    ro.r('dat2 = cbind(TMT_columns2_control, TMT_columns2_treatment)')
+    ro.r('rownames(dat2) = df.prot2$accession')
+    ro.r('count_columns2_treatment = df.prot2[, grep("psm.*.%s$", colnames(df.prot2), ignore.case=TRUE)]' % phenotype)
+    ro.r('count_columns2 = cbind(count_columns2_control, count_columns2_treatment)')
+    ro.r('psm.count.table2 = data.frame(count = rowMins(as.matrix(count_columns2)), row.names =  df.prot2$accession)')
+    ro.r('control2 = rep("control", each=length(TMT_columns2_control))')
+    ro.r('treatment2 = rep("treatment", each=length(TMT_columns2_treatment))')
+    ro.r('cond2 = as.factor(c(control2, treatment2))')
+    ro.r('design2 <- model.matrix(~0+cond2)')
+    ro.r('colnames(design2) = gsub("cond2","",colnames(design2))')
+    ro.r('fit12 <- lmFit(dat2, design2)')
+    ro.r('x2 <- c("treatment-control")')
+    ro.r('contrast2 = makeContrasts(contrasts=x2, levels=design2)')
+    ro.r('fit22 <- contrasts.fit(fit12, contrasts = contrast2)')
+    ro.r('fit32 <- eBayes(fit22)')
+    ro.r('fit32$count = psm.count.table2[rownames(fit32$coefficients),"count"]')
+    ro.r('fit42 = spectraCounteBayes(fit32)')
+    ro.r('DEqMS.results2 = outputResult(fit42,coef_col = 1)')
+    ro.r('fit42$p.value = fit42$sca.p')
+    ro.r('prots2 = rownames(DEqMS.results2)')
+    ro.r('protein_info2 = protein_list[protein_list$accession %in% prots2, ]')
+    ro.r('protein_info2 <- protein_info2[order(protein_info2$accession),]')
+    ro.r('DEqMS.results2["accession"] = rownames(DEqMS.results2)')
+    ro.r('DEqMS.results2 <- DEqMS.results2[order(DEqMS.results2$accession),]')
+    ro.r('protein_info2$accession <- NULL')
+    ro.r('DEqMS.results2.final = cbind(protein_info2, DEqMS.results2)')
+    ro.r('DEqMS.results2.final <- DEqMS.results2.final[, c("accession", names(DEqMS.results2.final)[names(DEqMS.results2.final) != "accession"])]')
+    ro.r('DEqMS.results2.final["gene.1"] <- NULL')
+    DEqMS_results2_final_r = ro.r('DEqMS.results2.final')
+    # write.table(DEqMS.results2.final, file="x:/DEqMS_results2_final.tsv", sep="\t", row.names=FALSE, quote=FALSE)
+    with localconverter(ro.default_converter + pandas2ri.converter):
+        DEqMS_results2_final = ro.conversion.rpy2py(DEqMS_results2_final_r)
+    return DEqMS_results2_final
+
+def run_deqms_mp(project, controls, phenotype):
+    ''' the DEqMS table for phenotype against the control tags. runs after
+    df.prot2 and protein_list were loaded into R '''
+    # df.prot2 = read.table('Z:/data/colon_projects/co1/results/co1_proteins_final.tsv', sep="\t", quote="", header=TRUE)
+    print("Calculating differentially expressed proteins for %s." % phenotype)
+    
+    ro.r('TMT_columns2_control <- data.frame(matrix(ncol=0, nrow=nrow(df.prot2)))')
+    ro.r('count_columns2_control <- data.frame(matrix(ncol=0, nrow=nrow(df.prot2)))')
+    for control in controls:
+        ro.r('TMT_columns2_control = cbind(TMT_columns2_control, df.prot2[, grep(".ratio.%s$", colnames(df.prot2))])' % control)
+        ro.r('count_columns2_control = cbind(count_columns2_control, df.prot2[, grep("psm.*.%s$", colnames(df.prot2), ignore.case=TRUE)])' % control)
+    ro.r('TMT_columns2_treatment = df.prot2[, grep(".ratio.%s$", colnames(df.prot2))]' % phenotype)
+    ro.r('dat2 = cbind(TMT_columns2_control, TMT_columns2_treatment)')
+    ro.r('rownames(dat2) = df.prot2$accession')
+    ro.r('count_columns2_treatment = df.prot2[, grep("psm.*.%s$", colnames(df.prot2), ignore.case=TRUE)]' % phenotype)
+    ro.r('count_columns2 = cbind(count_columns2_control, count_columns2_treatment)')
+    ro.r('psm.count.table2 = data.frame(count = rowMins(as.matrix(count_columns2)), row.names =  df.prot2$accession)')        
+    #ro.r('psm.count.table2 = data.frame(count = df.prot2$psm, row.names =  df.prot2$accession)')
+    # normalize
+    ro.r('dat2 = equalMedianNormalization(dat2)')
+    # drop na although with pemm, this shouldn't happen
+    ro.r('dat2 = na.omit(dat2)')
+    ro.r('control2 = rep("control", each=length(TMT_columns2_control))')
+    ro.r('treatment2 = rep("treatment", each=length(TMT_columns2_treatment))')
+    ro.r('cond2 = as.factor(c(control2, treatment2))')
+    ro.r('design2 <- model.matrix(~0+cond2)')
+    ro.r('colnames(design2) = gsub("cond2","",colnames(design2))')
+    ro.r('x2 = "treatment-control"')
+    ro.r('contrast2 = makeContrasts(contrasts=x2, levels=design2)')
+    ro.r('fit12 <- lmFit(dat2, design2)')
+    ro.r('fit22 <- contrasts.fit(fit12, contrasts = contrast2)')
+    ro.r('fit32 <- eBayes(fit22)')
+    ro.r('fit32$count = psm.count.table2[rownames(fit32$coefficients),"count"]')
+    ro.r('fit42 = spectraCounteBayes(fit32)')
+    ro.r('DEqMS.results2 = outputResult(fit42,coef_col = 1)')
+    ro.r('fit42$p.value = fit42$sca.p')
+    ro.r('prots2 = rownames(DEqMS.results2)')
+    ro.r('protein_info2 = protein_list[protein_list$accession %in% prots2, ]')
+    ro.r('protein_info2 <- protein_info2[order(protein_info2$accession),]')
+    ro.r('DEqMS.results2["accession"] = rownames(DEqMS.results2)')
+    ro.r('DEqMS.results2 <- DEqMS.results2[order(DEqMS.results2$accession),]')
+    ro.r('protein_info2$accession <- NULL')
+    ro.r('DEqMS.results2.final = cbind(protein_info2, DEqMS.results2)')
+    # move accession to the front
+    ro.r('DEqMS.results2.final <- DEqMS.results2.final[, c("accession", names(DEqMS.results2.final)[names(DEqMS.results2.final) != "accession"])]')
+    ro.r('DEqMS.results2.final["gene.1"] <- NULL')
+    DEqMS_results2_final_r = ro.r('DEqMS.results2.final')
+    # write.table(DEqMS.results2.final, file="x:/DEqMS_results2_final.tsv", sep="\t", row.names=FALSE, quote=FALSE)
+    with localconverter(ro.default_converter + pandas2ri.converter):
+        DEqMS_results2_final = ro.conversion.rpy2py(DEqMS_results2_final_r)
+    return DEqMS_results2_final
+
+def tag_names(project, t_type):
+    query = (Tag.objects.filter(project=project)
+                        .filter(t_type=t_type)
+                        .values('name'))
+    return [q['name'] for q in query]
+
+def phenotypes_with_samples(project, multiplex, phenotypes):
+    ''' phenotypes that have at least one sample, with one query '''
+    if multiplex == True:
+        query = (LabelChoice.objects.filter(multiplexlabel__project__name=project)
+                                    .filter(tag__name__in=phenotypes)
+                                    .values_list('tag__name', flat=True))
+    else:
+        query = (Queue.objects.filter(project=project)
+                              .filter(tag__name__in=phenotypes)
+                              .values_list('tag__name', flat=True))
+    found = set(query.distinct())
+    
+    for phenotype in phenotypes:
+        if phenotype not in found:
+            print("There are no samples with the %s phenotype. Skipping." % phenotype)
+    return [phenotype for phenotype in phenotypes if phenotype in found]
+
+def run_contrasts(contrast, *args):
+    ''' run contrast(*args, phenotype) for each phenotype (the last of args)
+    in forked workers and yield each phenotype and its table as it finishes '''
+    args, phenotypes = args[:-1], args[-1]
+    if len(phenotypes) == 0:
+        return
     
+    if settings.threads == -1:
+        threads = multiprocessing.cpu_count()
+    else:
+        threads = settings.threads
+    threads = max(1, min(threads, len(phenotypes)))
+    
+    # the workers are forked so they need to open their own connections
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers=threads, 
+                             mp_context=multiprocessing.get_context('fork')) as executor:
+        futures = {}
+        for phenotype in phenotypes:
+            futures[executor.submit(contrast, *args, phenotype)] = phenotype
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+def save_diff_proteins(project, phenotype, results):
+    ''' write the DEqMS table of phenotype and store its proteins '''
+    results.to_csv(os.path.join(settings.data_folder, project, 'results', '%s_DEqMS_results_final_%s.tsv' % (project, phenotype)), index=False, sep='\t')
+    # load results to database
+    # in this case, we're just going to link the files and not store it in a table
+    # however, we can store the diff protein results because the columns are the same each time  
+    
+    # accession is the primary key of FastaProtein so we only need to know
+    # which of them exist, in batches rather than a query per protein
+    accessions = list(results['accession'])
+    found = set()
+    for i in range(0, len(accessions), 5000):
+        found.update(FastaProtein.objects.filter(accession__in=accessions[i:i+5000])
+                                         .values_list('accession', flat=True))
+    
+    diffprotein_list = []
+    project_ = Project.objects.get(name=project)
+    for accession, logfc, p_value, d_p_value in zip(accessions, results['logFC'], 
+                                                    results['adj.P.Val'], results['sca.adj.pval']):
+        if accession not in found:
+            print("Missing FastaProtein %s. Skipping." % accession)
+            continue
+        diffprotein = DiffProtein(fp_id=accession, project=project_, logfc=logfc,
+                                  p_value=p_value, d_p_value=d_p_value)
+        diffprotein_list.append(diffprotein)
+    DiffProtein.objects.bulk_create(diffprotein_list, 5000)
+
+# the packages are installed once by r_environment, which records what was
+# installed so later analyses only have to load them
+def load_deqms():
     global deqms 
-    deqms = importr('DEqMS')
+    deqms = load_r_package('DEqMS')
 
-# note that PEMM isn't on CRAN anymore so it has to be installed manually
+# note that PEMM isn't on CRAN anymore so it's installed from
+# install_folder/software/PEMM_1.0.tar.gz
 def load_pemm():
-    pemm_dir = os.path.join(settings.install_folder, "software", "PEMM_1.0.tar.gz")
-    utils.install_packages(pemm_dir, repos = ro.r("NULL"), type = "source")
     global pemm
-    pemm = importr('PEMM')
-    
-    utils.chooseCRANmirror(ind=1)
-    packnames = ('matrixStats')
-    names_to_install = [x for x in packnames if not rpackages.isinstalled(x)]
-    if len(names_to_install) > 0:
-        utils.install_packages(StrVector(names_to_install))
+    pemm = load_r_package('PEMM')
         
     global matrixstats
-    matrixstats = importr('matrixStats')
+    matrixstats = load_r_package('matrixStats')
+
+def load_peptides(project):
+    ''' the normalized peptides of every sample. the ratios are loaded and
+    turned into peptides one sample at a time so only the PSMs of the largest
+    sample are ever in memory '''
+    query = (LabelChoice.objects.filter(
+                multiplexlabel__project__name=project,
+            ).values('multiplexlabel__sample__name', 'label__name', 'identifier', 'tag__t_type', 'tag__name'))
+    labelchoices = pd.DataFrame(list(query))
+    del query
+    
+    samples = list(Queue.objects.filter(project=project)
+                                .exclude(sample=None)
+                                .values_list('sample__name', flat=True)
+                                .distinct())
+    
+    print("Generating initial peptides.")
+    peptides_list = []
+    for sample in samples:
+        # the reference labels of the sample
+        references = list(labelchoices[(labelchoices['multiplexlabel__sample__name'] == sample)
+                                       & (labelchoices['tag__t_type'] == 'Reference')]['label__name'])
+        psm_ratio_list, columns = load_ratios(project, sample, references)
+        if len(psm_ratio_list) == 0:
+            continue
+        peptides_list.append(generate_initial_peptides(psm_ratio_list, columns))
+        del psm_ratio_list
+        
+    if len(peptides_list) == 0:
+        print("There are no PSM ratios for %s." % project)
+        return(pd.DataFrame(columns=PEPTIDE_COLUMNS + ['psm']), [], labelchoices)
+    
+    # samples can have different labels, those missing from a sample are NaN
+    columns = sorted(set(c for peptides in peptides_list for c in peptides.columns[9:]))
+    peptides_n = pd.concat(peptides_list, ignore_index=True)
+    del peptides_list
+    peptides_n = peptides_n[PEPTIDE_COLUMNS + ['psm'] + columns]
+    
+    return(peptides_n, columns, labelchoices)
 
-def load_ratios(project):
-    print("Loading ratios for multiplexed data.")
+def load_ratios(project, sample, references=[]):
+    ''' the PSM ratios of one sample with a column per label, streamed from
+    the database into a float32 array '''
+    print("Loading ratios for %s." % sample)
     query = (PsmRatio.objects.filter(psm__queue__project__name=project)
-                             .filter(psm__type="proteome")
+                             .filter(psm__queue__sample__name=sample)
+                             .filter(psm__fasta_type="proteome")
                              .exclude(psm__peptide__protein__fp__ppid='0')
                              .exclude(psm__queue__skip=True)
                              .exclude(psm__queue__error__gte=(1 + settings.max_retries))
-                             .values('psm_id', 'psm__peptide__id', 'ratio', 'label',
-                                     'psm__mod_sequence',                             
-                                     'psm__peptide__protein__fp__accession',
-                                     'psm__peptide__protein__fp__gene',
-                                     'psm__peptide__protein__fp__description',                                     
-                                     'psm__peptide__protein__fp__ppid',
-                                     'psm__peptide__protein__fp__ppid__organism',
-                                     'psm__queue__sample__name'))
-
-    # convert to dataframe
-    psm_ratio_list = pd.DataFrame(list(query))
-
-    del query
+                             .values_list('psm_id', 'label', 'ratio', 'psm__peptide__id',
+                                          'psm__mod_sequence',                             
+                                          'psm__peptide__protein__fp__accession',
+                                          'psm__peptide__protein__fp__gene',
+                                          'psm__peptide__protein__fp__description',                                     
+                                          'psm__peptide__protein__fp__ppid',
+                                          'psm__peptide__protein__fp__ppid__organism'))
+    
+    # row of each PSM and column of each label
+    psm_rows = {}
+    label_columns = {}
+    psm_info = []
+    rows = array('q')
+    cols = array('q')
+    values = array('f')
+    for psm_id, label, ratio, *info in query.iterator(chunk_size=RATIO_CHUNK):
+        row = psm_rows.get(psm_id)
+        if row is None:
+            row = psm_rows[psm_id] = len(psm_info)
+            psm_info.append(info)
+        col = label_columns.get(label)
+        if col is None:
+            col = label_columns[label] = len(label_columns)
+        rows.append(row)
+        cols.append(col)
+        values.append(float('nan') if ratio is None else float(ratio))
+    del query, psm_rows
     
-    psm_ratio_list = psm_ratio_list.rename(columns={'psm_id': 'psm_id',
-                                                    'psm__peptide__id': 'peptide_id',
-                                                    'psm__mod_sequence': 'sequence',                                                    
-                                                    'psm__peptide__protein__fp__accession': 'accession',
-                                                    'psm__peptide__protein__fp__gene': 'gene',                                                    
-                                                    'psm__peptide__protein__fp__description': 'description',
-                                                    'psm__peptide__protein__fp__ppid': 'ppid',                                                    
-                                                    'psm__peptide__protein__fp__ppid__organism': 'organism',
-                                                    'psm__queue__sample__name': 'sample'})
-                    
     # turn ratio/label columns into separate columns per label
-    psm_ratio_list = psm_ratio_list.pivot(index=['psm_id', 
-                                                 'peptide_id',
-                                                 'sequence',                                                 
-                                                 'accession',
-                                                 'gene',
-                                                 'description',                                                 
-                                                 'ppid',
-                                                 'organism',
-                                                 'sample'], 
-                                            columns='label', values='ratio')
-    psm_ratio_list = psm_ratio_list.reset_index()
-
-    query = (LabelChoice.objects.filter(
-                multiplexlabel__project__name=project,
-            ).values('multiplexlabel__sample__name', 'label__name', 'identifier', 'tag__t_type', 'tag__name'))
-    labelchoices = pd.DataFrame(list(query))
-    del query
-    columns = [x for x in psm_ratio_list.columns[9:]]
+    columns = sorted(label_columns)
+    ratios = np.full((len(psm_info), len(columns)), np.nan, dtype=np.float32)
+    order = np.empty(len(columns), dtype=np.int64)
+    for i, label in enumerate(columns):
+        order[label_columns[label]] = i
+    ratios[np.frombuffer(rows, dtype=np.int64),
+           order[np.frombuffer(cols, dtype=np.int64)]] = np.frombuffer(values, dtype=np.float32)
+    del rows, cols, values
+    
+    psm_ratio_list = pd.DataFrame(psm_info, columns=PEPTIDE_COLUMNS[:1] + PEPTIDE_COLUMNS[2:])
+    del psm_info
+    psm_ratio_list.insert(1, 'sample', sample)
+    psm_ratio_list = pd.concat([psm_ratio_list, pd.DataFrame(ratios, columns=columns)], axis=1)
+    del ratios
+    
+    if len(psm_ratio_list) == 0:
+        return(psm_ratio_list, columns)
+    
     # drop anything PSMs missing all ratios
     psm_ratio_list.dropna(subset=columns, inplace=True, how='all')
     # also drop any PSMs missing the reference because it can't be normalized
-    # have to lookup the reference for a given sample
-    references = list(labelchoices[labelchoices['tag__t_type'] == 'Reference'][['multiplexlabel__sample__name', 'label__name']].index)
-    psm_ratio_list.drop(index=references, inplace=True)
-
-    for col in columns:
-        psm_ratio_list[col] = psm_ratio_list[col].astype(float)
+    references = [x for x in references if x in columns]
+    if len(references) > 0:
+        psm_ratio_list.dropna(subset=references, inplace=True, how='any')
         
-    return(psm_ratio_list, columns, labelchoices)
+    return(psm_ratio_list, columns)
     
 def generate_initial_peptides(psm_ratio_list, columns):
-    print("Generating initial peptides.")
     # find the median of the psms for the raw peptide ratio
-    peptides = psm_ratio_list.groupby(['peptide_id',
-                                       'sample',
-                                       'sequence',
-                                       'accession',
-                                       'gene',
-                                       'description',                                       
-                                       'ppid',
-                                       'organism',
-                                      ])
+    peptides = psm_ratio_list.groupby(PEPTIDE_COLUMNS)
     # median of PSM is peptide
-    peptides_r = peptides[columns].median()
+    peptides_r = peptides[columns].median().astype(float)
     # peptide PSM count is total PSMs
     peptides_r['psm'] = peptides.size()
     peptides_r = peptides_r.reset_index()
@@ -471,76 +581,103 @@ def generate_initial_peptides(psm_ratio_list, columns):
     peptides_n = peptides_r.groupby('sample')[columns].transform(lambda x: x/x.median())
 
     # pull the peptide id and sample from other dataframe
-    peptides_n = pd.merge(peptides_r[['peptide_id', 
-                                      'sample',
-                                      'sequence',
-                                      'accession',
-                                      'gene',
-                                      'description',
-                                      'ppid',
-                                      'organism',
-                                      'psm',
-                                    ]], peptides_n, left_index=True, right_index=True)
+    peptides_n = pd.merge(peptides_r[PEPTIDE_COLUMNS + ['psm']], 
+                          peptides_n, left_index=True, right_index=True)
                                     
     return(peptides_n)
     
 def peptides_to_phenotypes(peptides_n, columns, labelchoices):
     print("Converting peptides into phenotypes.")
-    print("1")
-    sample_list = list(peptides_n['sample'].unique())
-    # map peptides to phenotypes
-    series_dict = {}
-    series_dict_p = {}
-    for sample in sample_list:
-        for col in columns:
-            mapping = labelchoices[(labelchoices['multiplexlabel__sample__name'] == sample)
-                                    & (labelchoices['label__name'] == col)]
-
-            phenotype_t = "%s ratio %s" % (mapping.iloc[0]['identifier'], mapping.iloc[0]['tag__name'])
-            phenotype_p = "%s psm %s" % (mapping.iloc[0]['identifier'], mapping.iloc[0]['tag__name'])
-            new_series = peptides_n[(peptides_n['sample'] == sample)][col]
-            new_series.name = phenotype_t
-            new_series_p = peptides_n[(peptides_n['sample'] == sample)]['psm']
-            new_series.name = phenotype_p
-            if phenotype_t not in series_dict:
-                series_dict[phenotype_t] = new_series
-            else:
-                series_dict[phenotype_t] = pd.concat(objs=[series_dict[phenotype_t], new_series])
-            if phenotype_p not in series_dict_p:
-                series_dict_p[phenotype_p] = new_series_p
-            else:
-                series_dict_p[phenotype_p] = pd.concat(objs=[series_dict_p[phenotype_p], new_series_p])
-    print("2")
-    # in some cases, the phenotype will be the same so merge the numbers
-    for s in series_dict:
-        series_dict[s] = series_dict[s].groupby(series_dict[s].index).median()
-
-    for s in series_dict_p:
-        series_dict_p[s] = series_dict_p[s].groupby(series_dict_p[s].index).median()
-    
-    series_df = pd.DataFrame(series_dict)
-    del series_dict
-    series_df_p = pd.DataFrame(series_dict_p)
-    del series_dict_p
-    print("3")    
-    peptide_samples = pd.merge(peptides_n, series_df, left_index=True, right_index=True)
-    del series_df
-    peptide_samples = pd.merge(peptide_samples, series_df_p, left_index=True, right_index=True)
-    del series_df_p
-    peptide_samples = peptide_samples.reset_index()
-    print("4")
-    # 'ColonRef Not Reported ratio Reference'
-    peptide_samples = peptide_samples.drop(columns=columns)
-    data_cols = list(sorted(peptide_samples.columns[10:]))
-    peptide_samples = peptide_samples.groupby(['sequence',
-                                               'accession',
-                                               'gene',
-                                               'description',
-                                               'ppid',
-                                               'organism']).agg({'psm': 'sum', **{e: 'median' for e in data_cols}})
-    peptide_samples = peptide_samples.reset_index()
+    keys = PEPTIDE_COLUMNS[2:]
+    
+    # the phenotype of each label of each sample. the phenotype names are
+    # "identifier ratio tag" and "identifier psm tag"
+    mapping = (labelchoices.drop_duplicates(['multiplexlabel__sample__name', 'label__name'])
+                           .rename(columns={'multiplexlabel__sample__name': 'sample', 
+                                            'label__name': 'label'}))
+    phenotype = mapping['identifier'].astype(str) + " ratio " + mapping['tag__name'].astype(str)
+    phenotype_p = mapping['identifier'].astype(str) + " psm " + mapping['tag__name'].astype(str)
+    # grouped by their codes rather than the strings
+    names = pd.CategoricalDtype(sorted(set(phenotype) | set(phenotype_p)))
+    mapping['phenotype'] = phenotype.astype(names)
+    mapping['phenotype_p'] = phenotype_p.astype(names)
+    mapping = mapping[['sample', 'label', 'phenotype', 'phenotype_p']]
+    
+    peptides_n = peptides_n.reset_index(drop=True)
+    # the peptides are combined by sequence and protein across samples
+    group = peptides_n.groupby(keys).ngroup().to_numpy()
+    peptide_samples = peptides_n.groupby(keys)['psm'].sum().reset_index()
+    
+    # one row per peptide and label with the phenotype of the label
+    values = (peptides_n[['sample', 'psm'] + columns].rename_axis('row').reset_index()
+                                                     .melt(id_vars=['row', 'sample', 'psm'], 
+                                                           value_vars=columns, 
+                                                           var_name='label', 
+                                                           value_name='ratio')
+                                                     .merge(mapping, on=['sample', 'label']))
+    # in some cases, the phenotype will be the same for more than one label of
+    # a sample so merge the numbers
+    ratios = values.groupby(['row', 'phenotype'], observed=True)['ratio'].median().reset_index()
+    psms = values.drop_duplicates(['row', 'phenotype_p'])[['row', 'phenotype_p', 'psm']]
+    del values
+    values = pd.concat([ratios.set_axis(['row', 'name', 'value'], axis=1),
+                        psms.set_axis(['row', 'name', 'value'], axis=1)], ignore_index=True)
+    del ratios, psms
+    
+    # median of each phenotype of the peptide in all of the samples
+    values['group'] = group[values['row'].to_numpy()]
+    values = values[values['group'] >= 0]
+    data = values.groupby(['group', 'name'], observed=True)['value'].median().unstack('name')
+    del values
+    data.columns = data.columns.astype(str)
+    data = data.reindex(index=range(len(peptide_samples)), columns=sorted(data.columns))
+    
+    peptide_samples = pd.concat([peptide_samples, data.reset_index(drop=True)], axis=1)
  
     return(peptide_samples)
+
+def benchmark_phenotypes(samples, peptides=5000, labels=16):
+    ''' time peptides_to_phenotypes on a synthetic TMT project with samples
+    plexes of labels channels each '''
+    rng = np.random.default_rng(0)
+    columns = ["%s%s" % (126 + i // 2, "N" if i % 2 == 0 else "C") for i in range(labels)]
+    
+    peptides_list = []
+    labelchoices = []
+    for s in range(samples):
+        sample = "S%s" % s
+        # most peptides are seen in most samples
+        seen = np.sort(rng.choice(int(peptides * 1.5), peptides, replace=False))
+        peptides_s = pd.DataFrame({'peptide_id': seen + s * peptides * 2,
+                                   'sample': sample,
+                                   'sequence': ["PEPTIDE%s" % x for x in seen],
+                                   'accession': ["P%s" % (x // 10) for x in seen],
+                                   'gene': ["G%s" % (x // 10) for x in seen],
+                                   'description': "protein",
+                                   'ppid': "UP000000001",
+                                   'organism': "organism",
+                                   'psm': rng.integers(1, 10, peptides)})
+        ratios = 2 ** rng.normal(0, 0.5, (peptides, labels))
+        ratios[rng.random((peptides, labels)) < 0.05] = np.nan
+        peptides_list.append(pd.concat([peptides_s, pd.DataFrame(ratios, columns=columns)], axis=1))
+        for i, label in enumerate(columns):
+            if i == 0:
+                t_type, tag = "Reference", "Reference"
+            else:
+                t_type, tag = ("Control", "Normal") if i % 2 == 0 else ("Treatment", "Tumor")
+            labelchoices.append({'multiplexlabel__sample__name': sample, 
+                                 'label__name': label, 
+                                 'identifier': "%s_%s" % (sample, i) if i > 0 else "%sRef" % sample,
+                                 'tag__t_type': t_type, 
+                                 'tag__name': tag})
+    peptides_n = pd.concat(peptides_list, ignore_index=True)
+    labelchoices = pd.DataFrame(labelchoices)
+    
+    start = time.time()
+    peptide_samples = peptides_to_phenotypes(peptides_n, columns, labelchoices)
+    print("%s samples x %s labels, %s peptide rows: %.2f s, %s peptides x %s columns" 
+          % (samples, labels, len(peptides_n), time.time() - start, 
+             peptide_samples.shape[0], peptide_samples.shape[1]))
     
 def generate_lf_peptides(project):
     query = (Peptide.objects.filter(queue__project__name=project)
@@ -0,0 +1,107 @@
+# shared parsing of the UniProt style FASTA headers used by MetaProD. the
+# patterns are compiled once here rather than on every call or record
+#
+# python3 manage.py runscript fasta_headers --script-args <fasta>
+# compares this against parsing the file with SeqIO
+
+import argparse
+import gzip
+import time
+from collections import namedtuple
+
+import regex as re
+from Bio import SeqIO
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+
+# headers after generate_fasta: db|accession|name OS= OX= [GN=] ... UPId= PPId=
+HEADER = re.compile(">?[^|]+\|(?P<accession>[^|]+)\|(?P<description>.+)\sOS=(?P<os>.+)\sOX=(?P<ox>[^\s]+)\s(GN=(?P<gn>[^\s]+)\s)?.+UPId=(?P<upid>[^\s]+)\sPPId=(?P<ppid>.+)$")
+# CRAP headers only have db|accession|
+CRAP_HEADER = re.compile(">?[^|]+\|(?P<accession>[^|]+)\|?$")
+# downloaded pan and reference proteome headers, see create_full_fasta
+PAN_HEADER = re.compile("^(?P<start>(?P<db>[^\|]+)\|(?P<accession>[^\|]+)\|(?P<middle>.+)\s)(?P<OS>OS=.+)\s(?P<OX>OX=.+)\s(?P<UPId>UPId=[^\s]+)\s(?P<PPId>PPId=[^\s]+)$")
+REF_HEADER = re.compile("^(?P<start>(?P<db>[^\|]+)\|(?P<accession>[^\|]+)\|(?P<middle>.+))\s(?P<OS>OS=.+)\s(?P<OX>OX=.+)")
+# proteins used for profiling
+PROFILE_PROTEINS = re.compile("ribosomal|elongation|chaperon")
+
+# what MetaProD keeps of a FASTA protein
+FastaRecord = namedtuple('FastaRecord', 
+    ['accession', 'description', 'gene', 'species', 'upid', 'ppid', 'length'])
+
+def run(*args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('fasta', type=str)
+    args2 = parser.parse_args(args)
+
+    benchmark(args2.fasta)
+
+def parse_header(title, length=0):
+    ''' return a FastaRecord for a FASTA header or None if it doesn't match.
+    CRAP proteins belong to proteome 0 '''
+    m1 = HEADER.search(title)
+    if m1:
+        return FastaRecord(m1.group('accession'), 
+                           m1.group('description'),
+                           m1.group('gn') or "unknown",
+                           m1.group('os'),
+                           m1.group('upid'),
+                           m1.group('ppid'),
+                           length)
+    m2 = CRAP_HEADER.search(title)
+    if m2:
+        return FastaRecord(m2.group('accession'), "CRAP", "CRAP", "CRAP", "0", "0", length)
+    return None
+
+def open_fasta(fasta):
+    if fasta.endswith(".gz"):
+        return gzip.open(fasta, "rt")
+    return open(fasta, "r")
+
+def read_fasta(fasta):
+    ''' yield a FastaRecord for each protein in fasta, which may be gzipped.
+    reverses are skipped since they are effectively a duplicate '''
+    with open_fasta(fasta) as f:
+        for title, sequence in SimpleFastaParser(f):
+            record = parse_header(title, len(sequence))
+            if record is None:
+                print("no regexp match for: %s" % title)
+                continue
+            if "_REVERSED" in record.accession:
+                continue
+            yield record
+
+def benchmark(fasta):
+    ''' time parsing fasta the way load_proteins used to, with SeqIO and
+    both patterns on every record, against read_fasta, and check both give 
+    the same records '''
+    start = time.time()
+    old_records = []
+    p1 = re.compile(HEADER.pattern)
+    p2 = re.compile(CRAP_HEADER.pattern)
+    with open_fasta(fasta) as f:
+        for record in SeqIO.parse(f, "fasta"):
+            m1 = p1.search(record.description)
+            m2 = p2.search(record.description)
+            if m1:
+                if "_REVERSED" in m1.group('accession'):
+                    continue
+                old_records.append(FastaRecord(m1.group('accession'), m1.group('description'),
+                                               m1.group('gn') if m1.group('gn') else "unknown",
+                                               m1.group('os'), m1.group('upid'), m1.group('ppid'),
+                                               len(record.seq)))
+            elif m2:
+                if "_REVERSED" in m2.group('accession'):
+                    continue
+                old_records.append(FastaRecord(m2.group('accession'), "CRAP", "CRAP", "CRAP", "0", "0",
+                                               len(record.seq)))
+    old_time = time.time() - start
+
+    start = time.time()
+    new_records = []
+    for record in read_fasta(fasta):
+        new_records.append(record)
+    new_time = time.time() - start
+
+    print("%s records" % len(new_records))
+    print("SeqIO: %.2f s (%.0f records/s)" % (old_time, len(old_records) / max(old_time, 1e-9)))
+    print("read_fasta: %.2f s (%.0f records/s)" % (new_time, len(new_records) / max(new_time, 1e-9)))
+    print("same records: %s" % (old_records == new_records))
@@ -0,0 +1,207 @@
+# an on-disk index of the proteins in a FASTA so load_proteins can look up
+# the few accessions it needs instead of parsing the whole FASTA for every
+# file. the index is a small sqlite database holding the parsed header of
+# every protein. indexes are kept in install_folder/fasta/index and named by
+# the sha256 of the FASTA, so every copy or hardlink of a FASTA (e.g. the ones
+# generate_fasta shares from its cache) uses the same index and a changed
+# FASTA gets a new one. the sha256 of each FASTA is remembered by inode, size
+# and mtime so a FASTA is only hashed again when it changes
+#
+# python3 manage.py runscript fasta_index --script-args <fasta> [accessions]
+# builds the index if needed and compares a lookup against a scan
+
+import os
+import time
+import sqlite3
+import hashlib
+import argparse
+
+from .fasta_headers import read_fasta, FastaRecord
+from .run_command import settings
+
+INDEX_SUFFIX = ".index.sqlite"
+# the sha256 of the FASTAs seen so far
+HASHES = "hashes.sqlite"
+INDEX_VERSION = 1
+# rows inserted per executemany while building
+INDEX_BATCH = 5000
+# sqlite allows 999 parameters per statement in older versions
+LOOKUP_BATCH = 500
+
+def run(*args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('fasta', type=str)
+    parser.add_argument('accessions', type=str, nargs='*')
+    args2 = parser.parse_args(args)
+
+    benchmark(args2.fasta, args2.accessions)
+
+def index_folder():
+    return os.path.join(settings.install_folder, "fasta", "index")
+
+def index_path(fasta):
+    return os.path.join(index_folder(), fasta_hash(fasta) + INDEX_SUFFIX)
+
+def fasta_hash(fasta):
+    ''' the sha256 of fasta, only hashing it if this inode hasn't been hashed
+    at its current size and mtime '''
+    stat = os.stat(fasta)
+    key = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    os.makedirs(index_folder(), exist_ok=True)
+    conn = sqlite3.connect(os.path.join(index_folder(), HASHES), timeout=60)
+    try:
+        with conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS fasta (dev INTEGER, ino INTEGER,
+                size INTEGER, mtime INTEGER, sha256 TEXT, PRIMARY KEY (dev, ino))''')
+        row = conn.execute("SELECT sha256 FROM fasta WHERE dev = ? AND ino = ? AND size = ? AND mtime = ?",
+                           key).fetchone()
+        if row is not None:
+            return row[0]
+
+        sha256 = file_hash(fasta)
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO fasta VALUES (?, ?, ?, ?, ?)", key + (sha256,))
+    finally:
+        conn.close()
+    return sha256
+
+def file_hash(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024*1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def read_meta(index):
+    ''' returns the meta table of an index or None if it's missing or unusable '''
+    if not os.path.exists(index):
+        return None
+    try:
+        conn = sqlite3.connect(index)
+        try:
+            meta = dict(conn.execute("SELECT key, value FROM meta").fetchall())
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return None
+    if meta.get('version') != str(INDEX_VERSION):
+        return None
+    return meta
+
+def build_index(fasta, index=None):
+    ''' parse fasta into a new index. the index is written to a temporary file
+    and renamed so jobs reading the same FASTA never see a partial index '''
+    sha256 = fasta_hash(fasta)
+    if index is None:
+        index = os.path.join(index_folder(), sha256 + INDEX_SUFFIX)
+
+    stat = os.stat(fasta)
+
+    temp_index = "%s.%s.tmp" % (index, os.getpid())
+    if os.path.exists(temp_index):
+        os.remove(temp_index)
+
+    conn = sqlite3.connect(temp_index)
+    try:
+        conn.execute("PRAGMA journal_mode = OFF")
+        conn.execute("PRAGMA synchronous = OFF")
+        conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+        conn.execute('''CREATE TABLE protein (accession TEXT PRIMARY KEY,
+            description TEXT, gene TEXT, species TEXT, upid TEXT, ppid TEXT,
+            length INTEGER) WITHOUT ROWID''')
+
+        rows = []
+        count = 0
+        for record in read_fasta(fasta):
+            rows.append(tuple(record))
+            if len(rows) >= INDEX_BATCH:
+                conn.executemany("INSERT OR IGNORE INTO protein VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+                count += len(rows)
+                rows = []
+        conn.executemany("INSERT OR IGNORE INTO protein VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        count += len(rows)
+
+        conn.executemany("INSERT INTO meta VALUES (?, ?)",
+            [('version', str(INDEX_VERSION)),
+             ('sha256', sha256),
+             ('size', str(stat.st_size)),
+             ('records', str(count)),
+             ('date', time.strftime("%Y-%m-%d %H:%M:%S"))])
+        conn.commit()
+    except:
+        conn.close()
+        os.remove(temp_index)
+        raise
+    conn.close()
+
+    os.replace(temp_index, index)
+    return index
+
+def open_index(fasta):
+    ''' returns the index of fasta, building it first if there's no index of
+    a FASTA with the same contents, and whether it had to be built '''
+    index = index_path(fasta)
+    if read_meta(index) is not None:
+        return index, False
+    return build_index(fasta, index), True
+
+def lookup(fasta, accessions):
+    ''' returns a FastaRecord for each of accessions found in fasta and
+    whether the index had to be built '''
+    index, built = open_index(fasta)
+    accessions = list(accessions)
+
+    records = []
+    conn = sqlite3.connect(index)
+    try:
+        for i in range(0, len(accessions), LOOKUP_BATCH):
+            batch = accessions[i:i + LOOKUP_BATCH]
+            query = ("SELECT accession, description, gene, species, upid, ppid, length FROM protein WHERE accession IN (%s)"
+                     % ", ".join("?" * len(batch)))
+            for row in conn.execute(query, batch):
+                records.append(FastaRecord(*row))
+    finally:
+        conn.close()
+
+    return records, built
+
+def benchmark(fasta, accessions):
+    ''' time scanning fasta for accessions against an index lookup. uses the
+    last accessions in the FASTA when none are given since they are the worst
+    case for a scan '''
+    if not accessions:
+        last = []
+        for record in read_fasta(fasta):
+            last.append(record.accession)
+            if len(last) > 100:
+                last.pop(0)
+        accessions = last
+
+    start = time.time()
+    needed = set(accessions)
+    scanned = []
+    for record in read_fasta(fasta):
+        if record.accession in needed:
+            scanned.append(record)
+            needed.remove(record.accession)
+            if len(needed) == 0:
+                break
+    scan_time = time.time() - start
+
+    if os.path.exists(index_path(fasta)):
+        os.remove(index_path(fasta))
+
+    start = time.time()
+    build_index(fasta)
+    build_time = time.time() - start
+
+    start = time.time()
+    found, built = lookup(fasta, accessions)
+    lookup_time = time.time() - start
+
+    print("%s accessions" % len(accessions))
+    print("scan: %.3f s" % scan_time)
+    print("build index: %.3f s (once per FASTA)" % build_time)
+    print("index lookup: %.3f s" % lookup_time)
+    print("same records: %s" % (sorted(scanned) == sorted(found)))
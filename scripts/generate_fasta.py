@@ -6,22 +6,27 @@ import os
 import shutil
 import gzip
 import csv
+import json
+import hashlib
 from pathlib import Path
-import urllib.request
-from Bio import SeqIO
 from Bio.SeqIO.FastaIO import SimpleFastaParser
 import pandas as pd
 import time
 import multiprocessing
+from collections import deque
 from concurrent.futures import ProcessPoolExecutor, as_completed, ThreadPoolExecutor
 
+from django.db import connections
 from django.db.models import Sum
 from django.core.exceptions import ObjectDoesNotExist
 
 from projects.models import Queue, SearchSetting
 from results.models import Protein, SpeciesSummary, SpeciesFileSummary
 from .run_command import run_command, settings, write_log
+from .tool_runtime import clone_software
 from .load_proteomes import load_proteomes
+from .fasta_headers import PAN_HEADER, REF_HEADER, PROFILE_PROTEINS
+from .stage_metrics import stage_metrics
 
 def run(*args):
     parser = argparse.ArgumentParser()
@@ -41,7 +46,22 @@ from requests.adapters import HTTPAdapter, Retry
 re_next_link = re.compile(r'<(.+)>; rel="next"')
 retries = Retry(total=5, backoff_factor=0.25, status_forcelist=[500, 502, 503, 504])
 session = requests.Session()
-session.mount("https://", HTTPAdapter(max_retries=retries))
+session.mount("https://", HTTPAdapter(max_retries=retries, pool_maxsize=10))
+
+# proteome downloads
+PAN_PROTEOME_URL = "https://ftp.uniprot.org/pub/databases/uniprot/current_release/knowledgebase/pan_proteomes/%s.fasta.gz"
+REF_PROTEOME_URL = "https://rest.uniprot.org/uniprotkb/stream?compressed=true&format=fasta&query=proteome:%s"
+# uniprot throttles clients that open too many connections
+DOWNLOAD_THREADS = 8
+DOWNLOAD_TIMEOUT = 300
+DOWNLOAD_MANIFEST = "download_manifest.json"
+
+# proteome formatting
+HUMAN_PROTEOME = "UP000005640.fasta.gz"
+# the proteomes are rewritten with a faster level than gzip's default
+GZIP_LEVEL = 6
+# name of the FASTA in each folder of the proteome FASTA cache
+CACHED_FASTA = "proteome_concatenated_target_decoy.fasta"
 
 def get_next_link(headers):
     if "Link" in headers:
@@ -59,6 +79,11 @@ def get_batch(batch_url):
 # end uniprot code
 
 def generate_fasta(project, fasta_type):
+    ''' make the FASTA for fasta_type and record its resource use '''
+    with stage_metrics(None, "generate_fasta_%s" % fasta_type, project=project):
+        return make_fasta(project, fasta_type)
+
+def make_fasta(project, fasta_type):
     write_log("Starting generate_fasta for %s %s." % (project, fasta_type), "fasta", project)
 
     try:
@@ -92,17 +117,12 @@ def generate_fasta(project, fasta_type):
                               .exclude(skip=True)
                               .filter(project__name=project))
         
-        # can send them individually
+        # the files that share a FASTA
+        groups = []
         if searchsetting.profile_type == SearchSetting.ProfileType.FILE:
             write_log("File based profiling.", "fasta", project)
-            start = time.time()
-        
             for q in query:
-                generate_proteome_fasta(project, [q.filename], 0)
-                    
-            end = time.time()
-            runtime = end-start
-            print(runtime)
+                groups.append([q.filename])
         
         # need to check if a sample has been assigned
         # if no sample, that file has to be processed individually
@@ -113,25 +133,27 @@ def generate_fasta(project, fasta_type):
             for q in query:
                 # if there's no sample, then it has to be filename
                 if q.sample is None:
-                    generate_proteome_fasta(project, [q.filename], 0)
+                    groups.append([q.filename])
                 else:
                     if q.sample in samples:
                         samples[q.sample].append(q.filename)
                     else:
                         samples[q.sample] = [q.filename]
             
-            if len(samples) > 0:
-                for sample in samples:
-                    generate_proteome_fasta(project, samples[sample], 1)
+            for sample in samples:
+                groups.append(samples[sample])
                 
         elif searchsetting.profile_type == SearchSetting.ProfileType.PROJECT:
             write_log("Project based profiling.", "fasta", project)
             files = []
             for q in query:
                 files.append(q.filename)
+            if len(files) > 0:
+                groups.append(files)
             
-            generate_proteome_fasta(project, files, 0)
-            # we generate the FASTA for 1 file and copy it to others
+        start = time.time()
+        generate_proteome_fastas(project, groups, searchsetting)
+        write_log("Generated proteome FASTAs in %.1f s." % (time.time() - start), "fasta", project)
             
     elif fasta_type == "profile":
         # move crap to somewhere accessible without project
@@ -167,154 +189,232 @@ def generate_fasta(project, fasta_type):
             write_log("Missing FASTA file.", "fasta", project)
             write_log("Failed to generate profile FASTA for %s." % (project), "fasta", project)
 
-def generate_proteome_fasta(project, filenames, have_sample):
-
-    try:
-        searchsetting=SearchSetting.objects.get(project__name=project)
-    except:
-        write_log("Searchsetting does not exist for %s. Make sure the project and searchsetting are added first." % (project), "fasta", project)
-        return 0
- 
-    write_log("Generating FASTA for %s." % (filenames), "fasta", project)
-                     
-    banned_species = []
-    proteomes = []  
-    # these are the proteomes to exclude based on too few proteins
-    query_s = (SpeciesFileSummary.objects.filter(fasta_type='profile')
-                                         .filter(queue__filename__in=filenames)
-                                         .filter(queue__project=project)
-                                         .exclude(ppid_id=0)
-                                         .exclude(ppid_id='UP000005640')
-                                         .values('ppid_id')
-                                         .annotate(sum=Sum('val_num_protein'))
-                                         .filter(sum__lt=searchsetting.profile_exclude_below)
-                                         .values_list('ppid_id', flat=True))
-    banned_species = list(query_s)
-   
-    # sum of all bacterial nsaf for the files being queried
-    query_t = (Protein.objects.filter(fasta_type="profile")
-                              .filter(queue__filename__in=filenames)
-                              .filter(queue__project=project)
-                              .exclude(fp__ppid__proteome='0')
-                              .exclude(fp__ppid__proteome='UP000005640')
-                              .exclude(fp__ppid__proteome__in=banned_species)
-                              .aggregate(Sum('nsaf')))
-    total = query_t['nsaf__sum']
-
-    if not total is None:
-        total = float(total) * float(searchsetting.profile_threshold / 100)
-        query = (Protein.objects.filter(fasta_type="profile")
-                                .filter(queue__filename__in=filenames)
-                                .filter(queue__project=project)
-                                .exclude(fp__ppid__proteome='0')
-                                .exclude(fp__ppid__proteome='UP000005640')
-                                .exclude(fp__ppid__proteome__in=banned_species)
-                                .values('fp__ppid__proteome')
-                                .annotate(sum=Sum('nsaf'))
-                                .order_by('-sum'))
-                        
-        count = 0
-        current_psm = 0       
-        for entry in query:
-            # running count is below the threshold, so we add it
-            if count <= total:
-                proteomes.append(entry['fp__ppid__proteome'])
-                count += entry['sum']              
-                current_psm = entry['sum']
-            else:
-                if entry['sum'] == current_psm:
-                    proteomes.append(entry['fp__ppid__proteome'])
-                else:
-                    break
-            
-            # don't bother adding CRAP or any others without headers
-            if len(entry['fp__ppid__proteome']) < 1 or entry['fp__ppid__proteome'] == '0':
+def generate_proteome_fastas(project, groups, searchsetting):
+    ''' generate the proteome FASTA of each group of files. groups with the
+    same proteomes share a FASTA and the FASTAs are made in parallel '''
+    if len(groups) == 0:
+        return
+        
+    filenames = [filename for group in groups for filename in group]
+    species_sums, nsaf_sums = proteome_sums(project, filenames)
+    
+    # files to share each FASTA with, by proteomes
+    builds = {}
+    for group in groups:
+        write_log("Generating FASTA for %s." % (group), "fasta", project)
+        proteomes = select_proteomes(group, species_sums, nsaf_sums, searchsetting)
+        if len(proteomes) > 0:
+            write_log("Including the proteomes: %s" % (proteomes), "fasta", project)
+        builds.setdefault(tuple(proteomes), []).extend(group)
+        
+    if settings.threads == -1:
+        threads = multiprocessing.cpu_count()
+    else:
+        threads = settings.threads
+    threads = max(1, min(threads, len(builds)))
+    
+    # the workers are forked so they need to open their own connections
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers=threads, 
+                             mp_context=multiprocessing.get_context('fork')) as executor:
+        futures = {}
+        for proteomes in builds:
+            future = executor.submit(cached_proteome_fasta, project, list(proteomes), searchsetting)
+            futures[future] = builds[proteomes]
+        
+        for future in as_completed(futures):
+            try:
+                cached_fasta = future.result()
+            except Exception as e:
+                write_log("Failed to generate FASTA for %s: %s" % (futures[future], e), "fasta", project)
                 continue
-                
-            if entry['fp__ppid__proteome'] not in proteomes:
-                proteomes.append(entry['fp__ppid__proteome'])
+            if cached_fasta is None:
+                write_log("Failed to generate FASTA for %s." % (futures[future]), "fasta", project)
+                continue
+            for filename in futures[future]:
+                share_fasta(project, cached_fasta, filename)
+
+def proteome_sums(project, filenames):
+    ''' the number of proteins and the nsaf of each proteome in each of
+    filenames, with one grouped query each '''
+    species_sums = {}
+    query = (SpeciesFileSummary.objects.filter(fasta_type='profile')
+                                       .filter(queue__filename__in=filenames)
+                                       .filter(queue__project=project)
+                                       .exclude(ppid_id=0)
+                                       .exclude(ppid_id='UP000005640')
+                                       .values('queue__filename', 'ppid_id')
+                                       .annotate(sum=Sum('val_num_protein')))
+    for entry in query:
+        species_sums.setdefault(entry['queue__filename'], {})[entry['ppid_id']] = entry['sum'] or 0
         
-        # so now we have to check again to look for species that weren't in
-        # the proteomes yet but that have proteins above the threshold
-        query_s = (SpeciesFileSummary.objects.filter(fasta_type='profile')
-                                             .filter(queue__filename__in=filenames)
-                                             .filter(queue__project=project)
-                                             .exclude(ppid_id=0)
-                                             .exclude(ppid_id='UP000005640')
-                                             .values('ppid_id')
-                                             .annotate(sum=Sum('val_num_protein'))
-                                             .filter(sum__gte=(searchsetting.profile_include_above))
-                                             .values_list('ppid_id', flat=True))
-        approved_species = list(query_s)
-        for species in approved_species:
-            if species not in proteomes:
-                proteomes.append(species)
-    
-    filename = filenames.pop(0)
-    fasta_file = "%s%s%s_%s_%s.fasta" % (os.path.join(settings.data_folder, project, "fasta", "proteome", filename), os.sep, project, filename, "proteome")
-    fasta_file_concat = "%s%s%s_%s_%s_concatenated_target_decoy.fasta" % (os.path.join(settings.data_folder, project, "fasta", "proteome", filename), os.sep, project, filename, "proteome")
+    nsaf_sums = {}
+    query = (Protein.objects.filter(fasta_type="profile")
+                            .filter(queue__filename__in=filenames)
+                            .filter(queue__project=project)
+                            .exclude(fp__ppid__proteome='0')
+                            .exclude(fp__ppid__proteome='UP000005640')
+                            .values('queue__filename', 'fp__ppid__proteome')
+                            .annotate(sum=Sum('nsaf')))
+    for entry in query:
+        if entry['sum'] is None:
+            continue
+        nsaf_sums.setdefault(entry['queue__filename'], {})[entry['fp__ppid__proteome']] = entry['sum']
     
-    if os.path.exists(fasta_file):
-        os.remove(fasta_file)
-
-    if os.path.exists(fasta_file_concat):
-        os.remove(fasta_file_concat)
- 
-    if os.path.exists(os.path.join(settings.data_folder, project, "fasta", "proteome", filename)):
-        shutil.rmtree(os.path.join(settings.data_folder, project, "fasta", "proteome", filename))
-    os.makedirs(os.path.join(settings.data_folder, project, "fasta", "proteome", filename))
-            
-    if len(proteomes) > 0:
-        write_log("Including the proteomes: %s" % (proteomes), "fasta", project)
-        for proteome in proteomes:
-            if os.path.exists(os.path.join(settings.install_folder, "fasta", "pan", "%s.fasta.gz" % proteome)):
-                location = "pan"
-            elif os.path.exists(os.path.join(settings.install_folder, "fasta", "ref", "%s.fasta.gz" % proteome)):
-                location = "ref"
+    return species_sums, nsaf_sums
+
+def select_proteomes(filenames, species_sums, nsaf_sums, searchsetting):
+    ''' the proteomes to include in the FASTA of filenames, sorted '''
+    species = {}
+    nsaf = {}
+    for filename in filenames:
+        for ppid, value in species_sums.get(filename, {}).items():
+            species[ppid] = species.get(ppid, 0) + value
+        for ppid, value in nsaf_sums.get(filename, {}).items():
+            nsaf[ppid] = nsaf.get(ppid, 0) + value
+    
+    # these are the proteomes to exclude based on too few proteins
+    banned_species = set(ppid for ppid in species if species[ppid] < searchsetting.profile_exclude_below)
+    for ppid in banned_species:
+        nsaf.pop(ppid, None)
+    
+    proteomes = []
+    if len(nsaf) == 0:
+        return proteomes
+    
+    # sum of all bacterial nsaf for the files
+    total = float(sum(nsaf.values())) * float(searchsetting.profile_threshold / 100)
+    
+    count = 0
+    current_psm = 0
+    for ppid in sorted(nsaf, key=lambda ppid: (-nsaf[ppid], ppid)):
+        # running count is below the threshold, so we add it
+        if count <= total:
+            proteomes.append(ppid)
+            count += nsaf[ppid]
+            current_psm = nsaf[ppid]
+        else:
+            if nsaf[ppid] == current_psm:
+                proteomes.append(ppid)
             else:
-                write_log("Missing FASTA file for %s." % (proteome), "fasta", project)
-                return
-
-            with gzip.open(os.path.join(settings.install_folder, "fasta", location, "%s.fasta.gz" % proteome), "rb") as f_in:
-                with open(fasta_file, "ab") as f_out:
-                    shutil.copyfileobj(f_in, f_out)             
+                break
+    
+    # so now we have to check again to look for species that weren't in
+    # the proteomes yet but that have proteins above the threshold
+    for ppid in species:
+        if species[ppid] >= searchsetting.profile_include_above and ppid not in proteomes:
+            proteomes.append(ppid)
+    
+    # don't bother adding CRAP or any others without headers
+    return sorted(set(ppid for ppid in proteomes if len(ppid) > 0 and ppid != '0'))
+
+def proteome_fasta_sources(project, proteomes, searchsetting):
+    ''' returns the files a proteome FASTA is made from, in order, or None if
+    one of them is missing '''
+    sources = []
+    for proteome in proteomes:
+        if os.path.exists(os.path.join(settings.install_folder, "fasta", "pan", "%s.fasta.gz" % proteome)):
+            location = "pan"
+        elif os.path.exists(os.path.join(settings.install_folder, "fasta", "ref", "%s.fasta.gz" % proteome)):
+            location = "ref"
+        else:
+            write_log("Missing FASTA file for %s." % (proteome), "fasta", project)
+            return None
+        sources.append(os.path.join(settings.install_folder, "fasta", location, "%s.fasta.gz" % proteome))
 
     if searchsetting.use_human == True:
         if not os.path.exists("%s%shuman.fasta" % (os.path.join(settings.install_folder, "fasta"), os.sep)):
             write_log("human.fasta does not exist. Remove full.fasta and run generate_fasta again.", "fasta", project)
-            return
-        with open(fasta_file, "a") as f_out:
-            with open(os.path.join(settings.install_folder, "fasta", "human.fasta"), "r") as f_in:
-                shutil.copyfileobj(f_in, f_out)
-            f_out.write(os.linesep)
+            return None
+        sources.append(os.path.join(settings.install_folder, "fasta", "human.fasta"))
 
     if searchsetting.use_crap == True:
-        # copy CRAP to destination file
-        with open(fasta_file, "a") as f_out:
-            with open(os.path.join(settings.install_folder, "fasta", "crap.fasta"), "r") as f_in:
-                shutil.copyfileobj(f_in, f_out)
-            f_out.write(os.linesep)
-    
-    generate_decoy(project, fasta_file)
+        sources.append(os.path.join(settings.install_folder, "fasta", "crap.fasta"))
+
+    return sources
+
+def proteome_fasta_key(proteomes, searchsetting, sources):
+    ''' the cache key of a proteome FASTA. the size and modification time of
+    each source are included so a FASTA is remade when a proteome is updated '''
+    key = {'proteomes': proteomes,
+           'use_human': bool(searchsetting.use_human),
+           'use_crap': bool(searchsetting.use_crap),
+           'decoy': "FastaCLI-%s" % settings.searchgui_ver,
+           'sources': [[os.path.relpath(source, os.path.join(settings.install_folder, "fasta")), 
+                        os.path.getsize(source), 
+                        os.stat(source).st_mtime_ns] for source in sources]}
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest(), key
+
+def cached_proteome_fasta(project, proteomes, searchsetting):
+    ''' returns the concatenated target decoy FASTA for proteomes from the
+    cache in install_folder/fasta/cache, making it first if it isn't there. 
+    the cache is shared by every file, sample and project '''
+    sources = proteome_fasta_sources(project, proteomes, searchsetting)
+    if sources is None:
+        return None
+
+    key, key_data = proteome_fasta_key(proteomes, searchsetting, sources)
+    cache_folder = os.path.join(settings.install_folder, "fasta", "cache", key)
+    cached_fasta = os.path.join(cache_folder, CACHED_FASTA)
     
-    copy_fasta(project, filename, filenames)
+    if os.path.exists(cached_fasta):
+        write_log("Using cached FASTA %s." % (key), "fasta", project)
+        return cached_fasta
 
-def copy_fasta(project, filename, filenames):
-    ''' this just copies the fasta of filename for each of the entries in filename '''
+    write_log("Generating FASTA %s." % (key), "fasta", project)
     
-    if os.path.exists("%s%s%s_%s_%s_concatenated_target_decoy.fasta" % (os.path.join(settings.data_folder, project, "fasta", "proteome", filename), os.sep, project, filename, "proteome")):
-        for file in filenames:
-            write_log("Copying fasta for %s from %s." % (file, filename), "fasta", project)
-
-            if os.path.exists(os.path.join(settings.data_folder, project, "fasta", "proteome", file)):
-                shutil.rmtree(os.path.join(settings.data_folder, project, "fasta", "proteome", file))
-            os.makedirs(os.path.join(settings.data_folder, project, "fasta", "proteome", file))
+    # made in a temporary folder and renamed so a partial FASTA is never used
+    temp_folder = "%s.%s.tmp" % (cache_folder, os.getpid())
+    if os.path.exists(temp_folder):
+        shutil.rmtree(temp_folder)
+    os.makedirs(temp_folder)
+
+    fasta_file = os.path.join(temp_folder, "proteome.fasta")
+    with open(fasta_file, "wb") as f_out:
+        for source in sources:
+            if source.endswith(".gz"):
+                with gzip.open(source, "rb") as f_in:
+                    shutil.copyfileobj(f_in, f_out)
+            else:
+                with open(source, "rb") as f_in:
+                    shutil.copyfileobj(f_in, f_out)
+                f_out.write(os.linesep.encode())
     
-            if os.path.exists("%s%s%s_%s_%s.fasta" % (os.path.join(settings.data_folder, project, "fasta", "proteome", file), os.sep, project, file, "proteome")):
-                os.remove("%s%s%s_%s_%s.fasta" % (os.path.join(settings.data_folder, project, "fasta", "proteome", file), os.sep, project, file, "proteome"))
-                
-            shutil.copy("%s%s%s_%s_%s_concatenated_target_decoy.fasta" % (os.path.join(settings.data_folder, project, "fasta", "proteome", filename), os.sep, project, filename, "proteome"),
-                       "%s%s%s_%s_%s_concatenated_target_decoy.fasta" % (os.path.join(settings.data_folder, project, "fasta", "proteome", file), os.sep, project, file, "proteome")) 
+    if generate_decoy(project, fasta_file) == False:
+        shutil.rmtree(temp_folder)
+        return None
+    
+    # only the target decoy FASTA is searched
+    os.remove(fasta_file)
+    with open(os.path.join(temp_folder, "key.json"), "w") as f:
+        json.dump(key_data, f, indent=1)
+
+    try:
+        os.rename(temp_folder, cache_folder)
+    except OSError:
+        # made by another process in the meantime
+        shutil.rmtree(temp_folder)
+        if not os.path.exists(cached_fasta):
+            raise
+
+    return cached_fasta
+
+def share_fasta(project, cached_fasta, file):
+    ''' put a cached FASTA into the folder of file. a hardlink is used if 
+    possible so removing the cache doesn't affect projects, otherwise a symlink '''
+    folder = os.path.join(settings.data_folder, project, "fasta", "proteome", file)
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.makedirs(folder)
+
+    fasta_file_concat = "%s%s%s_%s_%s_concatenated_target_decoy.fasta" % (folder, os.sep, project, file, "proteome")
+    try:
+        os.link(cached_fasta, fasta_file_concat)
+    except OSError:
+        try:
+            os.symlink(cached_fasta, fasta_file_concat)
+        except OSError:
+            shutil.copy(cached_fasta, fasta_file_concat)
                        
 def generate_profile_fasta(project):
     try:
@@ -439,22 +539,24 @@ def generate_decoy(project, fasta_file):
     ''' generate decoy sequences for FASTA file '''
     write_log("Generating decoy sequences.", "fasta", project)
 
-    if os.path.exists(os.path.join(settings.data_folder, project, "fasta", "temp")):
-        shutil.rmtree(os.path.join(settings.data_folder, project, "fasta", "temp"))
+    # per process since several FASTAs may be decoyed at once
+    temp_folder = os.path.join(settings.data_folder, project, "fasta", "temp", str(os.getpid()))
+    if os.path.exists(temp_folder):
+        shutil.rmtree(temp_folder)
 
     # remake the temp folder
-    os.makedirs(os.path.join(settings.data_folder, project, "fasta", "temp", "software"))
+    os.makedirs(os.path.join(temp_folder, "software"))
     
     if not os.path.exists(os.path.join(settings.install_folder, "software", "SearchGUI-%s" % settings.searchgui_ver, "SearchGUI-%s.jar" % settings.searchgui_ver)):
         write_log("Missing SearchGUI install.", "fasta", project)
         return False
         
-    # copy searchgui into temp
-    shutil.copytree(os.path.join(settings.install_folder, "software", "SearchGUI-%s" % settings.searchgui_ver), 
-                    os.path.join(settings.data_folder, project, "fasta", "temp", "software", "SearchGUI-%s" % settings.searchgui_ver))
+    # clone searchgui into temp
+    clone_software("SearchGUI-%s" % settings.searchgui_ver, 
+                   os.path.join(temp_folder, "software"))
     
     run_command(["java", 
-                "-cp", os.path.join(settings.data_folder, project, "fasta", "temp", "software", "SearchGUI-%s" % settings.searchgui_ver, "SearchGUI-%s.jar" % settings.searchgui_ver), 
+                "-cp", os.path.join(temp_folder, "software", "SearchGUI-%s" % settings.searchgui_ver, "SearchGUI-%s.jar" % settings.searchgui_ver), 
                 "eu.isas.searchgui.cmd.FastaCLI",
                 "-in", "%s" % fasta_file,
                 "-decoy"
@@ -464,7 +566,7 @@ def generate_decoy(project, fasta_file):
 
     if os.path.exists(os.path.join(fasta_file_concat)):
         write_log("Finished generating decoy sequences.", "fasta", project)
-        shutil.rmtree(os.path.join(settings.data_folder, project, "fasta", "temp"))
+        shutil.rmtree(temp_folder)
         return True
     else:
         write_log("Failed to generate decoy sequences.", "fasta", project)
@@ -480,7 +582,7 @@ def download_profile_fasta(project):
         # sometimes need to use different url
         #pp_membership_url = "https://proteininformationresource.org/rps/data/new/PPSeqCurrent/PPMembership.txt"
         pp_membership_url = "https://ftp.uniprot.org/pub/databases/uniprot/current_release/knowledgebase/pan_proteomes/PPMembership.txt"
-        urllib.request.urlretrieve(pp_membership_url, os.path.join(settings.install_folder, "fasta", "PPMembership.txt"))
+        download_file(pp_membership_url, os.path.join(settings.install_folder, "fasta", "PPMembership.txt"))
             
     # download reference proteomes
     if os.path.exists(os.path.join(settings.install_folder, "fasta", "ref_proteomes_list.tsv")):
@@ -509,27 +611,20 @@ def download_profile_fasta(project):
      
     write_log("Generating list of proteomes to download.", "fasta", project)
 
-    member_proteomes = []
-    pan_proteomes = []
-    ref_proteomes_dl = []
+    member_proteomes = set()
+    pan_proteomes = set()
+    ref_proteomes_dl = set()
     
     write_log("Including all pan proteomes.", "fasta", project)
     # download pan proteomes first as we include all of them
     with open(os.path.join(settings.install_folder, "fasta", "PPMembership.txt"), 'r') as file:
-        i = 1
         result = csv.reader(file, delimiter='\t')
         next(result)
         for row in result:
-            # member hasn't been added yet
-            if row[1] not in member_proteomes:
-                member_proteomes.append(row[1])
-                
-            # pan proteome hasn't been added yet
-            if row[0] not in pan_proteomes:
-                pan_proteomes.append(row[0])
+            member_proteomes.add(row[1])
+            pan_proteomes.add(row[0])
     
     write_log("Checking for missing reference proteomes.", "fasta", project)
-    ref_count = 0
     # so now we download the pan proteomes but we need to make sure the reference proteomes
     # on uniprot are included as sometimes they won't be a member of a pan proteome if they are
     # the only member of a pan proteome
@@ -537,216 +632,313 @@ def download_profile_fasta(project):
         result = csv.reader(file, delimiter='\t')
         header = next(result)
         header = [x.lower() for x in header]
+        id_column = header.index('proteome id')
         for row in result:
             # so this reference is not a member of a pan proteome, so add it as a pan proteome
-            if row[header.index('proteome id')] not in member_proteomes:
-                ref_count += 1
-                member_proteomes.append(row[header.index('proteome id')])
-                ref_proteomes_dl.append(row[header.index('proteome id')])
+            if row[id_column] not in member_proteomes:
+                member_proteomes.add(row[id_column])
+                ref_proteomes_dl.add(row[id_column])
     
-    write_log("%s reference proteomes were not a member of a pan-proteome." % (ref_count), "fasta", project)
+    write_log("%s reference proteomes were not a member of a pan-proteome." % (len(ref_proteomes_dl)), "fasta", project)
     # human
-    ref_proteomes_dl.append("UP000005640")
+    ref_proteomes_dl.add("UP000005640")
         
     # download the pan proteomes
     # https://ftp.uniprot.org/pub/databases/uniprot/current_release/knowledgebase/pan_proteomes/UP000000212.fasta.gz
-    write_log("Downloading needed pan proteomes.", "fasta", project)
-    lenp = len(pan_proteomes)
-    i = 1
-    failed_proteomes = []
-    for proteome in pan_proteomes:
-        attempts = 10
-        for attempt in range(attempts):
-            try:
-                # if it already exists, don't download it again because uniprot is slow
-                # but there could be a problem if the filesize is wrong so might have to check that down the road
-                if not os.path.exists(os.path.join(settings.install_folder, "fasta", "pan", "%s.fasta.gz" % proteome)) and not os.path.exists(os.path.join(settings.install_folder, "fasta", "pan", "%s.fasta" % proteome)):
-                    write_log("Downloading %s pan-proteome of %s. (%s)" % (i, lenp, proteome), "fasta", project)
-                    # fix until uniprot is fixed
-                    #proteome_url = "https://proteininformationresource.org/rps/data/new/PPSeqCurrent/" + proteome + ".fasta.gz"
-                    proteome_url = "https://ftp.uniprot.org/pub/databases/uniprot/current_release/knowledgebase/pan_proteomes/" + proteome + ".fasta.gz"
-                    urllib.request.urlretrieve(proteome_url, os.path.join(settings.install_folder, "fasta", "pan", "%s.fasta.gz" % proteome))
-            except Exception as e:
-                if attempt == attempts - 1:
-                    write_log('Error downloading %s.' % (proteome), "fasta", project)
-                    failed_proteoms.append(proteome)
-            else:
-                break
-        i += 1
-    
     # now download the reference proteomes remaining
     # put this in another dir so that we know how to change the header later
     # https://www.uniprot.org/uniprot/?query=proteome:UP000027395&format=fasta&compress=yes
-    write_log("Downloading needed reference proteomes.", "fasta", project)
     if not os.path.exists(os.path.join(settings.install_folder, "fasta", "ref")):
         os.makedirs(os.path.join(settings.install_folder, "fasta", "ref"))
-    i = 1
-    lenp = len(ref_proteomes_dl)
-    for proteome in ref_proteomes_dl:
-        attempts = 10
-        for attempt in range(attempts):
+
+    downloads = {}
+    for proteome in sorted(pan_proteomes):
+        downloads[os.path.join("pan", "%s.fasta.gz" % proteome)] = PAN_PROTEOME_URL % proteome
+    for proteome in sorted(ref_proteomes_dl):
+        downloads[os.path.join("ref", "%s.fasta.gz" % proteome)] = REF_PROTEOME_URL % proteome
+    
+    write_log("Downloading needed pan and reference proteomes.", "fasta", project)
+    failed_proteomes = download_files(downloads, os.path.join(settings.install_folder, "fasta"), project)
+    
+    write_log("The following proteomes failed to download: %s" % (failed_proteomes), "fasta", project)
+
+def download_files(downloads, folder, project, threads=DOWNLOAD_THREADS):
+    ''' download {path: url} into folder in parallel, skipping files that 
+    were already downloaded. returns the paths that failed '''
+    manifest = load_manifest(folder)
+    
+    needed = {}
+    for path, url in downloads.items():
+        # an uncompressed copy means it was already downloaded and extracted
+        if os.path.exists(os.path.join(folder, path[:-3])):
+            continue
+        entry = manifest.get(path)
+        if (entry is not None and os.path.exists(os.path.join(folder, path)) 
+            and os.path.getsize(os.path.join(folder, path)) == entry['size']):
+            continue
+        needed[path] = url
+        
+    write_log("%s of %s files need to be downloaded." % (len(needed), len(downloads)), "fasta", project)
+    
+    failed = []
+    i = 0
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = {executor.submit(download_file, url, os.path.join(folder, path)): path 
+                   for path, url in needed.items()}
+        for future in as_completed(futures):
+            path = futures[future]
+            i += 1
             try:
-                if not os.path.exists(os.path.join(settings.install_folder, "fasta", "ref", "%s.fasta.gz" % proteome)) and not os.path.exists(os.path.join(settings.install_folder, "fasta", "ref", "%s.fasta" % proteome)):
-                    write_log("Downloading %s reference proteome of %s. (%s)" % (i, lenp, proteome), "fasta", project)
-                    proteome_url = "https://rest.uniprot.org/uniprotkb/stream?compressed=true&format=fasta&query=proteome:" + proteome
-                    #proteome_url = "https://www.uniprot.org/uniprot/?query=proteome:" + proteome + "&format=fasta&compress=yes"
-                    urllib.request.urlretrieve(proteome_url, os.path.join(settings.install_folder, "fasta", "ref", "%s.fasta.gz" % proteome))
+                entry = future.result()
             except Exception as e:
-                if attempt == attempts - 1:
-                    write_log('Error downloading %s.' % (proteome), "fasta", project)
-                    failed_proteoms.append(proteome)
-            else:
-                break
-        i += 1
+                write_log("Error downloading %s: %s" % (path, e), "fasta", project)
+                failed.append(path)
+                continue
+                
+            entry['url'] = needed[path]
+            manifest[path] = entry
+            write_log("Downloaded %s of %s. (%s)" % (i, len(needed), path), "fasta", project)
+            # save now and then so an interrupted download keeps most of its work
+            if i % 100 == 0:
+                save_manifest(folder, manifest)
+                
+    save_manifest(folder, manifest)
+    return sorted(failed)
+
+def download_file(url, path, attempts=10):
+    ''' download url to path, resuming a partial download if the server 
+    allows it. the file is only moved into place once it checks out. returns
+    the manifest entry for the file '''
+    partial = "%s.part" % path
+    for attempt in range(attempts):
+        try:
+            # a file already in place from before the manifest is kept if 
+            # it's intact
+            if os.path.exists(path):
+                entry = verify_download(path)
+                if entry is not None:
+                    return entry
+                os.remove(path)
+
+            offset = 0
+            headers = {}
+            if os.path.exists(partial):
+                offset = os.path.getsize(partial)
+                headers['Range'] = "bytes=%s-" % offset
+            
+            with session.get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+                # the partial file is already complete
+                if response.status_code == 416:
+                    expected = None
+                else:
+                    response.raise_for_status()
+                    # the server ignored the range so start over
+                    if response.status_code != 206:
+                        offset = 0
+                    expected = response.headers.get('Content-Length')
+                    with open(partial, 'ab' if offset > 0 else 'wb') as f:
+                        # keep the bytes as sent, like urlretrieve did
+                        for chunk in response.raw.stream(1024*1024, decode_content=False):
+                            f.write(chunk)
+                
+            if expected is not None and os.path.getsize(partial) != offset + int(expected):
+                raise IOError("Incomplete download: %s bytes of %s" % (os.path.getsize(partial), offset + int(expected)))
+                
+            entry = verify_download(partial)
+            if entry is None:
+                # start over rather than resuming a corrupt file
+                os.remove(partial)
+                raise IOError("Corrupt download")
+                
+            os.replace(partial, path)
+            return entry
+        except Exception:
+            if attempt == attempts - 1:
+                raise
+            time.sleep(min(60, 2**attempt))
+
+def verify_download(path):
+    ''' returns the size and sha256 of path or None if path is a gzip file 
+    that fails its crc or length check '''
+    if path.endswith(".gz") or path.endswith(".gz.part"):
+        try:
+            with gzip.open(path, 'rb') as f:
+                while f.read(1024*1024):
+                    pass
+        except (OSError, EOFError):
+            return None
     
-    write_log("The following proteomes failed to download: %s" % (failed_proteomes), "fasta", project)
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024*1024), b''):
+            sha256.update(chunk)
+    return {'size': os.path.getsize(path), 'sha256': sha256.hexdigest(), 
+            'date': time.strftime("%Y-%m-%d %H:%M:%S")}
+
+def load_manifest(folder):
+    ''' the manifest has the size, sha256, url and date of each file 
+    downloaded into folder '''
+    if os.path.exists(os.path.join(folder, DOWNLOAD_MANIFEST)):
+        with open(os.path.join(folder, DOWNLOAD_MANIFEST), 'r') as f:
+            return json.load(f)
+    return {}
+
+def save_manifest(folder, manifest):
+    with open(os.path.join(folder, "%s.tmp" % DOWNLOAD_MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(os.path.join(folder, "%s.tmp" % DOWNLOAD_MANIFEST), os.path.join(folder, DOWNLOAD_MANIFEST))
 
 # we can generate profile.fasta here too
 def create_full_fasta(project):
     ''' produces full.fasta with all sequences and no filtering'''
-    seq_count = 0
-
     write_log("Formatting FASTA files and filtering for high profile proteins.", "fasta", project)
     write_log("This can take a long time due to the need to reformat the reference proteomes to match the pan proteome format.", "fasta", project)
  
     if os.path.exists(os.path.join(settings.install_folder, "fasta", "human.fasta")):
         os.remove(os.path.join(settings.install_folder, "fasta", "human.fasta"))
     
-    if os.path.exists(os.path.join(settings.install_folder, "fasta", "ref", "temp.fasta")):
-        os.remove(os.path.join(settings.install_folder, "fasta", "ref", "temp.fasta"))
-    
     if os.path.exists(os.path.join(settings.install_folder, "fasta", "profile.fasta")):
         write_log("profile.fasta already exists. Delete to recreate.", "fasta", project)
         return
         
     accessions = set()
-
     proteomes = {}
-    # pan proteome files
-    # unzip pan, look for high profile, then delete unzipped
-    write_log("Extracting pan proteomes and filtering for high profile.", "fasta", project)
-    p = re.compile("^(?P<start>(?P<db>[^\|]+)\|(?P<accession>[^\|]+)\|(?P<middle>.+)\s)(?P<OS>OS=.+)\s(?P<OX>OX=.+)\s(?P<UPId>UPId=[^\s]+)\s(?P<PPId>PPId=[^\s]+)$")
-    for file in sorted(os.listdir(os.path.join(settings.install_folder, "fasta", "pan"))):
-        if file.endswith(".fasta.gz"):
-            filename = Path(file).stem
-            if os.path.exists(os.path.join(settings.install_folder, "fasta", "pan", filename)):
-                os.remove(os.path.join(settings.install_folder, "fasta", "pan", filename))
-            with gzip.open(os.path.join(settings.install_folder, "fasta", "pan", file), "rb") as f_in:
-                with open(os.path.join(settings.install_folder, "fasta", "pan", filename), "ab") as f_out:
-                    shutil.copyfileobj(f_in, f_out)
-                    
-            for record in SeqIO.parse(os.path.join(settings.install_folder, "fasta", "pan", filename), "fasta"):           
-                m1 = p.search(record.description)         
-                if not m1:
-                    continue
-                    
-                accession = m1.group('accession')
-                ppid = m1.group('PPId').replace('PPId=','')
-                species = m1.group('OS').replace('OS=','')
-                
-                if accession in accessions:
-                    continue
-                accessions.add(accession)
-
-                if ppid not in proteomes:
-                    proteomes[ppid] = {'OS':species, 'Full Size':1, 'Profile Size':0}
-                else:
-                    proteomes[ppid]['Full Size'] += 1
-
-                with open(os.path.join(settings.install_folder, "fasta", "pan", "temp.fasta"), "a") as fasta_out:
-                    SeqIO.write(record, fasta_out, "fasta")
-                        
-                m2 = re.search("ribosomal|elongation|chaperon", record.description)              
-                if not m2:
-                    continue
-                    
-                proteomes[ppid]['Profile Size'] += 1
-                
-                with open(os.path.join(settings.install_folder, "fasta", "profile.fasta"), "a") as fasta_out:
-                    SeqIO.write(record, fasta_out, "fasta")   
-                    
-            if os.path.exists(os.path.join(settings.install_folder, "fasta", "pan", filename)):
-                os.remove(os.path.join(settings.install_folder, "fasta", "pan", filename))
-
-            with open(os.path.join(settings.install_folder, "fasta", "pan", "temp.fasta"), "rb") as f_in:
-                with gzip.open(os.path.join(settings.install_folder, "fasta", "pan", "%s" % file), "wb") as f_out:
-                    shutil.copyfileobj(f_in, f_out) 
-            
-            if os.path.exists(os.path.join(settings.install_folder, "fasta", "pan", "temp.fasta")):
-                os.remove(os.path.join(settings.install_folder, "fasta", "pan", "temp.fasta"))
-                
-    # unzip ref, reformat header, look for high profile
-    # once done, zip them all
-    write_log("Extracting reference proteomes, reformatting, and filtering for high profile.", "fasta", project)
-    p = re.compile("^(?P<start>(?P<db>[^\|]+)\|(?P<accession>[^\|]+)\|(?P<middle>.+))\s(?P<OS>OS=.+)\s(?P<OX>OX=.+)")
-    for file in sorted(os.listdir(os.path.join(settings.install_folder, "fasta", "ref"))):
-        # exclude human
-        if file.endswith(".fasta.gz"):
-            filename = Path(file).stem
-            if os.path.exists(os.path.join(settings.install_folder, "fasta", "ref", filename)):
-                os.remove(os.path.join(settings.install_folder, "fasta", "ref", filename))
-            with gzip.open(os.path.join(settings.install_folder, "fasta", "ref", file), "rb") as f_in:
-                with open(os.path.join(settings.install_folder, "fasta", "ref", filename), "ab") as f_out:
-                    shutil.copyfileobj(f_in, f_out)
+    
+    # pan proteomes first, then the reference proteomes. the order matters
+    # since an accession is only kept in the first proteome it's found in
+    files = []
+    for kind in ["pan", "ref"]:
+        folder = os.path.join(settings.install_folder, "fasta", kind)
+        files.extend([(folder, file) for file in sorted(os.listdir(folder)) if file.endswith(".fasta.gz")])
+    
+    if settings.threads == -1:
+        threads = multiprocessing.cpu_count()
+    else:
+        threads = settings.threads
+        
+    # the proteomes are reformatted in parallel and merged in order. only a
+    # few are queued ahead so the results don't pile up in memory
+    write_log("Extracting and reformatting %s proteomes and filtering for high profile." % len(files), "fasta", project)
+    profile_temp = os.path.join(settings.install_folder, "fasta", "profile.fasta.tmp")
+    with ProcessPoolExecutor(max_workers=threads) as executor, open(profile_temp, "w") as profile_out:
+        futures = deque()
+        for folder, file in files:
+            futures.append((folder, file, executor.submit(format_proteome, folder, file)))
+            if len(futures) > 2 * threads:
+                folder, file, future = futures.popleft()
+                merge_proteome(folder, file, future.result(), accessions, proteomes, profile_out)
+        while len(futures) > 0:
+            folder, file, future = futures.popleft()
+            merge_proteome(folder, file, future.result(), accessions, proteomes, profile_out)
+    os.replace(profile_temp, os.path.join(settings.install_folder, "fasta", "profile.fasta"))
                 
-            for record in SeqIO.parse(os.path.join(settings.install_folder, "fasta", "ref", filename), "fasta"):
-                m1 = p.search(record.description)
+    proteome_df = pd.DataFrame.from_dict(proteomes, orient='index').reset_index(names=['PPID'])
+    proteome_df.to_csv(os.path.join(settings.install_folder, "fasta", "proteomes.tsv"), sep='\t', index=False)
+    
+    write_log("Finished generating profile.fasta", "fasta", project)
+
+def format_proteome(folder, file):
+    ''' reformat a downloaded proteome in one pass. the reformatted proteome
+    is written to <file>.tmp, uncompressed for human, and its profile 
+    proteins to <file>.profile. returns the accession, ppid, species and 
+    whether it's a profile protein for each record '''
+    # reference proteomes get the same UPId and PPId as pan proteomes, the
+    # proteome itself
+    reference = os.path.basename(folder) == "ref"
+    human = reference and file == HUMAN_PROTEOME
+    proteome = Path(Path(file).stem).stem
+    
+    records = []
+    if human:
+        f_out = open(os.path.join(folder, "%s.tmp" % file), "w")
+    else:
+        f_out = gzip.open(os.path.join(folder, "%s.tmp" % file), "wt", compresslevel=GZIP_LEVEL)
+    with gzip.open(os.path.join(folder, file), "rt") as f_in, f_out, open(os.path.join(folder, "%s.profile" % file), "w") as f_profile:
+        for title, sequence in SimpleFastaParser(f_in):
+            if reference:
+                m1 = REF_HEADER.search(title)
                 if not m1:
                     continue
-
-                accession = m1.group('accession')
-                ppid = Path(filename).stem
-                species = m1.group('OS').replace('OS=','')                    
-
+                ppid = proteome
                 # account for the case where we already ran this on the reference proteomes before
                 # we don't want to add part again because it'll already be in m1.group('OX')
-                if 'UPId' in record.description or 'PPId' in m1.group('OX'):
-                    description = m1.group('start') + " " + m1.group('OS') + " " + m1.group('OX')
-                else:
-                    description = m1.group('start') + " " + m1.group('OS') + " " + m1.group('OX') + " " + "UPId=" + Path(filename).stem + " " + "PPId=" + Path(filename).stem
-                    
-                # now write the new fasta header + sequence to a file
-                record.description = description
-                    
-                if file != "UP000005640.fasta.gz":
-                    if accession in accessions:
-                        continue
-                        
-                    accessions.add(accession)      
-                    
-                    if ppid not in proteomes:
-                        proteomes[ppid] = {'OS':species, 'Full Size':1, 'Profile Size':0}
-                    else:
-                        proteomes[ppid]['Full Size'] += 1
-
-                    with open(os.path.join(settings.install_folder, "fasta", "ref", "temp.fasta"), "a") as fasta_out:
-                        SeqIO.write(record, fasta_out, "fasta")
-                        
-                    m2 = re.search("ribosomal|elongation|chaperon", record.description)
-                    if not m2:
-                        continue
-                        
-                    proteomes[ppid]['Profile Size'] += 1
-                    
-                    with open(os.path.join(settings.install_folder, "fasta", "profile.fasta"), "a") as fasta_out:
-                        SeqIO.write(record, fasta_out, "fasta")
-                                            
-                # write human to a different file so we can access it easily later
+                if 'UPId' in title or 'PPId' in m1.group('OX'):
+                    title = m1.group('start') + " " + m1.group('OS') + " " + m1.group('OX')
                 else:
-                    with open(os.path.join(settings.install_folder, "fasta", "human.fasta"), "a") as fasta_out:
-                        SeqIO.write(record, fasta_out, "fasta")
-                       
-            if os.path.exists(os.path.join(settings.install_folder, "fasta", "ref", filename)):
-                os.remove(os.path.join(settings.install_folder, "fasta", "ref", filename))
-            
-            if os.path.exists(os.path.join(settings.install_folder, "fasta", "ref", "temp.fasta")):
-                with open(os.path.join(settings.install_folder, "fasta", "ref", "temp.fasta"), "rb") as f_in:
-                    with gzip.open(os.path.join(settings.install_folder, "fasta", "ref", "%s" % file), "wb") as f_out:
-                        shutil.copyfileobj(f_in, f_out)            
- 
-                os.remove(os.path.join(settings.install_folder, "fasta", "ref", "temp.fasta"))
+                    title = m1.group('start') + " " + m1.group('OS') + " " + m1.group('OX') + " " + "UPId=" + proteome + " " + "PPId=" + proteome
+            else:
+                m1 = PAN_HEADER.search(title)
+                if not m1:
+                    continue
+                ppid = m1.group('PPId').replace('PPId=','')
                 
-    proteome_df = pd.DataFrame.from_dict(proteomes, orient='index').reset_index(names=['PPID'])
-    proteome_df.to_csv(os.path.join(settings.install_folder, "fasta", "proteomes.tsv"), sep='\t', index=False)
+            profile = PROFILE_PROTEINS.search(title) is not None
+            write_fasta_record(f_out, title, sequence)
+            if profile and not human:
+                write_fasta_record(f_profile, title, sequence)
+            records.append((m1.group('accession'), ppid, m1.group('OS').replace('OS=',''), profile))
+    return records
+
+def merge_proteome(folder, file, records, accessions, proteomes, profile_out):
+    ''' keep the records of a reformatted proteome whose accession hasn't been
+    seen yet, count them and add the profile proteins to profile_out '''
+    temp = os.path.join(folder, "%s.tmp" % file)
+    profile_temp = os.path.join(folder, "%s.profile" % file)
+    
+    # write human to a different file so we can access it easily later
+    if os.path.basename(folder) == "ref" and file == HUMAN_PROTEOME:
+        with open(temp, "r") as f_in:
+            with open(os.path.join(settings.install_folder, "fasta", "human.fasta"), "a") as f_out:
+                shutil.copyfileobj(f_in, f_out)
+        os.remove(temp)
+        os.remove(profile_temp)
+        return
+    
+    keep = []
+    for accession, ppid, species, profile in records:
+        if accession in accessions:
+            keep.append(False)
+            continue
+        accessions.add(accession)
+        keep.append(True)
+        
+        if ppid not in proteomes:
+            proteomes[ppid] = {'OS':species, 'Full Size':1, 'Profile Size':0}
+        else:
+            proteomes[ppid]['Full Size'] += 1
+        if profile:
+            proteomes[ppid]['Profile Size'] += 1
+            
+    # nothing new, so the proteome is left as it was
+    if not any(keep):
+        os.remove(temp)
+        os.remove(profile_temp)
+        return
     
-    write_log("Finished generating profile.fasta", "fasta", project)
\ No newline at end of file
+    # duplicates are rare so the proteome is only filtered again if there
+    # are any
+    if all(keep):
+        with open(profile_temp, "r") as f_in:
+            shutil.copyfileobj(f_in, profile_out)
+        os.remove(profile_temp)
+        os.replace(temp, os.path.join(folder, file))
+        return
+        
+    with gzip.open(temp, "rt") as f_in:
+        with gzip.open(os.path.join(folder, "%s.tmp2" % file), "wt", compresslevel=GZIP_LEVEL) as f_out:
+            for (title, sequence), kept in zip(SimpleFastaParser(f_in), keep):
+                if not kept:
+                    continue
+                write_fasta_record(f_out, title, sequence)
+                if PROFILE_PROTEINS.search(title):
+                    write_fasta_record(profile_out, title, sequence)
+    os.remove(temp)
+    os.remove(profile_temp)
+    os.replace(os.path.join(folder, "%s.tmp2" % file), os.path.join(folder, file))
+
+def write_fasta_record(f, title, sequence):
+    ''' write a record the way SeqIO does, with 60 residues per line '''
+    f.write(">%s\n" % title)
+    if sequence:
+        f.write("\n".join([sequence[i:i+60] for i in range(0, len(sequence), 60)]))
+        f.write("\n")
\ No newline at end of file
@@ -2,11 +2,17 @@
 # this can be done optionally to speed up profiling
 # proteins aren't loaded by project so this is particularly useful if one is
 # running many projects or many files in a single install
+#
+# --native writes the proteins to a TSV and hands it to the database's own
+# bulk import (LOAD DATA LOCAL INFILE on MySQL, COPY on PostgreSQL) instead of
+# going through bulk_create. MySQL needs local_infile enabled on the server.
+# the client side is only enabled on a connection opened for the load
 
 import os
+import time
 import argparse
-import regex as re
-from Bio import SeqIO
+
+from django.db import connection, transaction
 
 from results.models import (
     FastaProtein,
@@ -14,74 +20,261 @@ from results.models import (
 )
 
 from .run_command import write_debug, settings
+from .fasta_headers import read_fasta
+from .load_proteomes import create_fastaproteins
+
+# columns written to the TSV, in order
+NATIVE_COLUMNS = ['accession', 'description', 'gene', 'ppid_id', 'length']
 
 def run(*args):
     parser = argparse.ArgumentParser()
     parser.add_argument('fasta_type', choices=['profile', 'full'])  
+    parser.add_argument('--native', action='store_true',
+        help='load through the database bulk import instead of bulk_create')
+    parser.add_argument('--benchmark', type=int, default=0,
+        help='time setting the proteome of this many proteins instead of loading them')
     args2 = parser.parse_args(args)
     
     fasta_type = args2.fasta_type
 
-    load_fastaproteins(fasta_type)
+    if args2.benchmark > 0:
+        benchmark(os.path.join(settings.install_folder, "fasta", "%s.fasta" % fasta_type),
+                  args2.benchmark)
+        return
+
+    load_fastaproteins(fasta_type, args2.native)
 
-def load_fastaproteins(fasta_type): 
+def load_fastaproteins(fasta_type, native=False): 
     print("Loading %s proteins into the database. This may take a while." % (fasta_type))
+    
+    proteomes = set(Proteome.objects.values_list('proteome', flat=True))
    
     def load_proteins(fasta):
-        proteins_to_add = []
-        p1 = re.compile(">?[^|]+\|(?P<accession>[^|]+)\|(?P<description>.+)\sOS=(?P<os>.+)\sOX=(?P<ox>[^\s]+)\s(GN=(?P<gn>[^\s]+)\s)?.+UPId=(?P<upid>[^\s]+)\sPPId=(?P<ppid>.+)$")
-        p2 = re.compile(">?[^|]+\|(?P<accession>[^|]+)\|?$")
+        # both ways skip proteins that are already loaded, so what was added
+        # is counted the same way for both
+        count = FastaProtein.objects.count()
+        start = time.time()
+        if native == True:
+            attempted, missing = native_load(fasta, proteomes)
+        else:
+            attempted, missing = create_fastaproteins(read_fasta(fasta), proteomes)
+        elapsed = time.time() - start
+        added = FastaProtein.objects.count() - count
+        print("Processed %s proteins in %.1f s (%.0f proteins/s)." 
+              % (attempted, elapsed, attempted / max(elapsed, 1e-9)))
+        print("Added %s proteins, %s were already loaded." % (added, attempted - added))
+        if missing > 0:
+            print("Skipped %s proteins from proteomes that aren't loaded. Run load_proteomes first." 
+                  % (missing))
+    
+    def load_all():
+        print("Loading bacterial proteins.")
+        if fasta_type == 'profile':
+            load_proteins(os.path.join(settings.install_folder, "fasta", "profile.fasta"))
+        elif fasta_type == 'full':
+            load_proteins(os.path.join(settings.install_folder, "fasta", "full.fasta"))
+        
+        print("Loading CRAP proteins.")
+        load_proteins(os.path.join(settings.install_folder, "fasta", "crap.fasta"))
+        
+        print("Loading human proteins.")
+        load_proteins(os.path.join(settings.install_folder, "fasta", "human.fasta"))
     
-        for record in SeqIO.parse(fasta, "fasta"):
-            m1 = p1.search(record.description)
-            m2 = p2.search(record.description)
-            if m1:
-                # reverses are effectively a duplicate
-                if "_REVERSED" in m1.group('accession'):
-                    continue            
-                accession = m1.group('accession')
-                description = m1.group('description')
-                if m1.group('gn'):
-                    gene = m1.group('gn')
-                else:
-                    gene = "unknown"
-                upid = m1.group('upid')
-                ppid_m = Proteome.objects.get(proteome=m1.group('ppid'))
-            elif m2:
-                if "_REVERSED" in m2.group('accession'):
-                    continue            
-                accession = m2.group('accession')
-                description = "CRAP"
-                upid = "0"
-                gene = "CRAP"
-                ppid_m = Proteome.objects.get(proteome=0)
+    if native == True:
+        # the indexes are dropped once around all three loads rather than
+        # rebuilt after each one
+        indexes = disable_indexes()
+        try:
+            load_all()
+        finally:
+            print("Rebuilding indexes.")
+            enable_indexes(indexes)
+    else:
+        load_all()
+
+def tsv_field(value):
+    ''' escape a value for LOAD DATA and COPY, which both use backslash 
+    escapes by default '''
+    return (str(value).replace("\\", "\\\\")
+                      .replace("\t", "\\t")
+                      .replace("\n", "\\n")
+                      .replace("\r", "\\r"))
+
+def write_tsv(fasta, tsv, proteomes):
+    ''' write the proteins of fasta with a loaded proteome to tsv. returns
+    the number written and the number skipped '''
+    written = 0
+    missing = 0
+    with open(tsv, 'w', encoding='utf-8', newline='\n') as f:
+        for record in read_fasta(fasta):
+            if record.ppid not in proteomes:
+                missing += 1
+                continue
+            f.write("\t".join([tsv_field(record.accession),
+                               tsv_field(record.description),
+                               tsv_field(record.gene),
+                               tsv_field(record.ppid),
+                               str(record.length)]) + "\n")
+            written += 1
+    return written, missing
+
+def native_load(fasta, proteomes):
+    ''' load the proteins of fasta through the database bulk import. returns
+    the number of proteins loaded, including ones that were already in the
+    database, and the number skipped, like create_fastaproteins '''
+    temp_folder = os.path.join(settings.install_folder, "temp")
+    os.makedirs(temp_folder, exist_ok=True)
+    tsv = os.path.join(temp_folder, "%s.%s.tsv" % (os.path.basename(fasta), os.getpid()))
+
+    try:
+        written, missing = write_tsv(fasta, tsv, proteomes)
+        if connection.vendor == 'mysql':
+            mysql_load(tsv)
+        elif connection.vendor == 'postgresql':
+            postgresql_load(tsv)
+        else:
+            executemany_load(tsv)
+    finally:
+        if os.path.exists(tsv):
+            os.remove(tsv)
+
+    return written, missing
+
+def mysql_load(tsv):
+    ''' LOAD DATA LOCAL INFILE lets the server ask the client for any file it
+    can read, so it's only enabled on a connection opened for the load '''
+    table = connection.ops.quote_name(FastaProtein._meta.db_table)
+    columns = ", ".join(connection.ops.quote_name(c) for c in NATIVE_COLUMNS)
+    params = connection.get_connection_params()
+    params['local_infile'] = 1
+    conn = connection.get_new_connection(params)
+    try:
+        cursor = conn.cursor()
+        # the ppids have been checked against the loaded proteomes already
+        cursor.execute("SET foreign_key_checks = 0")
+        cursor.execute("SET unique_checks = 0")
+        # IGNORE skips accessions that are already loaded, like 
+        # ignore_conflicts does for bulk_create. the default field and line
+        # terminators and escape character match write_tsv
+        cursor.execute("LOAD DATA LOCAL INFILE %%s IGNORE INTO TABLE %s CHARACTER SET utf8mb4 (%s)" 
+                       % (table, columns), [tsv])
+        conn.commit()
+    finally:
+        conn.close()
+
+def postgresql_load(tsv):
+    table = connection.ops.quote_name(FastaProtein._meta.db_table)
+    columns = ", ".join(connection.ops.quote_name(c) for c in NATIVE_COLUMNS)
+    with transaction.atomic(), connection.cursor() as cursor:
+        # COPY can't skip conflicts so it goes into a staging table first
+        cursor.execute("CREATE TEMPORARY TABLE fastaprotein_load (LIKE %s INCLUDING DEFAULTS) ON COMMIT DROP" 
+                       % (table))
+        copy = "COPY fastaprotein_load (%s) FROM STDIN" % (columns)
+        raw = cursor.cursor
+        with open(tsv, 'r', encoding='utf-8') as f:
+            if hasattr(raw, 'copy_expert'):
+                # psycopg2
+                raw.copy_expert(copy, f)
             else:
-                print("no regexp match for: %s" % record)
-                
-            fastaprotein = FastaProtein(accession = accession,
-                                        description = description,
-                                        gene = gene,
-                                        ppid = ppid_m,
-                                        length = len(record.seq)
-                                    )
-                                    
-            proteins_to_add.append(fastaprotein)
-            if len(proteins_to_add) > 5000:
-                FastaProtein.objects.bulk_create(proteins_to_add, 
-                                                ignore_conflicts=True
-                                                )
-                proteins_to_add = []
-           
-        FastaProtein.objects.bulk_create(proteins_to_add, ignore_conflicts=True)
+                # psycopg 3
+                with raw.copy(copy) as c:
+                    for chunk in iter(lambda: f.read(1024*1024), ''):
+                        c.write(chunk)
+        cursor.execute("INSERT INTO %s (%s) SELECT DISTINCT ON (accession) %s FROM fastaprotein_load ON CONFLICT DO NOTHING" 
+                       % (table, columns, columns))
+
+def executemany_load(tsv, batch_size=50000):
+    ''' the fallback for other databases, mainly sqlite '''
+    table = connection.ops.quote_name(FastaProtein._meta.db_table)
+    columns = ", ".join(connection.ops.quote_name(c) for c in NATIVE_COLUMNS)
+    if connection.vendor == 'sqlite':
+        query = "INSERT OR IGNORE INTO %s (%s) VALUES (%%s, %%s, %%s, %%s, %%s)" % (table, columns)
+    else:
+        query = "INSERT INTO %s (%s) VALUES (%%s, %%s, %%s, %%s, %%s) ON CONFLICT DO NOTHING" % (table, columns)
+
+    def unescape(value):
+        return (value.replace("\\\\", "\0").replace("\\t", "\t")
+                     .replace("\\n", "\n").replace("\\r", "\r").replace("\0", "\\"))
+
+    rows = []
+    with transaction.atomic(), connection.cursor() as cursor:
+        with open(tsv, 'r', encoding='utf-8', newline='\n') as f:
+            for line in f:
+                fields = [unescape(v) for v in line.rstrip("\n").split("\t")]
+                fields[4] = int(fields[4])
+                rows.append(fields)
+                if len(rows) >= batch_size:
+                    cursor.executemany(query, rows)
+                    rows = []
+        if len(rows) > 0:
+            cursor.executemany(query, rows)
+
+def disable_indexes():
+    ''' turn off the checks and secondary indexes of the FastaProtein table
+    for a native load. returns what enable_indexes needs to undo it '''
+    table = FastaProtein._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'mysql':
+            # the checks are turned off on the load connection in mysql_load.
+            # this only does something for MyISAM tables
+            cursor.execute("ALTER TABLE %s DISABLE KEYS" % connection.ops.quote_name(table))
+            return []
+        elif connection.vendor == 'postgresql':
+            # indexes that back a constraint (the primary key) have to stay
+            cursor.execute('''SELECT indexname, indexdef FROM pg_indexes 
+                WHERE tablename = %s AND schemaname = current_schema() 
+                AND indexname NOT IN (SELECT conname FROM pg_constraint)''', [table])
+            indexes = cursor.fetchall()
+        elif connection.vendor == 'sqlite':
+            # automatic indexes have no sql and can't be dropped
+            cursor.execute('''SELECT name, sql FROM sqlite_master 
+                WHERE type = 'index' AND tbl_name = %s AND sql IS NOT NULL''', [table])
+            indexes = cursor.fetchall()
+        else:
+            return []
+
+        for name, sql in indexes:
+            cursor.execute("DROP INDEX %s" % connection.ops.quote_name(name))
+    return indexes
+
+def enable_indexes(indexes):
+    with connection.cursor() as cursor:
+        if connection.vendor == 'mysql':
+            cursor.execute("ALTER TABLE %s ENABLE KEYS" 
+                           % connection.ops.quote_name(FastaProtein._meta.db_table))
+        for name, sql in indexes:
+            cursor.execute(sql)
+
+def benchmark(fasta, count):
+    ''' compare fetching the Proteome of each protein against setting ppid_id
+    from the preloaded proteome ids, for the first count proteins of fasta.
+    nothing is saved '''
+    records = []
+    for record in read_fasta(fasta):
+        records.append(record)
+        if len(records) >= count:
+            break
     
-    print("Loading bacterial proteins.")
-    if fasta_type == 'profile':
-        load_proteins(os.path.join(settings.install_folder, "fasta", "profile.fasta"))
-    elif fasta_type == 'full':
-        load_proteins(os.path.join(settings.install_folder, "fasta", "full.fasta"))
+    start = time.time()
+    for record in records:
+        FastaProtein(accession = record.accession,
+                     description = record.description,
+                     gene = record.gene,
+                     ppid = Proteome.objects.get(proteome=record.ppid),
+                     length = record.length)
+    get_time = time.time() - start
     
-    print("Loading CRAP proteins.")
-    load_proteins(os.path.join(settings.install_folder, "fasta", "crap.fasta"))
+    start = time.time()
+    proteomes = set(Proteome.objects.values_list('proteome', flat=True))
+    for record in records:
+        if record.ppid in proteomes:
+            FastaProtein(accession = record.accession,
+                         description = record.description,
+                         gene = record.gene,
+                         ppid_id = record.ppid,
+                         length = record.length)
+    cache_time = time.time() - start
     
-    print("Loading human proteins.")
-    load_proteins(os.path.join(settings.install_folder, "fasta", "human.fasta"))
\ No newline at end of file
+    print("%s proteins" % len(records))
+    print("Proteome.objects.get: %.2f s (%.0f proteins/s)" % (get_time, len(records) / max(get_time, 1e-9)))
+    print("preloaded ids: %.2f s (%.0f proteins/s)" % (cache_time, len(records) / max(cache_time, 1e-9)))
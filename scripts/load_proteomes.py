@@ -2,12 +2,11 @@ from projects.models import Queue, Project, Setting
 from results.models import Proteome, FastaProtein
 
 from .run_command import write_debug, settings
+from .fasta_index import lookup
 
 import os
 import urllib.request
 import csv
-import regex as re
-from Bio import SeqIO
 import argparse
 import pandas as pd
 
@@ -60,29 +59,59 @@ def load_proteomes():
     Proteome.objects.bulk_create(proteomes_to_add, ignore_conflicts=True)
     
     print("Finished loading proteomes.")
+
+def create_fastaproteins(records, proteomes=None, batch_size=5000):
+    ''' bulk_create a FastaProtein for each FastaRecord in records, which may
+    be a generator. returns the number of proteins passed to bulk_create,
+    including ones that were already loaded, and the number skipped because
+    their proteome isn't loaded '''
+    # ppid_id is set from the parsed id rather than fetching the Proteome for
+    # every protein, so it's checked against the loaded proteomes instead
+    if proteomes is None:
+        proteomes = set(Proteome.objects.values_list('proteome', flat=True))
+    
+    added = 0
+    missing = 0
+    proteins_to_add = []
+    for record in records:
+        if record.ppid not in proteomes:
+            missing += 1
+            continue
+        
+        fastaprotein = FastaProtein(accession = record.accession,
+                                    description = record.description,
+                                    gene = record.gene,
+                                    ppid_id = record.ppid,
+                                    length = record.length
+                                   )
+                                   
+        proteins_to_add.append(fastaprotein)
+        if len(proteins_to_add) >= batch_size:
+            FastaProtein.objects.bulk_create(proteins_to_add, 
+                                            ignore_conflicts=True
+                                            )
+            added += len(proteins_to_add)
+            proteins_to_add = []
+            
+    FastaProtein.objects.bulk_create(proteins_to_add, ignore_conflicts=True)
+    added += len(proteins_to_add)
+    
+    return added, missing
     
 def load_proteins(project_name, job, fasta, accession_list):
     ''' load the proteins into the database so their info can be accessed '''
-    # this is kind of slow because it needs to crawl through a FASTA file
-    # an option may be to check to see if the proteins are already loaded so we
-    # can skip this step. all we need to do is look for 1 protein that isn't
-    # loaded
-    
-    # other ideas
-    # trim accession list to only be ones that are loaded
-    # pop accession list as we load them and if it's empty, we're done
+    # the proteins are looked up in an index of the FASTA (see fasta_index)
+    # that is built the first time it's needed, so only the first file
+    # searched against a FASTA pays for parsing it
     
     write_debug("Loading FASTA proteins into database (this may take some time).", 
         job, project_name)
     
     # check for existing proteins because we can save some time sometimes
     # even though this step is time consuming
-    fp = list(FastaProtein.objects.filter(accession__in=accession_list).values_list('accession', flat=True))
-    
-    accessions_needed = []
-    for accession in accession_list:
-        if accession not in fp:
-            accessions_needed.append(accession)
+    accessions_needed = set(accession_list)
+    fp = FastaProtein.objects.filter(accession__in=accessions_needed).values_list('accession', flat=True)
+    accessions_needed.difference_update(fp)
     
     write_debug("%s proteins need to be added." % (len(accessions_needed)), job, project_name)
     
@@ -90,60 +119,19 @@ def load_proteins(project_name, job, fasta, accession_list):
         if len(accessions_needed) == 0:
             write_debug("Finished loading proteins.", job, project_name)
             return
+        
+        records, built = lookup(fasta, accessions_needed)
+        if built == True:
+            write_debug("Built protein index for %s." % (fasta), job, project_name)
             
-        proteins_to_add = []
-        p1 = re.compile(">?[^|]+\|(?P<accession>[^|]+)\|(?P<description>.+)\sOS=(?P<os>.+)\sOX=(?P<ox>[^\s]+)\s(GN=(?P<gn>[^\s]+)\s)?.+UPId=(?P<upid>[^\s]+)\sPPId=(?P<ppid>.+)$")
-        p2 = re.compile(">?[^|]+\|(?P<accession>[^|]+)\|?$")
- 
-        for record in SeqIO.parse(fasta, "fasta"):
-            m1 = p1.search(record.description)
-            m2 = p2.search(record.description)
-            if m1:
-                # reverses are effectively a duplicate
-                if "_REVERSED" in m1.group('accession'):
-                    continue            
-                accession = m1.group('accession')
-                description = m1.group('description')
-                if m1.group('gn'):
-                    gene = m1.group('gn')
-                else:
-                    gene = "unknown"
-                upid = m1.group('upid')
-                ppid_m = Proteome.objects.get(proteome=m1.group('ppid'))
-            elif m2:
-                if "_REVERSED" in m2.group('accession'):
-                    continue            
-                accession = m2.group('accession')
-                description = "CRAP"
-                upid = "0"
-                gene = "CRAP"
-                ppid_m = Proteome.objects.get(proteome=0)
-            else:
-                print("no regexp match for: %s" % record)
-                
-            if accession not in accessions_needed:
-                continue 
-       
-            fastaprotein = FastaProtein(accession = accession,
-                                        description = description,
-                                        gene = gene,
-                                        ppid = ppid_m,
-                                        length = len(record.seq)
-                                       )
-                                   
-            proteins_to_add.append(fastaprotein)
-            if len(proteins_to_add) > 5000:
-                FastaProtein.objects.bulk_create(proteins_to_add, 
-                                                ignore_conflicts=True
-                                                )
-                proteins_to_add = []
-            
-            accessions_needed.remove(accession)
-            
-            if len(accessions_needed) == 0:
-                break
-                
-        FastaProtein.objects.bulk_create(proteins_to_add, ignore_conflicts=True)
+        added, missing = create_fastaproteins(records)
+        if missing > 0:
+            write_debug("%s proteins belong to proteomes that aren't loaded." % (missing),
+                job, project_name)
+        
+        if len(records) < len(accessions_needed):
+            write_debug("%s proteins were not found in %s." % (len(accessions_needed) - len(records), fasta),
+                job, project_name)
     except Exception as e:
         write_debug("Error loading proteins: %s" % (e), job, project_name)
     else:                
@@ -0,0 +1,442 @@
+# a NumPy/SciPy version of the R part of analyze_results: median
+# normalization, PEMM imputation (phi=0) and a limma moderated t-test with the
+# DEqMS PSM count variance prior. it takes the same peptides_initial table and
+# writes peptides_final, proteins_final and DEqMS tables with the same layout
+# as the R version without R. the PEMM penalty isn't PEMM_fun's default yet
+# and the loess fit isn't R's code, so the numbers don't match R's. it isn't
+# offered as a SearchSetting.analysis_engine until PemmDeqmsTest in
+# scripts/tests.py passes against the R tables in testdata/pemm_deqms. until
+# then it's only run by analyze_results --python and the comparison below
+#
+# python3 manage.py runscript pemm_deqms --script-args <project>
+# runs this on the project's <project>_peptides_initial.tsv and compares the
+# results against the tables the R version wrote to the results folder
+
+import os
+import argparse
+import warnings
+
+import numpy as np
+import pandas as pd
+import regex as re
+from scipy import special, stats
+
+# the protein information columns of the peptide tables
+INFO_COLUMNS = ['sequence', 'accession', 'gene', 'description', 'ppid', 'organism']
+
+def run(*args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('project_name', type=str)
+    args2 = parser.parse_args(args)
+
+    compare_with_r(args2.project_name)
+
+def grep(pattern, columns, ignore_case=False):
+    ''' the columns R's grep would select '''
+    flags = re.IGNORECASE if ignore_case else 0
+    return [column for column in columns if re.search(pattern, str(column), flags)]
+
+def median_normalize(dat):
+    ''' subtract the median of each column, i.e. sweep(dat, 2, colMedians(dat)) '''
+    return dat - dat.median(axis=0, skipna=True)
+
+def pemm(X, lam=None, K=5, tol=1e-4, max_iter=100):
+    ''' penalized EM estimate of the mean and covariance of the columns of X
+    with missing values (NaN), as PEMM_fun(X, phi=0). returns mu, Sigma and
+    Xhat, which is X with missing values replaced by their conditional means.
+    rows with the same missing columns are imputed together '''
+    X = np.asarray(X, dtype=float)
+    n, p = X.shape
+    missing = np.isnan(X)
+
+    mu = np.nanmean(X, axis=0)
+    Xhat = np.where(missing, mu, X)
+    Sigma = np.cov(Xhat, rowvar=False).reshape(p, p)
+    if lam is None:
+        # shrink towards the average variance. this is a stand in for
+        # PEMM_fun's default penalty, which has to be ported before this can
+        # match R
+        lam = K * np.mean(np.diag(Sigma))
+
+    patterns, pattern_rows = np.unique(missing, axis=0, return_inverse=True)
+    pattern_rows = pattern_rows.reshape(-1)
+    groups = [(pattern, np.flatnonzero(pattern_rows == i))
+              for i, pattern in enumerate(patterns) if pattern.any()]
+
+    for iteration in range(max_iter):
+        C = np.zeros((p, p))
+        for pattern, rows in groups:
+            m = pattern
+            o = ~pattern
+            if not o.any():
+                Xhat[np.ix_(rows, m)] = mu
+                C += len(rows) * Sigma
+                continue
+            S_oo = Sigma[np.ix_(o, o)]
+            S_mo = Sigma[np.ix_(m, o)]
+            B = np.linalg.solve(S_oo, S_mo.T).T
+            Xhat[np.ix_(rows, m)] = mu[m] + (X[np.ix_(rows, o)] - mu[o]) @ B.T
+            C[np.ix_(m, m)] += len(rows) * (Sigma[np.ix_(m, m)] - B @ S_mo.T)
+
+        mu_new = Xhat.mean(axis=0)
+        D = Xhat - mu_new
+        Sigma_new = (D.T @ D + C + lam * np.eye(p)) / (n + K)
+
+        converged = (np.max(np.abs(mu_new - mu)) < tol
+                     and np.max(np.abs(Sigma_new - Sigma)) < tol)
+        mu = mu_new
+        Sigma = Sigma_new
+        if converged:
+            break
+
+    return mu, Sigma, Xhat
+
+def p_adjust_bh(p):
+    ''' p.adjust(p, method="BH"), ignoring NaN '''
+    p = np.asarray(p, dtype=float)
+    adjusted = np.full(p.shape, np.nan)
+    ok = ~np.isnan(p)
+    n = ok.sum()
+    if n == 0:
+        return adjusted
+    order = np.argsort(-p[ok], kind='stable')
+    ranks = np.arange(n, 0, -1)
+    values = np.minimum.accumulate(n / ranks * p[ok][order])
+    result = np.empty(n)
+    result[order] = np.minimum(1, values)
+    adjusted[ok] = result
+    return adjusted
+
+def trigamma_inverse(x):
+    ''' limma's trigammaInverse, Newton's method on 1/trigamma '''
+    x = np.atleast_1d(np.asarray(x, dtype=float))
+    y = 0.5 + 1 / x
+    for iteration in range(50):
+        tri = special.polygamma(1, y)
+        dif = tri * (1 - tri / x) / special.polygamma(2, y)
+        y = y + dif
+        if np.max(-dif / y) < 1e-8:
+            break
+    y = np.where(x > 1e7, 1 / np.sqrt(x), y)
+    y = np.where(x < 1e-6, 1 / x, y)
+    return y
+
+def fit_f_dist(x, df1):
+    ''' limma's fitFDist without a covariate. returns the prior variance
+    (scale) and prior degrees of freedom (df2) '''
+    ok = np.isfinite(x) & np.isfinite(df1) & (df1 > 1e-15)
+    x = np.maximum(x[ok], 0)
+    df1 = df1[ok]
+    n = len(x)
+    if n <= 1:
+        return np.nan, np.nan
+    m = np.median(x)
+    if m == 0:
+        m = 1
+    x = np.maximum(x, 1e-5 * m)
+    e = np.log(x) - special.digamma(df1 / 2) + np.log(df1 / 2)
+    emean = e.mean()
+    evar = np.sum((e - emean) ** 2) / (n - 1) - np.mean(special.polygamma(1, df1 / 2))
+    if evar > 0:
+        df2 = 2 * trigamma_inverse(evar)[0]
+        s20 = np.exp(emean + special.digamma(df2 / 2) - np.log(df2 / 2))
+    else:
+        df2 = np.inf
+        s20 = np.exp(emean)
+    return s20, df2
+
+def t_sf(t, df):
+    ''' upper tail of the t distribution, allowing infinite df '''
+    return np.where(np.isinf(df), stats.norm.sf(t), stats.t.sf(t, np.where(np.isinf(df), 1, df)))
+
+def t_isf(p, df):
+    return np.where(np.isinf(df), stats.norm.isf(p), stats.t.isf(p, np.where(np.isinf(df), 1, df)))
+
+def tmixture(tstat, stdev_unscaled, df, proportion, v0_lim):
+    ''' limma's tmixture.vector, the prior variance of the true log fold
+    changes of the differentially expressed proteins '''
+    ok = ~np.isnan(tstat)
+    tstat = np.abs(tstat[ok])
+    stdev_unscaled = stdev_unscaled[ok]
+    df = df[ok]
+    ngenes = len(tstat)
+    ntarget = int(np.ceil(proportion / 2 * ngenes))
+    if ntarget < 1:
+        return np.nan
+    p = max(ntarget / ngenes, proportion)
+    max_df = np.max(df)
+    lower = df < max_df
+    if lower.any():
+        tstat[lower] = t_isf(t_sf(tstat[lower], df[lower]), max_df)
+    order = np.argsort(-tstat, kind='stable')[:ntarget]
+    tstat = tstat[order]
+    v1 = stdev_unscaled[order] ** 2
+    r = np.arange(1, ntarget + 1)
+    p0 = 2 * t_sf(tstat, max_df)
+    ptarget = ((r - 0.5) / ngenes - (1 - p) * p0) / p
+    v0 = np.zeros(ntarget)
+    pos = ptarget > p0
+    if pos.any():
+        qtarget = t_isf(ptarget[pos] / 2, max_df)
+        v0[pos] = v1[pos] * ((tstat[pos] / qtarget) ** 2 - 1)
+    v0 = np.clip(v0, v0_lim[0], v0_lim[1])
+    return v0.mean()
+
+def loess_fit(x, y, span=0.75):
+    ''' fitted values of a local quadratic regression with tricube weights,
+    like fitted(loess(y ~ x, span=span)) computed directly at each point. the
+    fit is made once for each distinct x, and x is usually a log PSM count
+    with few distinct values '''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(x)
+    if n == 0 or np.ptp(x) == 0:
+        return np.full(n, np.mean(y) if n > 0 else np.nan)
+    q = max(3, min(n, int(np.floor(n * span))))
+    x0, inverse = np.unique(x, return_inverse=True)
+    fitted = np.empty(len(x0))
+    # blocks keep the distance matrix small
+    for start in range(0, len(x0), 256):
+        block = x0[start:start + 256]
+        distance = np.abs(x[None, :] - block[:, None])
+        h = np.partition(distance, q - 1, axis=1)[:, q - 1]
+        h = np.where(h > 0, h, 1)
+        weight = np.clip(1 - (distance / h[:, None]) ** 3, 0, None) ** 3
+        dx = x[None, :] - block[:, None]
+        # weighted least squares of y on 1, dx, dx^2 for each point
+        A = np.empty((len(block), 3, 3))
+        b = np.empty((len(block), 3))
+        moments = [np.sum(weight * dx ** k, axis=1) for k in range(5)]
+        for i in range(3):
+            b[:, i] = np.sum(weight * dx ** i * y[None, :], axis=1)
+            for j in range(3):
+                A[:, i, j] = moments[i + j]
+        fitted[start:start + len(block)] = (np.linalg.pinv(A) @ b[:, :, None])[:, 0, 0]
+    return fitted[inverse.reshape(-1)]
+
+def deqms(dat, control, treatment, counts, proportion=0.01, stdev_coef_lim=(0.1, 4)):
+    ''' lmFit with a control/treatment design, the treatment-control contrast,
+    eBayes and DEqMS spectraCounteBayes, for all proteins at once. dat has the
+    log ratios of the proteins (rows), counts their PSM counts. returns the
+    outputResult columns '''
+    values = dat.to_numpy(dtype=float)
+    xc = values[:, [dat.columns.get_loc(c) for c in control]] if len(control) > 0 else np.empty((len(dat), 0))
+    xt = values[:, [dat.columns.get_loc(c) for c in treatment]] if len(treatment) > 0 else np.empty((len(dat), 0))
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        nc = np.sum(~np.isnan(xc), axis=1)
+        nt = np.sum(~np.isnan(xt), axis=1)
+        mc = np.nanmean(xc, axis=1)
+        mt = np.nanmean(xt, axis=1)
+        rss = (np.nansum((xc - mc[:, None]) ** 2, axis=1)
+               + np.nansum((xt - mt[:, None]) ** 2, axis=1))
+        df_residual = (nc + nt - (nc > 0) - (nt > 0)).astype(float)
+        sigma2 = np.where(df_residual > 0, rss / df_residual, np.nan)
+        coef = mt - mc
+        stdev_unscaled = np.sqrt(1 / nc + 1 / nt)
+        amean = np.nanmean(values, axis=1)
+
+    # eBayes
+    s2_prior, df_prior = fit_f_dist(sigma2, df_residual)
+    if np.isinf(df_prior):
+        s2_post = np.full(len(sigma2), s2_prior)
+    else:
+        s2_post = (df_residual * sigma2 + df_prior * s2_prior) / (df_residual + df_prior)
+        s2_post = np.where(np.isnan(sigma2), s2_prior, s2_post)
+    t = coef / stdev_unscaled / np.sqrt(s2_post)
+    df_total = np.minimum(df_residual + df_prior, np.nansum(df_residual))
+    p_value = 2 * t_sf(np.abs(t), df_total)
+
+    var_prior_lim = np.array(stdev_coef_lim) ** 2 / s2_prior
+    var_prior = tmixture(t, stdev_unscaled, df_total, proportion, var_prior_lim)
+    if np.isnan(var_prior):
+        var_prior = 1 / s2_prior
+    r = (stdev_unscaled ** 2 + var_prior) / stdev_unscaled ** 2
+    t2 = t ** 2
+    if df_prior > 1e6:
+        kernel = t2 * (1 - 1 / r) / 2
+    else:
+        kernel = (1 + df_total) / 2 * np.log((t2 + df_total) / (t2 / r + df_total))
+    lods = np.log(proportion / (1 - proportion)) - np.log(r) / 2 + kernel
+
+    # spectraCounteBayes: the prior variance follows the PSM count
+    counts = np.asarray(counts, dtype=float)
+    ok = np.isfinite(sigma2) & (sigma2 > 0) & (counts > 0)
+    log_var = np.log(sigma2[ok])
+    y_pred = np.full(len(sigma2), np.nan)
+    y_pred[ok] = loess_fit(np.log2(counts[ok]), log_var, span=0.75)
+    residual = log_var - y_pred[ok]
+    evar = np.var(residual, ddof=1) - np.mean(special.polygamma(1, df_residual[ok] / 2))
+    d0 = 2 * trigamma_inverse(evar)[0] if evar > 0 else np.inf
+    sca_priorvar = np.exp(y_pred)
+    if np.isinf(d0):
+        sca_postvar = sca_priorvar
+        sca_df = np.full(len(sigma2), np.inf)
+    else:
+        sca_postvar = (d0 * sca_priorvar + df_residual * sigma2) / (d0 + df_residual)
+        sca_df = d0 + df_residual
+    sca_t = coef / stdev_unscaled / np.sqrt(sca_postvar)
+    sca_p = 2 * t_sf(np.abs(sca_t), sca_df)
+
+    return pd.DataFrame({'logFC': coef,
+                         'AveExpr': amean,
+                         't': t,
+                         'P.Value': p_value,
+                         'adj.P.Val': p_adjust_bh(p_value),
+                         'B': lods,
+                         'count': counts,
+                         'sca.t': sca_t,
+                         'sca.P.Value': sca_p,
+                         'sca.adj.pval': p_adjust_bh(sca_p)}, index=dat.index)
+
+def peptides_to_proteins(peptides_initial, multiplex, references, imput_threshold):
+    ''' filter, normalize and impute the peptides with PEMM and aggregate them
+    into proteins. returns the peptides_final and proteins_final tables '''
+    df_pep = peptides_initial.reset_index(drop=True)
+
+    if multiplex == True:
+        # we don't want the reference columns in analysis but store them for later
+        reference = pd.DataFrame(index=df_pep.index)
+        for name in references:
+            columns = grep(name, df_pep.columns)
+            reference = pd.concat([reference, df_pep[columns]], axis=1)
+            df_pep = df_pep.drop(columns=columns)
+            # we only want the log of the Reference ratio columns and not PSM
+            ratios = grep("ratio.%s" % name, reference.columns)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                reference[ratios] = np.log2(reference[ratios].astype(float))
+        ratio_columns = grep(".ratio.", df_pep.columns, ignore_case=True)
+        psm_columns = grep(".psm.", df_pep.columns, ignore_case=True)
+    else:
+        ratio_columns = grep("Peak.Area.", df_pep.columns)
+        psm_columns = grep("psm.", df_pep.columns, ignore_case=True)
+
+    dat = df_pep[ratio_columns].astype(float)
+    # select the rows meeting the non-empty criteria (0.5 = 50%)
+    present = 1 - dat.isna().sum(axis=1) / dat.shape[1]
+    dat = dat[present >= imput_threshold / 100]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dat = np.log2(dat)
+    dat = median_normalize(dat)
+
+    mu, Sigma, Xhat = pemm(dat.to_numpy())
+    pem_final = pd.DataFrame(Xhat, index=dat.index, columns=dat.columns)
+    rows = pem_final.index
+
+    # imputed peptides will count as having 1 PSM
+    psm_data = df_pep.loc[rows, psm_columns].astype(float).fillna(0) + 1
+    peptides_final = pd.concat([df_pep.loc[rows, INFO_COLUMNS], pem_final, psm_data], axis=1)
+    if multiplex == True:
+        peptides_final = pd.concat([peptides_final, reference.loc[rows]], axis=1)
+
+    accession = df_pep.loc[rows, 'accession']
+    ratio = pem_final.groupby(accession).median().sort_index()
+    psm = psm_data.groupby(accession).sum().sort_index()
+    protein_info = (df_pep.drop_duplicates('accession')[INFO_COLUMNS[1:]]
+                          .set_index('accession', drop=False)
+                          .loc[ratio.index])
+    proteins_final = pd.concat([protein_info, median_normalize(ratio), psm], axis=1)
+    proteins_final = proteins_final.reset_index(drop=True)
+
+    return peptides_final, proteins_final
+
+def diff_proteins(proteins_final, multiplex, controls, phenotype):
+    ''' the DEqMS table for phenotype against the control tags '''
+    df_prot = proteins_final.set_index('accession', drop=False)
+    df_prot.index.name = None
+    value_pattern = ".ratio.%s$" if multiplex == True else "Peak.Area.*.%s$"
+
+    control = []
+    count_columns = []
+    for name in controls:
+        control += grep(value_pattern % name, df_prot.columns)
+        count_columns += grep("psm.*.%s$" % name, df_prot.columns, ignore_case=True)
+    treatment = grep(value_pattern % phenotype, df_prot.columns)
+    count_columns += grep("psm.*.%s$" % phenotype, df_prot.columns, ignore_case=True)
+
+    # a column can match more than one tag, as it does with cbind in R
+    columns = control + treatment
+    dat = pd.DataFrame(df_prot[columns].to_numpy(dtype=float), index=df_prot.index,
+                       columns=["c%s" % i for i in range(len(columns))])
+    control = list(dat.columns[:len(control)])
+    treatment = list(dat.columns[len(control):])
+    counts = df_prot[count_columns].to_numpy(dtype=float).min(axis=1)
+
+    if multiplex == True:
+        dat = median_normalize(dat)
+        keep = ~dat.isna().any(axis=1).to_numpy()
+        dat = dat[keep]
+        counts = counts[keep]
+
+    results = deqms(dat, control, treatment, counts)
+    protein_info = df_prot.loc[results.index, INFO_COLUMNS[1:]]
+    results = pd.concat([protein_info, results], axis=1).sort_values('accession')
+    return results.reset_index(drop=True)
+
+def compare_with_r(project):
+    ''' run this on the project's peptides_initial table and print the largest
+    difference from each table the R version wrote '''
+    from django.core.exceptions import ObjectDoesNotExist
+    from projects.models import SearchSetting, Tag
+    from .run_command import settings
+
+    try:
+        searchsetting = SearchSetting.objects.get(project=project)
+    except ObjectDoesNotExist:
+        print("Missing searchsetting for project: %s." % project)
+        return False
+
+    folder = os.path.join(settings.data_folder, project, 'results')
+    peptides_initial = pd.read_csv(os.path.join(folder, '%s_peptides_initial.tsv' % project), sep='\t')
+
+    def tag_names(t_type):
+        return [t['name'] for t in Tag.objects.filter(project=project).filter(t_type=t_type).values('name')]
+
+    differences = compare_tables(folder, project, peptides_initial, searchsetting.multiplex,
+                                 tag_names('Reference'), tag_names('Control'), tag_names('Treatment'),
+                                 searchsetting.imput_threshold)
+    for name in differences:
+        if differences[name] is None:
+            print("%s: missing" % name)
+            continue
+        rows, rows_r, matched, columns = differences[name]
+        print("%s: %s rows (R %s, matched %s)" % (name, rows, rows_r, matched))
+        for column in columns:
+            print("  %s: max difference %.3g" % (column, columns[column]))
+
+def compare_tables(folder, prefix, peptides_initial, multiplex, references, controls, phenotypes,
+                   imput_threshold):
+    ''' make the tables from peptides_initial and compare them with the ones R
+    wrote to folder as <prefix>_peptides_final.tsv etc. returns the rows, R
+    rows, matched rows and the largest difference of each numeric column for
+    each table, or None when R's table is missing '''
+    peptides_final, proteins_final = peptides_to_proteins(peptides_initial, multiplex,
+                                                          references, imput_threshold)
+
+    def compare(name, ours, keys):
+        path = os.path.join(folder, name)
+        if not os.path.exists(path):
+            return None
+        theirs = pd.read_csv(path, sep='\t')
+        merged = ours.merge(theirs, on=keys, suffixes=('', '.r'))
+        columns = {}
+        for column in ours.columns:
+            if column in keys or column + '.r' not in merged.columns:
+                continue
+            if not pd.api.types.is_numeric_dtype(merged[column]):
+                continue
+            columns[column] = np.nanmax(np.abs(merged[column].to_numpy(dtype=float)
+                                               - merged[column + '.r'].to_numpy(dtype=float)))
+        return len(ours), len(theirs), len(merged), columns
+
+    differences = {}
+    name = '%s_peptides_final.tsv' % prefix
+    differences[name] = compare(name, peptides_final, ['sequence', 'accession'])
+    name = '%s_proteins_final.tsv' % prefix
+    differences[name] = compare(name, proteins_final, ['accession'])
+    for phenotype in phenotypes:
+        results = diff_proteins(proteins_final, multiplex, controls, phenotype)
+        name = '%s_DEqMS_results_final_%s.tsv' % (prefix, phenotype)
+        differences[name] = compare(name, results, ['accession'])
+    return differences
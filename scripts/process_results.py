@@ -5,6 +5,7 @@ import argparse
 import pandas as pd
 import math
 import time
+import heapq
 import warnings
 from decimal import Decimal
 
@@ -198,6 +199,30 @@ def calculate_species_file_summary(q_id, fasta_type):
                                      peak_area_psm=entry['peak_area_psm'])
         species.save()    
 
+# look up the proteome and length of each accession in chunks so every step
+# of inference can share them instead of querying per protein. the accession
+# is the FastaProtein primary key so it can be used directly as fp_id
+def fastaprotein_info(accessions, chunk_size=5000):
+    fp_info = {}
+    accessions = list(accessions)
+    for i in range(0, len(accessions), chunk_size):
+        query = (FastaProtein.objects.filter(accession__in=accessions[i:i + chunk_size])
+                                     .values_list('accession', 'ppid_id', 'length'))
+        for accession, ppid, length in query:
+            fp_info[accession] = {'ppid': ppid, 'length': length}
+            
+    return fp_info
+    
+# set the inferred protein for each (peptide id, accession) pair
+# the proteins for the file are fetched in one query and the peptides are
+# written with bulk_update rather than a get and save per peptide
+def link_peptides(queue, fasta_type, peptide_accessions):
+    protein_ids = dict(Protein.objects.filter(queue=queue, fasta_type=fasta_type)
+                                      .values_list('fp_id', 'id'))
+    peptides = [Peptide(id=peptide_id, protein_id=protein_ids[accession])
+                for peptide_id, accession in peptide_accessions]
+    Peptide.objects.bulk_update(peptides, ['protein'], batch_size=1000)
+    
 def infer_proteins(queue, fasta_type):
     ''' makes protein inference decisions. This is the old method. '''
 
@@ -248,11 +273,12 @@ def infer_proteins(queue, fasta_type):
     
     # now we have the species list, which we'll use to break ties, if possible
     # this is how many times a species could be linked to a peptide
+    fp_info = fastaprotein_info(accession_list.keys())
     species_list = {}
     for entry in query:
         accessions = entry.accessions.split(',')
         for accession in accessions:
-            ppid = FastaProtein.objects.filter(accession=accession).values_list('ppid__proteome', flat=True)[0]
+            ppid = fp_info[accession]['ppid']
             if ppid not in species_list:
                 species_list[ppid] = 1
             else:
@@ -268,8 +294,7 @@ def infer_proteins(queue, fasta_type):
         top_species_count = 0
         top_species = ""
         for accession in accessions:
-            fp = FastaProtein.objects.get(accession=accession)
-            ppid = fp.ppid.proteome
+            ppid = fp_info[accession]['ppid']
             if accession_list[accession] > top_count:
                 top_protein = accession
                 top_count = accession_list[accession]
@@ -323,8 +348,7 @@ def infer_proteins(queue, fasta_type):
     proteins_to_add = []
     for index, row in proteins.iterrows():
         accession = index
-        fp = FastaProtein.objects.get(accession=accession)
-        saf = Decimal(row['val_num_psm'] / fp.length)
+        saf = Decimal(row['val_num_psm'] / fp_info[accession]['length'])
         if searchsetting.mzmine_run_mzmine == False:
             peak_area = None
             peak_area_psm = None
@@ -333,7 +357,7 @@ def infer_proteins(queue, fasta_type):
             peak_area_psm = row['peak_area_psm']
         
         protein = Protein(queue=queue,
-                          fp=fp,
+                          fp_id=accession,
                           val_num_psm=float(row['val_num_psm']),
                           val_num_peptide=row['val_num_peptide'],
                           saf=saf,
@@ -351,16 +375,64 @@ def infer_proteins(queue, fasta_type):
     
     # update the proteininference link for the peptide now that we know what it is
     write_debug("Updating peptides with protein inference.", job, project)
-    for index, row in peptides.iterrows():
-        peptide = Peptide.objects.get(id=row['peptide_id'])
-        fp = FastaProtein.objects.get(accession=row['accession'])
-        protein = Protein.objects.get(fp=fp,
-                                      fasta_type=fasta_type,
-                                      queue=queue)
-        peptide.protein = protein
-        peptide.save()        
+    link_peptides(queue, fasta_type, zip(peptides['peptide_id'].tolist(), 
+                                         peptides['accession'].tolist()))
     #proteins.to_csv('proteins.csv')
     
+def assign_peptides(protein_peptides, peptide_proteins, uniques, protein_ppid,
+                    species_count):
+    ''' greedy parsimony inference over a peptide <-> protein index. 
+
+    protein_peptides maps accession -> peptide ids and peptide_proteins maps
+    peptide id -> accessions. the protein with the most unassigned peptides
+    is picked first. ties go to the protein with the most unique peptides,
+    then the most common species, then the protein seen first. returns a
+    dict of peptide id -> accession. '''
+
+    counts = {}
+    order = {}
+    heap = []
+    for i, accession in enumerate(protein_peptides):
+        counts[accession] = len(protein_peptides[accession])
+        order[accession] = i
+        
+    # ties are decided by values that don't change as peptides are assigned
+    def priority(accession):
+        return (-counts[accession],
+                -uniques.get(accession, 0),
+                -species_count[protein_ppid[accession]],
+                order[accession],
+                accession)
+        
+    for accession in protein_peptides:
+        heap.append(priority(accession))
+    heapq.heapify(heap)
+    
+    assignments = {}
+    while len(heap) > 0:
+        entry = heapq.heappop(heap)
+        prot = entry[-1]
+        # counts only go down, so an entry is stale if the count changed
+        # since it was pushed
+        if -entry[0] != counts[prot]:
+            continue
+        counts[prot] = 0
+            
+        for pep in protein_peptides[prot]:
+            if pep in assignments:
+                continue
+            assignments[pep] = prot
+            # the peptide is used now, so every other protein it could belong
+            # to has one less peptide to offer
+            for pro in peptide_proteins[pep]:
+                if pro == prot or counts[pro] == 0:
+                    continue
+                counts[pro] -= 1
+                if counts[pro] > 0:
+                    heapq.heappush(heap, priority(pro))
+
+    return assignments
+    
 def infer_proteins_new(queue, fasta_type):
     ''' makes protein inference decisions. This is the new method. '''
 
@@ -374,16 +446,6 @@ def infer_proteins_new(queue, fasta_type):
         print("Missing searchsetting for project: %s." % project)
         return False
         
-    def update_counts(prots):
-        counts = {}
-        for accession in prots:   
-            if accession in counts:
-                print("error")
-            counts[accession] = len(prots[accession])
-        counts = {k:v for k, v in sorted(counts.items(), key=lambda item: item[1], reverse=True)}      
-
-        return(counts)
-        
     # select the peptides for the file
     query = (Peptide.objects.filter(queue=queue, fasta_type=fasta_type))
 
@@ -396,6 +458,7 @@ def infer_proteins_new(queue, fasta_type):
     # build list of peptide assignments for each protein
     write_debug("Building list of initial list of peptide assignments.", job, project)
     protein_peptides = {}
+    peptide_proteins = {}
     uniques = {}
     peptide_info = {}
     rows_list = []
@@ -411,6 +474,7 @@ def infer_proteins_new(queue, fasta_type):
                 protein_peptides[accession] = [entry.id]
             else:
                 protein_peptides[accession].append(entry.id)
+        peptide_proteins[entry.id] = accessions
      
         dict1 = {}
         # now build the dataframe
@@ -423,8 +487,6 @@ def infer_proteins_new(queue, fasta_type):
     peptide_info = pd.DataFrame(rows_list)
     peptide_info.set_index('id', inplace=True)
     
-    counts = update_counts(protein_peptides)
-
     accession_list = list(protein_peptides)
     
     # we have to load the proteins here to get the species assignments
@@ -445,15 +507,16 @@ def infer_proteins_new(queue, fasta_type):
     # now we have the species list, which we'll use to break ties, if possible
     # this is how many times a species could be linked to a peptide
     write_debug("Calculating species expression.", job, project)
-    # make this a dataframe so we can look up the species without doing another db lookup
+    # fetch the protein info once so we can look up the species and lengths
+    # without doing another db lookup per protein
+    fp_info = fastaprotein_info(accession_list)
     protein_ppid = {}
     species_count = {}
     for entry in query:
         accessions = entry.accessions.split(',')
         for accession in accessions:
             if accession not in protein_ppid:
-                ppid = FastaProtein.objects.filter(accession=accession).values_list('ppid__proteome', flat=True)[0]
-                protein_ppid[accession] = ppid
+                protein_ppid[accession] = fp_info[accession]['ppid']
 
             if protein_ppid[accession] not in species_count:
                 species_count[protein_ppid[accession]] = 1
@@ -462,75 +525,9 @@ def infer_proteins_new(queue, fasta_type):
  
     write_debug("Updating inferences.", job, project)
     
-    rows_list = []
-    while len(counts) > 0:
-        #print(len(counts))
-        # this gets the first protein, i.e. the one with the most peptides
-        # we do have a problem here that ties are arbitrary right now. for example, if two proteins have 2 peptides, there's no tiebreaker so it's random
-        # we need to have a better tiebreaker
-        # how do we break ties?
-        #prot = next(iter(counts))
-        keys = list(counts)
-        count_to_check = counts[keys[0]]
-        prots = [k for k, v in counts.items() if v == count_to_check]
-
-        # check uniques first
-        # if tied, check species
-        # if still tied, then just let it be random as there's no way to resolve it
-        best_count = 0
-        tied_prots = []
-        for p in prots:
-            if p in uniques:
-                if uniques[p] > best_count:
-                    best_count = uniques[p]
-                    tied_prots = [p]    
-                elif uniques[p] == best_count:
-                    tied_prots.append(p)
-                    
-            # tied one wasn't found
-            else:
-                if(len(tied_prots)) == 0:
-                    tied_prots = [p]
-                elif best_count == 0:
-                    tied_prots.append(p)
-        
-        tied_peptide_proteins = {}
-        # now check tied_prots for ties after unique tiebreaker
-        if len(tied_prots) > 1:
-            best_count = 0
-            prot = ""
-            # species tie requires loading all proteins ahead of time (kind of slow)
-            for p in tied_prots:
-                p_species = protein_ppid[p]
-                p_species_count = species_count[p_species]
-                if p_species_count > best_count:
-                    best_count = p_species_count
-                    prot = p
-        # only one, so can use the first entry and skip species ties
-        else:
-            prot = tied_prots[0]
-            
-        peps_used = []
-        for pep in protein_peptides.pop(prot):
-            dict1 = {}
-            dict1.update({'id':pep, 'accession':prot})
-            # we also need to remove the peptide from protein_peptides now
-            peps_used.append(pep)
-            rows_list.append(dict1)
-            
-        # remove them 
-        for pro in protein_peptides:
-            protein_peptides[pro] = [x for x in protein_peptides[pro] if x not in peps_used]
-        
-        # now we may have an issue here where we have entries in protein_peptides that are empty
-        # clear them out
-        protein_peptides_dup = protein_peptides.copy()
-        for prot in protein_peptides_dup:
-            if len(protein_peptides_dup[prot]) == 0:
-                del protein_peptides[prot]
-                
-        # now we need to update the counts
-        counts = update_counts(protein_peptides)
+    assignments = assign_peptides(protein_peptides, peptide_proteins, uniques,
+                                  protein_ppid, species_count)
+    rows_list = [{'id':pep, 'accession':prot} for pep, prot in assignments.items()]
   
     # we may have no data, so just move on
     if len(rows_list) == 0:
@@ -553,8 +550,7 @@ def infer_proteins_new(queue, fasta_type):
     proteins_to_add = []
     for index, row in proteins.iterrows():
         accession = index
-        fp = FastaProtein.objects.get(accession=accession)
-        saf = Decimal(row['val_num_psm'] / fp.length)
+        saf = Decimal(row['val_num_psm'] / fp_info[accession]['length'])
         if searchsetting.mzmine_run_mzmine == False:
             peak_area = None
             peak_area_psm = None
@@ -563,7 +559,7 @@ def infer_proteins_new(queue, fasta_type):
             peak_area_psm = row['peak_area_psm']
         
         protein = Protein(queue=queue,
-                          fp=fp,
+                          fp_id=accession,
                           val_num_psm=float(row['val_num_psm']),
                           val_num_peptide=row['val_num_peptide'],
                           saf=saf,
@@ -581,13 +577,7 @@ def infer_proteins_new(queue, fasta_type):
     
     # update the peptides with the inference
     write_debug("Updating peptides with protein inference.", job, project)
-    for index, row in peptide_info.iterrows():
-        peptide = Peptide.objects.get(id=row['id'])
-        fp = FastaProtein.objects.get(accession=row['accession'])
-        protein = Protein.objects.get(fp=fp,
-                                      fasta_type=fasta_type,
-                                      queue=queue)
-        peptide.protein = protein
-        peptide.save()        
+    link_peptides(queue, fasta_type, zip(peptide_info['id'].tolist(), 
+                                         peptide_info['accession'].tolist()))
     #proteins.to_csv('proteins.csv')    
     
\ No newline at end of file
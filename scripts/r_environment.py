@@ -0,0 +1,206 @@
+# the R packages analyze_results needs are installed once by setup_r_environment
+# and recorded in install_folder/software/r_environment.json along with the R
+# version and the PEMM tarball they were installed from. later analyses only
+# load the packages, and the setup is run again when the stamp no longer
+# matches (a new R, a new PEMM tarball or a missing package)
+#
+# python3 manage.py runscript r_environment [--script-args --force|--benchmark]
+
+import os
+import json
+import time
+import hashlib
+import argparse
+
+from .run_command import settings
+
+STAMP = "r_environment.json"
+# bump when the packages or the way they're installed change
+STAMP_VERSION = 1
+CRAN_PACKAGES = ('BiocManager', 'matrixStats')
+BIOC_PACKAGES = ('DEqMS',)
+# PEMM isn't on CRAN anymore so it's installed from a tarball
+PEMM_TARBALL = "PEMM_1.0.tar.gz"
+PACKAGES = CRAN_PACKAGES + BIOC_PACKAGES + ('PEMM',)
+
+# set once the stamp has been checked in this process
+_checked = False
+
+def run(*args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--force', action='store_true', help='reinstall all packages')
+    parser.add_argument('--benchmark', action='store_true',
+        help='time the old per-analysis bootstrap against the cached one')
+    args2 = parser.parse_args(args)
+
+    if args2.benchmark:
+        benchmark()
+    else:
+        setup_r_environment(force=args2.force)
+
+def load_r():
+    ''' import rpy2, which starts R. returns robjects, pandas2ri and
+    localconverter '''
+    import rpy2.robjects as ro
+    from rpy2.robjects import pandas2ri
+    from rpy2.robjects.conversion import localconverter
+    return ro, pandas2ri, localconverter
+
+def stamp_path():
+    return os.path.join(settings.install_folder, "software", STAMP)
+
+def pemm_tarball():
+    return os.path.join(settings.install_folder, "software", PEMM_TARBALL)
+
+def file_sha256(path):
+    if not os.path.exists(path):
+        return None
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024*1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def current_environment():
+    ''' what the installed packages depend on '''
+    ro, pandas2ri, localconverter = load_r()
+    return {'version': STAMP_VERSION,
+            'r_version': ro.r('R.version.string')[0],
+            'pemm_sha256': file_sha256(pemm_tarball())}
+
+def read_stamp():
+    if not os.path.exists(stamp_path()):
+        return None
+    try:
+        with open(stamp_path(), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def stamp_is_current():
+    stamp = read_stamp()
+    if stamp is None:
+        return False
+    environment = current_environment()
+    for key in environment:
+        if stamp.get(key) != environment[key]:
+            return False
+    return set(PACKAGES).issubset(stamp.get('packages', {}))
+
+def setup_r_environment(force=False):
+    ''' install the R packages that are missing, or all of them with force,
+    and write the stamp '''
+    ro, pandas2ri, localconverter = load_r()
+    from rpy2.robjects.packages import isinstalled
+
+    start = time.time()
+    stamp = read_stamp() or {}
+    pemm_sha256 = file_sha256(pemm_tarball())
+    for name in PACKAGES:
+        if force or not isinstalled(name):
+            install_package(name)
+        elif name == 'PEMM' and pemm_sha256 is not None and stamp.get('pemm_sha256') != pemm_sha256:
+            # the tarball is compiled from source so it's only installed when
+            # it changes rather than for every analysis
+            install_package(name)
+
+    packages = {}
+    for name in PACKAGES:
+        if isinstalled(name):
+            packages[name] = str(ro.r('as.character(packageVersion("%s"))' % name)[0])
+
+    environment = current_environment()
+    environment['packages'] = packages
+    environment['date'] = time.strftime("%Y-%m-%d %H:%M:%S")
+    os.makedirs(os.path.dirname(stamp_path()), exist_ok=True)
+    with open(stamp_path(), 'w') as f:
+        json.dump(environment, f, indent=1)
+
+    global _checked
+    _checked = True
+    print("R environment ready in %.1f s: %s" % (time.time() - start,
+          ", ".join("%s %s" % (name, packages[name]) for name in packages)))
+
+def install_package(name):
+    ''' install one of PACKAGES from CRAN, Bioconductor or the PEMM tarball '''
+    ro, pandas2ri, localconverter = load_r()
+    from rpy2.robjects.packages import importr, isinstalled
+
+    utils = importr('utils')
+    if name == 'PEMM':
+        if not os.path.exists(pemm_tarball()):
+            raise FileNotFoundError("Missing %s. PEMM isn't on CRAN anymore so it's installed from this tarball." 
+                                    % pemm_tarball())
+        print("Installing PEMM from %s." % pemm_tarball())
+        utils.install_packages(pemm_tarball(), repos=ro.r("NULL"), type="source")
+        return
+
+    utils.chooseCRANmirror(ind=1)
+    if name in BIOC_PACKAGES:
+        if not isinstalled('BiocManager'):
+            install_package('BiocManager')
+        print("Installing %s from Bioconductor." % name)
+        importr("BiocManager").install(name, update=False, ask=False)
+    else:
+        print("Installing %s from CRAN." % name)
+        utils.install_packages(name)
+
+def load_r_package(name):
+    ''' importr a package, setting up the R environment first if this is the
+    first time or the stamp is out of date '''
+    from rpy2.robjects.packages import importr, PackageNotInstalledError
+
+    global _checked
+    if _checked == False:
+        if not stamp_is_current():
+            setup_r_environment()
+        _checked = True
+
+    try:
+        return importr(name)
+    except PackageNotInstalledError:
+        # removed since the stamp was written
+        install_package(name)
+        return importr(name)
+
+def benchmark():
+    ''' time starting R, the bootstrap analyze_results used to run for every
+    analysis, and loading the packages with a current stamp '''
+    if not os.path.exists(pemm_tarball()):
+        print("Missing %s, which the old bootstrap installed PEMM from." % pemm_tarball())
+        return False
+
+    start = time.time()
+    ro, pandas2ri, localconverter = load_r()
+    from rpy2.robjects.packages import importr, isinstalled
+    importr('base')
+    utils = importr('utils')
+    r_time = time.time() - start
+
+    if not stamp_is_current():
+        setup_r_environment()
+
+    # what load_pemm and load_deqms did on every call
+    start = time.time()
+    utils.install_packages(pemm_tarball(), repos=ro.r("NULL"), type="source")
+    importr('PEMM')
+    utils.chooseCRANmirror(ind=1)
+    isinstalled('matrixStats')
+    importr('matrixStats')
+    utils.chooseCRANmirror(ind=1)
+    isinstalled('BiocManager')
+    isinstalled('matrixStats')
+    isinstalled('DEqMS')
+    importr('DEqMS')
+    old_time = time.time() - start
+
+    global _checked
+    _checked = False
+    start = time.time()
+    for name in ('PEMM', 'matrixStats', 'DEqMS'):
+        load_r_package(name)
+    new_time = time.time() - start
+
+    print("starting R: %.2f s" % r_time)
+    print("bootstrap per analysis before: %.2f s" % old_time)
+    print("bootstrap per analysis now: %.2f s" % new_time)
@@ -17,7 +17,6 @@ import numpy as np
 import warnings
 
 from django.core.exceptions import ObjectDoesNotExist
-from django.db.models import Sum, Count
 
 csv.field_size_limit(sys.maxsize)
 
@@ -33,6 +32,20 @@ from results.models import (
 
 from .run_command import write_debug, settings
 
+# psm report columns in the order they are passed to Psm
+PSM_COLUMNS = ['Protein(s)',
+               'Sequence',
+               'Modified Sequence',
+               'Variable Modifications',
+               'Fixed Modifications',
+               'RT',
+               'm/z',
+               'Precursor m/z Error [ppm]',
+               'Measured Charge',
+               'Validation',
+               'Confidence [%]',
+               'Spectrum Title']
+
 def run(*args):
     parser = argparse.ArgumentParser()
     parser.add_argument('queue_id', type=int)
@@ -123,120 +136,44 @@ def read_results(queue_id, fasta_type):
             data_psm.iloc[:, i] = data_psm.iloc[:, i].astype(float)
             data_psm.iloc[:, i] = data_psm.iloc[:, i].replace(0, np.nan)
  
-    psmratio_list = []
-    psm_list = []
-    write_debug("Reading and saving PSMs (this may take some time).", job, project)
-    for index, row in data_psm.iterrows():
-        try:
-            #peak_area = math.log2(data_psm_pa[data_psm_pa['compound_db_identity:compound_name'] == row['Spectrum Title']]['area'].values[0])
-            peak_area = data_psm_pa[data_psm_pa['compound_db_identity:compound_name'] == row['Spectrum Title']]['area'].values[0]
-        except:
-            # set to 0 if mzmine didn't find a peak
-            peak_area = None
+    # only confident psms are saved, so mask them once instead of checking
+    # each row
+    confident = data_psm['Validation'] == 'Confident'
 
-        if row['Validation'] != 'Confident':
-            continue
-            
-        psm = Psm(queue=queue,
-                  accessions=row['Protein(s)'],
-                  sequence=row['Sequence'],
-                  mod_sequence=row['Modified Sequence'],
-                  variable_ptm=row['Variable Modifications'],
-                  fixed_ptm=row['Fixed Modifications'],
-                  rt=row['RT'],
-                  mz=row['m/z'],
-                  error=row['Precursor m/z Error [ppm]'],
-                  charge=row['Measured Charge'],
-                  validation=row['Validation'],
-                  confidence=Decimal(row['Confidence [%]']),
-                  title=row['Spectrum Title'],
-                  fasta_type=fasta_type,
-                  peak_area = peak_area
-                 )
-        # move to bulk_create and just loop again for ratios
-        psm_list.append(psm)
-        if len(psm_list) > 1000:
-            Psm.objects.bulk_create(psm_list, ignore_conflicts=True)
-            psm_list = []
-            
-    Psm.objects.bulk_create(psm_list, ignore_conflicts=True)
-    psm_list = []
-    
-    # we have to loop again because we can't determine the psm foreign key
-    # until it has actually been inserted
-    if searchsetting.multiplex == True:   
-        write_debug("Updating PSM ratios (this may take some time).", job, project)
-        for index, row in data_psm.iterrows():
-            if row['Validation'] != 'Confident':
-                continue        
-            # queue, title, and type is probably enough but we'll add a few more 
-            # things just to make sure it finds the right one
-            psm = Psm.objects.get(queue=queue,
-                                  sequence=row['Sequence'],
-                                  mod_sequence=row['Modified Sequence'],
-                                  title=row['Spectrum Title'],
-                                  fasta_type=fasta_type)
-            # insert the reporter ratio, which is the deisotoped intensity then normalized vs reference channel
-            # (entry for that psm divided by entry for reference for that psm)
-    
-            for i in range(pos2, final_pos):
-                ratio = row[i]
-                if math.isnan(ratio):
-                    ratio = None
-                psmratio = PsmRatio(psm=psm, ratio=ratio, label=headers2[i])
-                psmratio_list.append(psmratio)
-                if len(psmratio_list) > 5000:
-                    PsmRatio.objects.bulk_create(psmratio_list)
-                    psmratio_list = []                
-                #psmratio.save()
-    
-        PsmRatio.objects.bulk_create(psmratio_list)
-        psmratio_list = []
-    
+    # join the peak areas to the psms by spectrum title in one pass
+    if searchsetting.mzmine_run_mzmine == True:
+        peak_areas = psm_peak_areas(data_psm, data_psm_pa)
+    else:
+        peak_areas = pd.Series(np.nan, index=data_psm.index)
+
+    # peptides are created first so the psms can be inserted with their
+    # peptide already linked
     write_debug("Determing peptides from PSM list.", job, project)
-    peptides = data_psm.groupby('Modified Sequence')
-    peptide_list = data_psm['Modified Sequence'].unique()
-    med_ratios = {}
+    mod_sequences = data_psm['Modified Sequence']
+    # other than the counts, we can retrieve the peptide info from the 
+    # first entry
+    first_entries = data_psm.drop_duplicates(subset='Modified Sequence')
+    val_num_psms = mod_sequences.value_counts()
+    # validation is really a peptideshaker measure
+    # if there is one confident PSM, validation is Confident, otherwise
+    # Doubtful
+    validations = confident.groupby(mod_sequences).any()
+    # peak areas only come from saved psms that mzmine found a peak for
+    has_area = confident & (peak_areas > 0)
+    peak_area_sums = peak_areas[has_area].groupby(mod_sequences[has_area]).sum()
+    peak_area_counts = peak_areas[has_area].groupby(mod_sequences[has_area]).count()
 
-    rows_list1 = []
     peptide_list_add = []
-    peak_area_query = (Psm.objects.filter(queue=queue)
-                                .filter(peak_area__gt=0)
-                                .filter(fasta_type=fasta_type).values('mod_sequence')
-                                .annotate(peak_area_sum=Sum('peak_area'))
-                                .annotate(peak_area_count=Count('peak_area'))
-                                .order_by('mod_sequence'))
-    for p in peptide_list:
-        dict1 = {}
-        # retrieve the group
-        # other than the shape, we can retrieve the peptide info from the 
-        # first entry
-        group = peptides.get_group(p)
-        val_num_psm = group.shape[0]
-        first_entry = group.iloc[0]
-        if searchsetting.mzmine_run_mzmine == True:
-            result = next((item for item in peak_area_query if item['mod_sequence'] == first_entry['Modified Sequence']), None)
-            try:
-                peak_area = result['peak_area_sum']
-                peak_area_psm = result['peak_area_count']
-            except:
-                peak_area = None
-                peak_area_psm = None
+    for (accessions, sequence, mod_sequence, variable_ptm, 
+         fixed_ptm) in zip(*[first_entries[c].tolist() for c in PSM_COLUMNS[:5]]):
+        if mod_sequence in peak_area_sums.index:
+            peak_area = peak_area_sums[mod_sequence]
+            peak_area_psm = int(peak_area_counts[mod_sequence])
         else:
             peak_area = None
             peak_area_psm = None
             
-        accessions = first_entry['Protein(s)']
-        sequence = first_entry['Sequence']
-        mod_sequence = first_entry['Modified Sequence']
-        dict1.update({'peptide':mod_sequence})
-        variable_ptm = first_entry['Variable Modifications']
-        fixed_ptm = first_entry['Fixed Modifications']
-        # validation is really a peptideshaker measure
-        # if there is one confident PSM, validation is Confident, otherwise
-        # Doubtful
-        exists = 'Confident' in group.Validation.values
-        if exists == True:
+        if validations[mod_sequence] == True:
             validation = 'Confident'
         else:
             validation = 'Doubtful'
@@ -247,7 +184,7 @@ def read_results(queue_id, fasta_type):
                           mod_sequence=mod_sequence,
                           variable_ptm=variable_ptm,
                           fixed_ptm=fixed_ptm,
-                          val_num_psm=val_num_psm,
+                          val_num_psm=int(val_num_psms[mod_sequence]),
                           validation=validation,
                           fasta_type=fasta_type,
                           peak_area=peak_area,
@@ -255,25 +192,78 @@ def read_results(queue_id, fasta_type):
                          )
                               
         peptide_list_add.append(peptide)
-            
-        if len(peptide_list) > 1000:
+        if len(peptide_list_add) > 1000:
             Peptide.objects.bulk_create(peptide_list_add, ignore_conflicts=True)
             peptide_list_add = []
-            
-        # peptide.save()
 
     Peptide.objects.bulk_create(peptide_list_add, ignore_conflicts=True)
-    peptide_list = []
+    peptide_list_add = []
     # moved ratios to later because we need to know ppid of protein to remove contaminants
 
-    write_debug("Linking the PSMs to a peptide.", job, project)
-    # link the psms to a peptide now
-    query = (Psm.objects.filter(queue=queue).filter(fasta_type=fasta_type))
-    for entry in query:
-        peptide = Peptide.objects.get(queue=queue, mod_sequence=entry.mod_sequence, fasta_type=fasta_type)
-        entry.peptide = peptide
-        #entry.save()
-    Psm.objects.bulk_update(query, ['peptide'], batch_size=1000)
+    # bulk_create doesn't return ids with ignore_conflicts so fetch them all
+    # at once rather than looking up each peptide later
+    peptide_ids = dict(Peptide.objects.filter(queue=queue, fasta_type=fasta_type)
+                                      .values_list('mod_sequence', 'id'))
+
+    psm_list = []
+    write_debug("Reading and saving PSMs (this may take some time).", job, project)
+    data_confident = data_psm[confident]
+    columns = [data_confident[c].tolist() for c in PSM_COLUMNS]
+    columns.append(peak_areas[confident].tolist())
+    for (accessions, sequence, mod_sequence, variable_ptm, fixed_ptm, rt, mz,
+         error, charge, validation, confidence, title, peak_area) in zip(*columns):
+        # set to None if mzmine didn't find a peak
+        if pd.isna(peak_area):
+            peak_area = None
+
+        psm = Psm(queue=queue,
+                  peptide_id=peptide_ids[mod_sequence],
+                  accessions=accessions,
+                  sequence=sequence,
+                  mod_sequence=mod_sequence,
+                  variable_ptm=variable_ptm,
+                  fixed_ptm=fixed_ptm,
+                  rt=rt,
+                  mz=mz,
+                  error=error,
+                  charge=charge,
+                  validation=validation,
+                  confidence=Decimal(confidence),
+                  title=title,
+                  fasta_type=fasta_type,
+                  peak_area = peak_area
+                 )
+        psm_list.append(psm)
+        if len(psm_list) > 1000:
+            Psm.objects.bulk_create(psm_list, ignore_conflicts=True)
+            psm_list = []
+            
+    Psm.objects.bulk_create(psm_list, ignore_conflicts=True)
+    psm_list = []
+    
+    # the psm foreign key isn't known until it has actually been inserted, so
+    # fetch the ids for the file once and key them by spectrum title
+    if searchsetting.multiplex == True:   
+        write_debug("Updating PSM ratios (this may take some time).", job, project)
+        psm_ids = dict(Psm.objects.filter(queue=queue, fasta_type=fasta_type)
+                                  .values_list('title', 'id'))
+        # insert the reporter ratio, which is the deisotoped intensity then normalized vs reference channel
+        # (entry for that psm divided by entry for reference for that psm)
+        labels = headers2[pos2:final_pos]
+        ratios = data_confident.iloc[:, pos2:final_pos].to_numpy(dtype=float)
+        psmratio_list = []
+        for title, psm_ratios in zip(data_confident['Spectrum Title'].tolist(), ratios):
+            psm_id = psm_ids[title]
+            for label, ratio in zip(labels, psm_ratios.tolist()):
+                if math.isnan(ratio):
+                    ratio = None
+                psmratio_list.append(PsmRatio(psm_id=psm_id, ratio=ratio, label=label))
+            if len(psmratio_list) > 5000:
+                PsmRatio.objects.bulk_create(psmratio_list)
+                psmratio_list = []
+    
+        PsmRatio.objects.bulk_create(psmratio_list)
+        psmratio_list = []
     
     end = time.time()
     runtime = end - start
@@ -284,3 +274,12 @@ def read_results(queue_id, fasta_type):
         runtimex.read_results_proteome = runtime
     runtimex.save()
     return True
+
+# look up the mzmine peak area for each psm by spectrum title
+# the mzexport is indexed once so this is a hash join rather than a scan of
+# the whole export per psm. if a title appears more than once, the first
+# feature is used. psms without a peak are NaN
+def psm_peak_areas(data_psm, data_psm_pa):
+    areas = (data_psm_pa.drop_duplicates(subset='compound_db_identity:compound_name')
+                        .set_index('compound_db_identity:compound_name')['area'])
+    return data_psm['Spectrum Title'].map(areas)
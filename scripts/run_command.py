@@ -1,6 +1,10 @@
 import subprocess
 import time
 import os
+import sys
+import re
+import threading
+import collections
 
 from django.core.exceptions import ObjectDoesNotExist
 
@@ -12,22 +16,125 @@ except ObjectDoesNotExist:
     print("Create default settings for this server first.")
     raise SystemExit
 
+# numbers in a line of command output, which change between progress lines
+PROGRESS_DIGITS = re.compile(r'\d+')
+
+# a java heap size such as 25G or 4096m
+JAVA_MEMORY = re.compile(r'^\s*(\d+)\s*([kKmMgGtT]?)\s*$')
+JAVA_MEMORY_MB = {'': 1 / 1024**2, 'k': 1 / 1024, 'm': 1, 'g': 1024, 't': 1024**2}
+
+# log files are kept open and written in blocks instead of being opened for
+# every line, since the tools can print hundreds of thousands of lines
+_log_lock = threading.RLock()
+_logs = {}
+
+# seconds between flushes of command output to the log files
+LOG_FLUSH_SECONDS = 1
+# lines of command output kept in memory for each log for error reporting
+LOG_TAIL = 50
+
+def log_file(job, project):
+    ''' return the state of the open log file for job, opening it if needed '''
+    filename = "%s%s%s_%s.log" % (os.path.join(settings.install_folder, "log", project), os.sep, project, job)
+    log = _logs.get(filename)
+    if log is None:
+        if not os.path.exists(os.path.join(settings.install_folder, "log", project)):
+            os.makedirs(os.path.join(settings.install_folder, "log", project), exist_ok=True)
+        log = {'handle': open(filename, 'a'),
+               'last_flush': time.time(),
+               # the last progress line and when that kind of line was last 
+               # written, see log_command_line
+               'progress_key': None,
+               'progress_time': 0,
+               'progress_skipped': None,
+               'tail': collections.deque(maxlen=LOG_TAIL)}
+        _logs[filename] = log
+    return log
+
+def flush_logs():
+    with _log_lock:
+        for log in _logs.values():
+            log['handle'].flush()
+            log['last_flush'] = time.time()
+    sys.stdout.flush()
+
+def close_logs():
+    with _log_lock:
+        for log in _logs.values():
+            log['handle'].close()
+        _logs.clear()
+    sys.stdout.flush()
+
+def _forget_logs():
+    # a forked process opens its own handles. the parent flushed before the 
+    # fork so nothing is written twice
+    global _log_lock
+    _log_lock = threading.RLock()
+    _logs.clear()
+
+os.register_at_fork(before=flush_logs, after_in_child=_forget_logs)
+
+def _write(log, msg, flush):
+    log['handle'].write(msg)
+    if flush or time.time() - log['last_flush'] > LOG_FLUSH_SECONDS:
+        log['handle'].flush()
+        log['last_flush'] = time.time()
+        sys.stdout.flush()
+
+def log_tail(job, project):
+    ''' return the last lines of command output for job '''
+    with _log_lock:
+        return list(log_file(job, project)['tail'])
+
 # program outputs only
 def write_log(msg, job, project):
     ts = time.localtime()
     msg = "%s %s" % (time.strftime("%Y-%m-%d %H:%M:%S", ts), msg)
-    
-    filename = "%s%s%s_%s.log" % (os.path.join(settings.install_folder, "log", project), os.sep, project, job)
+    if not msg.endswith("\n"):
+        msg += "\n"
 
-    if not os.path.exists(os.path.join(settings.install_folder, "log", project)):
-        os.makedirs(os.path.join(settings.install_folder, "log", project))
-        
-    f = open(filename, 'a')
+    with _log_lock:
+        _write(log_file(job, project), msg, True)
+    print(msg.strip("\n"))
+
+# a line of output from run_command. output is only flushed every 
+# LOG_FLUSH_SECONDS, and runs of progress lines that only differ by their 
+# numbers (e.g. 10%, 20%) are written at most every log_progress_interval
+# seconds. the last line of a run is always written
+def log_command_line(line, job, project):
     ts = time.localtime()
-    f.write(msg)
-    f.close()
-    #print(msg, end='\r\n', flush=True)
-    print(msg.strip("\n"), flush=True)
+    msg = "%s %s" % (time.strftime("%Y-%m-%d %H:%M:%S", ts), line)
+    if not msg.endswith("\n"):
+        msg += "\n"
+    key = PROGRESS_DIGITS.sub("#", line.strip())
+
+    with _log_lock:
+        log = log_file(job, project)
+        log['tail'].append(msg)
+        if settings.log_progress_interval > 0:
+            now = time.time()
+            if key == log['progress_key']:
+                if now - log['progress_time'] < settings.log_progress_interval:
+                    log['progress_skipped'] = msg
+                    return
+            else:
+                if log['progress_skipped'] is not None:
+                    _write(log, log['progress_skipped'], False)
+                log['progress_key'] = key
+            log['progress_time'] = now
+            log['progress_skipped'] = None
+        _write(log, msg, False)
+    print(msg.strip("\n"))
+
+def end_command_log(job, project):
+    ''' write any skipped last progress line and flush after a command '''
+    with _log_lock:
+        log = log_file(job, project)
+        if log['progress_skipped'] is not None:
+            _write(log, log['progress_skipped'], False)
+        log['progress_key'] = None
+        log['progress_skipped'] = None
+        _write(log, "", True)
 
 # debug mode messages
 def write_debug(msg, job, project):
@@ -39,15 +146,8 @@ def write_debug(msg, job, project):
     ts = time.localtime()
     msg = "%s %s" % (time.strftime("%Y-%m-%d %H:%M:%S", ts), msg)
     
-    filename = "%s%s%s_%s.log" % (os.path.join(settings.install_folder, "log", project), os.sep, project, job)
-
-    if not os.path.exists(os.path.join(settings.install_folder, "log", project)):
-        os.makedirs(os.path.join(settings.install_folder, "log", project))
-        
-    f = open(filename, 'a')
-    ts = time.localtime()
-    f.write("%s\r\n" % msg)
-    f.close()
+    with _log_lock:
+        _write(log_file(job, project), "%s\r\n" % msg, True)
     #print(msg, end='\r\n', flush=True)
     print(msg, flush=True)
 
@@ -66,6 +166,39 @@ def write_error(msg):
     #print(msg, end='\r\n', flush=True)
     print(msg, flush=True)
     
+# resource use of the commands run since the last call to command_usage
+# commands may be run from several threads at once, e.g. parallel searches
+_usage_lock = threading.Lock()
+_usage = {'commands': 0, 'cpu_time': 0, 'peak_rss': 0, 'read_mb': 0, 'write_mb': 0}
+
+def command_usage():
+    ''' return and reset the resource use of the commands run so far '''
+    global _usage
+    with _usage_lock:
+        usage = _usage
+        _usage = {'commands': 0, 'cpu_time': 0, 'peak_rss': 0, 'read_mb': 0, 'write_mb': 0}
+    return usage
+
+def add_command_usage(rusage):
+    # rusage from wait4 includes the children the command waited for, so it
+    # covers the java or mono process started by timeout. ru_maxrss is in
+    # KB and the block counts are in 512 byte blocks
+    with _usage_lock:
+        _usage['commands'] += 1
+        _usage['cpu_time'] += rusage.ru_utime + rusage.ru_stime
+        _usage['peak_rss'] = max(_usage['peak_rss'], rusage.ru_maxrss / 1024)
+        _usage['read_mb'] += rusage.ru_inblock * 512 / 1024**2
+        _usage['write_mb'] += rusage.ru_oublock * 512 / 1024**2
+
+def split_memory(memory, parts):
+    ''' divide a java heap size such as 25G between parts jvms that run at the
+    same time. returns it in MB, or unchanged if it can't be parsed '''
+    match = JAVA_MEMORY.match(memory)
+    if match is None or parts <= 1:
+        return memory
+    mb = int(match.group(1)) * JAVA_MEMORY_MB[match.group(2).lower()]
+    return "%sM" % max(1, int(mb // parts))
+
 # execute a command and log each individual line of output as it comes out    
 def run_command(cmd, job, project):
     write_debug("runCommand: %s" % (cmd), job, project)
@@ -73,9 +206,19 @@ def run_command(cmd, job, project):
     with subprocess.Popen(cmd, stdout=subprocess.PIPE, 
                             stderr=subprocess.STDOUT, universal_newlines=True, bufsize=1) as p:
         for line in p.stdout:
-            write_log(line, job, project)
+            log_command_line(line, job, project)
+        # reap the command ourselves to get its resource use
+        pid, status, rusage = os.wait4(p.pid, 0)
+        if os.WIFSIGNALED(status):
+            p.returncode = -os.WTERMSIG(status)
+        else:
+            p.returncode = os.WEXITSTATUS(status)
+    add_command_usage(rusage)
+    end_command_log(job, project)
     if p.returncode != 0:
         print("returned error:" + str(p.returncode) + str(p.args))
+        write_error("Command failed with %s for project %s, job %s: %s\n%s" % 
+                    (p.returncode, project, job, p.args, "".join(log_tail(job, project)).rstrip("\n")))
         return 0
     else:
         return 1
@@ -11,6 +11,7 @@ from django.core.exceptions import ObjectDoesNotExist
 from projects.models import Setting, Queue, RunTime, SearchSetting
 
 from .run_command import run_command, write_debug, settings
+from .tool_runtime import clone_software, clean_job_temp
 
 def run(*args):
     # here if we know queue_id, we don't care about project
@@ -24,7 +25,7 @@ def run(*args):
       
 # args: filename
 # this will only get called when processing the queue
-def run_msconvert(queue_id):
+def run_msconvert(queue_id, job=None):
     try:
         queue = Queue.objects.get(id=queue_id)
     except ObjectDoesNotExist:
@@ -35,7 +36,10 @@ def run_msconvert(queue_id):
     filename = queue.filename
     project = queue.project.name
     install_folder = settings.install_folder
-    job = queue.job
+    # run_queue passes the job of the worker running the step so workers
+    # running entries of the same job don't share a temp folder
+    if job is None:
+        job = queue.job
 
     try:
         searchsetting=SearchSetting.objects.get(project=project)
@@ -49,14 +53,12 @@ def run_msconvert(queue_id):
         
     start = time.time()
 
-    if os.path.exists(os.path.join(install_folder, "temp", project, str(job))):
-        shutil.rmtree(os.path.join(install_folder, "temp", project, str(job)))
-    os.makedirs(os.path.join(install_folder, "temp", project, str(job)))
+    clean_job_temp(project, job)
   
     if os.path.exists(os.path.join(settings.data_folder, project, "raw", "%s.raw" % filename)):
-        # copy searchgui into temp
-        shutil.copytree(os.path.join(install_folder, "software", "SearchGUI-%s" % settings.searchgui_ver), 
-                        os.path.join(install_folder, "temp", project, str(job), "software", "SearchGUI-%s" % settings.searchgui_ver))
+        # clone searchgui into temp
+        clone_software("SearchGUI-%s" % settings.searchgui_ver, 
+                       os.path.join(install_folder, "temp", project, str(job), "software"))
                         
         write_debug("Starting msconvert: %s" % (filename), job, project)
          
@@ -77,8 +79,8 @@ def run_msconvert(queue_id):
                                 #"-z", # no zlib compression
                               ], job, project)
 
-        if os.path.exists(os.path.join(install_folder, "temp", project, str(job))):
-            shutil.rmtree(os.path.join(install_folder, "temp", project, str(job)))                              
+        # keep the searchgui clone for the search step
+        clean_job_temp(project, job)
     # if ends with .mzML, assume success and copy file
     elif os.path.exists(os.path.join(settings.data_folder, project, "raw", "%s.mzML" % filename)):
         write_debug("Found an mzML file already converted. Using it instead.", job, project)
@@ -17,6 +17,7 @@ from projects.models import (
 )
 
 from .run_command import run_command, write_debug, settings, write_error
+from .tool_runtime import clone_software
 
 def run(*args):
     parser = argparse.ArgumentParser()
@@ -28,7 +29,7 @@ def run(*args):
         
     run_mzmine(queue_id)
 
-def run_mzmine(queue_id):
+def run_mzmine(queue_id, job=None):
     ''' runs mzmine for peak areas for identified psms '''
     try:
         queue = Queue.objects.get(id=queue_id)
@@ -40,7 +41,10 @@ def run_mzmine(queue_id):
     project = queue.project.name
     
     install_folder = settings.install_folder
-    job = queue.job
+    # run_queue passes the job of the worker running the step so workers
+    # running entries of the same job don't share a temp folder
+    if job is None:
+        job = queue.job
     
     start = time.time()
     
@@ -68,15 +72,9 @@ def run_mzmine(queue_id):
     if os.path.exists(os.path.join(install_folder, "temp", project, str(job), "temp", "MZmine")):
         shutil.rmtree(os.path.join(install_folder, "temp", project, str(job), "temp", "MZmine"))
         
-    # copy reporter into temp
-    if os.path.exists(os.path.join(install_folder, "temp", project, str(job), "software", 
-                                   "MZmine-%s" % settings.mzmine_ver)):
-        shutil.rmtree(os.path.join(install_folder, "temp", project, str(job), "software", 
-                                   "MZmine-%s" % settings.mzmine_ver))
-        
-    shutil.copytree(os.path.join(install_folder, "software", "MZmine-%s" % settings.mzmine_ver), 
-                    os.path.join(install_folder, "temp", project, str(job), "software", 
-                    "MZmine-%s" % settings.mzmine_ver))
+    # clone mzmine into temp
+    clone_software("MZmine-%s" % settings.mzmine_ver, 
+                   os.path.join(install_folder, "temp", project, str(job), "software"))
                     
     # remove the old output if it exists
     if os.path.exists(os.path.join(settings.data_folder, project, "out", filename, type, "%s_mzexport.csv" % filename)):
@@ -12,6 +12,7 @@ from django.core.exceptions import ObjectDoesNotExist
 from projects.models import Setting, Queue, RunTime, SearchSetting, EngineStatus
 
 from .run_command import run_command, write_debug, settings
+from .tool_runtime import clone_software
 
 def run(*args):
     parser = argparse.ArgumentParser()
@@ -22,7 +23,7 @@ def run(*args):
         
     run_peptideshaker(queue_id)
 
-def run_peptideshaker(queue_id):
+def run_peptideshaker(queue_id, job=None):
     try:
         queue = Queue.objects.get(id=queue_id)
     except ObjectDoesNotExist:
@@ -33,7 +34,10 @@ def run_peptideshaker(queue_id):
     project = queue.project.name
  
     install_folder = settings.install_folder
-    job = queue.job
+    # run_queue passes the job of the worker running the step so workers
+    # running entries of the same job don't share a temp folder
+    if job is None:
+        job = queue.job
     
     start = time.time()
 
@@ -68,12 +72,9 @@ def run_peptideshaker(queue_id):
     if os.path.exists(os.path.join(install_folder, "temp", project, str(job), "temp", "PeptideShaker")):
         shutil.rmtree(os.path.join(install_folder, "temp", project, str(job), "temp", "PeptideShaker"))
     
-    # copy peptideshaker into temp
-    if os.path.exists(os.path.join(install_folder, "temp", project, str(job), "software", "PeptideShaker-%s" % settings.peptideshaker_ver)):
-        shutil.rmtree(os.path.join(install_folder, "temp", project, str(job), "software", "PeptideShaker-%s" % settings.peptideshaker_ver))
-        
-    shutil.copytree(os.path.join(settings.install_folder, "software", "PeptideShaker-%s" % settings.peptideshaker_ver), 
-                    os.path.join(install_folder, "temp", project, str(job), "software", "PeptideShaker-%s" % settings.peptideshaker_ver))
+    # clone peptideshaker into temp
+    clone_software("PeptideShaker-%s" % settings.peptideshaker_ver, 
+                   os.path.join(install_folder, "temp", project, str(job), "software"))
 
     # remove the old output if it exists
     if os.path.exists(os.path.join(settings.data_folder, project, "out", filename, fasta_type, "%s.psdb" % filename)):
@@ -2,15 +2,22 @@ import os
 import shutil
 import sys
 import argparse
+import time
+import socket
+import multiprocessing
+import threading
+import psutil
 from django.utils import timezone
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import connections
+from django.db.models import F
 
 from projects.models import Queue, Project, Setting, SearchSetting
-from projects.models import RunTime, EngineStatus
+from projects.models import RunTime, EngineStatus, StageMetric
 from results.models import Protein, Peptide, Psm
 from results.models import PsmRatio, SpeciesSummary, SpeciesFileSummary
 
-from .run_command import run_command, write_debug, settings
+from .run_command import run_command, write_debug, settings, split_memory
 from .run_msconvert import run_msconvert
 from .run_searchgui import run_searchgui
 from .run_peptideshaker import run_peptideshaker
@@ -19,16 +26,78 @@ from .generate_fasta import generate_fasta
 from .run_reporter import run_reporter
 from .process_results import process_results
 from .run_mzmine import run_mzmine
+from .stage_metrics import stage_metrics
+
+# steps grouped by the resource they mostly use. the search and quantification
+# tools are cpu and memory heavy while read_results and process_results are
+# limited by the database
+RESOURCE_CLASSES = {
+    'cpu': [Queue.Status.FILE_ADDED,
+            Queue.Status.THERMO,
+            Queue.Status.SEARCHGUI_PROF,
+            Queue.Status.PEPTIDESHAKER_PROF,
+            Queue.Status.REPORTER_PROF,
+            Queue.Status.MZMINE_PROF,
+            Queue.Status.SEARCHGUI_PROT,
+            Queue.Status.PEPTIDESHAKER_PROT,
+            Queue.Status.REPORTER_PROT,
+            Queue.Status.MZMINE_PROT],
+    'db': [Queue.Status.READ_RESULTS_PROF,
+           Queue.Status.PROCESS_RESULTS_PROF,
+           Queue.Status.READ_RESULTS_PROT,
+           Queue.Status.PROCESS_RESULTS_PROT],
+}
+
+# names the resource use of each step is recorded under, the same as the 
+# RunTime fields. custom searches are recorded as profile like in RunTime
+STAGES = {
+    Queue.Status.THERMO: 'msconvert',
+    Queue.Status.SEARCHGUI_PROF: 'searchgui_profile',
+    Queue.Status.PEPTIDESHAKER_PROF: 'peptideshaker_profile',
+    Queue.Status.REPORTER_PROF: 'reporter_profile',
+    Queue.Status.MZMINE_PROF: 'mzmine_profile',
+    Queue.Status.READ_RESULTS_PROF: 'read_results_profile',
+    Queue.Status.PROCESS_RESULTS_PROF: 'process_results_profile',
+    Queue.Status.SEARCHGUI_PROT: 'searchgui_proteome',
+    Queue.Status.PEPTIDESHAKER_PROT: 'peptideshaker_proteome',
+    Queue.Status.REPORTER_PROT: 'reporter_proteome',
+    Queue.Status.MZMINE_PROT: 'mzmine_proteome',
+    Queue.Status.READ_RESULTS_PROT: 'read_results_proteome',
+    Queue.Status.PROCESS_RESULTS_PROT: 'process_results_proteome',
+}
+
+# how long an idle worker waits before looking for work again
+WORKER_SLEEP = 30
+# how long a claim on a queue entry lasts without being renewed. a worker
+# renews it every third of this while a step runs, so an entry held by a
+# worker that died becomes claimable again after this long
+LEASE_SECONDS = 600
 
 def run(*args):
     parser = argparse.ArgumentParser()
     parser.add_argument('project', type=str)
     parser.add_argument('job', type=int, nargs='?', default=0)
+    # cpu_workers > 0 runs several queue entries at once
+    parser.add_argument('cpu_workers', type=int, nargs='?', default=0)
+    parser.add_argument('db_workers', type=int, nargs='?', default=1)
     args2 = parser.parse_args(args)
     project = args2.project
     job = args2.job
     
-    run_queue(project, job)
+    if args2.cpu_workers > 0:
+        run_queue_concurrent(project, job, args2.cpu_workers, args2.db_workers)
+    else:
+        run_queue(project, job)
+
+# entries that still have steps left to run
+def remaining_queue(project):
+    return (Queue.objects.filter(project__name=project)
+                         .exclude(error__gte=(1 + settings.max_retries))
+                         .exclude(status=Queue.Status.FINISHED_PROF)
+                         .exclude(status=Queue.Status.FINISHED_PROT)
+                         .exclude(status=Queue.Status.FILE_FINISHED)
+                         .exclude(skip=True)
+           )
 
 def run_queue(project, job):
     ''' main queue processing '''
@@ -48,316 +117,477 @@ def run_queue(project, job):
         (project, job), job, project
     )
     
+    worker = worker_name(job)
+    release_dead_leases(project, job)
+    waiting = False
     while True:
-        queue = (Queue.objects.filter(project__name=project, job=job)
-                              .exclude(error__gte=(1 + settings.max_retries))
-                              .exclude(status=Queue.Status.FINISHED_PROF)
-                              .exclude(status=Queue.Status.FINISHED_PROT)
-                              .exclude(status=Queue.Status.FILE_FINISHED)
-                              .exclude(skip=True)
-                              .order_by_status().first()
-                )
+        queue = (remaining_queue(project).filter(job=job)
+                                         .claim(worker, LEASE_SECONDS))
         if not queue:
+            # entries leased by another run of this job, or by one that died
+            # on another host, can be claimed once the lease runs out
+            if remaining_queue(project).filter(job=job).exists():
+                if waiting == False:
+                    write_debug("Waiting for entries leased by other workers in project %s and job %s." % (project, job), job, project)
+                    waiting = True
+                time.sleep(WORKER_SLEEP)
+                continue
             write_debug("No remaining entries left in the queue for project %s and job %s." % (project, job), job, project)
             return
+        waiting = False
             
-        filename = queue.filename
-        project = queue.project.name
-        install_folder = settings.install_folder
-        
-        # done with proteome step, so hold here
-        if queue.status == Queue.Status.FINISHED_PROT:
+        if run_step(queue, searchsetting, worker, job) == False:
             return
+
+def run_queue_concurrent(project, job, cpu_workers, db_workers):
+    ''' process several queue entries at once. each worker process only 
+    runs steps from its resource class and leases an entry before running a
+    step so no two workers work on the same file '''
+    if not Project.objects.filter(name=project).exists():
+        print("Unable to find project %s." % project)
+        return False
+        
+    if cpu_workers < 1 or db_workers < 1:
+        print("At least one cpu and one db worker are needed.")
+        return False
+        
+    write_debug("Starting concurrent queue processing for project %s and job %s with %s cpu and %s db workers." % 
+        (project, job, cpu_workers, db_workers), job, project
+    )
+    
+    release_dead_leases(project, job)
+    
+    # each worker gets its own job number, which run_step passes to the tools
+    # for their install_folder/temp/<project>/<job> folder and uses for the
+    # log. the entries keep their own job. runs of other jobs with the same
+    # number of workers get numbers that don't overlap with these
+    worker_job = job * (cpu_workers + db_workers)
+    
+    # the workers are forked so they need to open their own connections
+    connections.close_all()
+    context = multiprocessing.get_context('fork')
+    workers = []
+    for resource, count in (('cpu', cpu_workers), ('db', db_workers)):
+        for i in range(count):
+            worker = context.Process(target=run_worker, 
+                                     args=(project, worker_job, resource, count))
+            worker.start()
+            workers.append(worker)
+            worker_job += 1
             
-        elif queue.status == Queue.Status.PROCESS_RESULTS_PROT:
-            write_debug("Starting process_results for project: %s, filename: %s, type: proteome." % (project, filename), job, project)
-            if process_results(queue.id, "proteome") == True:
-                queue.status = Queue.Status.FINISHED_PROT
-                queue.date_finished_proteome = timezone.now()
-                # calculate the runtime now
-                write_debug("Calculating total runtime for project: %s, filename: %s, type: proteome." % (project, filename), job, project)
-                runtimex = RunTime.objects.get(queue=queue)
-                runtime = (runtimex.msconvert
-                           + runtimex.searchgui_profile
-                           + runtimex.peptideshaker_profile
-                           + runtimex.reporter_profile
-                           + runtimex.mzmine_profile
-                           + runtimex.read_results_profile
-                           + runtimex.process_results_profile
-                           + runtimex.searchgui_proteome
-                           + runtimex.peptideshaker_proteome
-                           + runtimex.reporter_proteome
-                           + runtimex.mzmine_proteome
-                           + runtimex.read_results_proteome
-                           + runtimex.process_results_proteome
-                           )
-                queue.total_runtime = runtime
-                queue.save()
-                write_debug("Finished process_results for project: %s, filename: %s, type: proteome." % (project, filename), job, project)
-            else:
-                write_debug("Failed process_results for project: %s, filename: %s, type: proteome." % (project, filename), job, project)
-                queue.error += 1
-                queue.save()
-              
-        elif queue.status == Queue.Status.READ_RESULTS_PROT:
-            write_debug("Starting read_results for project: %s, filename: %s, type: proteome." % (project, filename), job, project)
-            if read_results(queue.id, "proteome") == True:
-                queue.status = Queue.Status.PROCESS_RESULTS_PROT
-                queue.error = 0
-                queue.save()
-                write_debug("Finished read_results for project: %s, filename: %s, type: proteome." % (project, filename), job, project)
-            else:
-                write_debug("Failed read_results for project: %s, filename: %s, type: proteome." % (project, filename), job, project)
-                queue.error += 1 
-                queue.save()
+    for worker in workers:
+        worker.join()
+        
+    write_debug("Finished concurrent queue processing for project %s and job %s." % (project, job), job, project)
 
-        elif queue.status == Queue.Status.MZMINE_PROT:
-            if searchsetting.mzmine_run_mzmine == True:
-                write_debug("Starting run_mzmine for project: %s, filename: %s, type: proteome." % (project, filename), job, project)
-                if run_mzmine(queue.id) == True:
-                    queue.status = Queue.Status.READ_RESULTS_PROT
-                    queue.error = 0
-                    queue.save()
-                    write_debug("Finished run_mzmine for project: %s, filename: %s, type: proteome." % (project, filename), job, project)
-                else:
-                    write_debug("Failed run_mzmine for project: %s, filename: %s, type: proteome." % (project, filename), job, project)
-                    queue.error += 1
-                    queue.save()
-            else:
-                queue.status = Queue.Status.READ_RESULTS_PROT
-                queue.save()
-                
-        elif queue.status == Queue.Status.REPORTER_PROT:
-            # reporter is only needed for multiplexed
-            if searchsetting.multiplex == True:
-                write_debug("Starting run_reporter for project: %s, filename: %s, type: proteome." % (project, filename), job, project)
-                if run_reporter(queue.id) == True:
-                    queue.status = Queue.Status.MZMINE_PROT
-                    queue.error = 0
-                    queue.save()
-                    write_debug("Finished run_reporter for project: %s, filename: %s, type: proteome." % (project, filename), job, project)
-                else:
-                    write_debug("Failed run_reporter for project: %s, filename: %s, type: proteome." % (project, filename), job, project)
-                    queue.error += 1
-                    queue.save()
-            else:
-                queue.status = Queue.Status.MZMINE_PROT
-                queue.save()
+def run_worker(project, job, resource, workers):
+    ''' claim and run steps of the given resource class until the queue is
+    empty. workers is the number of workers of this resource class '''
+    try:
+        searchsetting=SearchSetting.objects.get(project=project)
+    except ObjectDoesNotExist:
+        write_debug("Missing searchsetting for project: %s." % project, job, project)
+        return False
+        
+    worker = worker_name(job)
+    if resource == 'cpu':
+        # the cpu workers run their tools at the same time so they share the
+        # threads and memory. settings is this process's own copy and isn't
+        # saved
+        if settings.threads == -1:
+            threads = psutil.cpu_count()
+        else:
+            threads = settings.threads
+        settings.threads = max(1, threads // workers)
+        settings.memory = split_memory(settings.memory, workers)
+        write_debug("Worker %s uses %s threads and %s memory." % (worker, settings.threads, settings.memory), job, project)
+    write_debug("Starting %s worker %s for project %s." % (resource, worker, project), job, project)
+    
+    while True:
+        queue = (remaining_queue(project).filter(status__in=RESOURCE_CLASSES[resource])
+                                         .claim(worker, LEASE_SECONDS))
+        if not queue:
+            # other workers may still be running steps that lead to ours
+            if not remaining_queue(project).exists():
+                write_debug("No remaining entries left in the queue for project %s and worker %s." % (project, worker), job, project)
+                return
+            time.sleep(WORKER_SLEEP)
+            continue
+            
+        run_step(queue, searchsetting, worker, job)
+
+def worker_name(job):
+    return "%s:%s:%s" % (socket.gethostname(), os.getpid(), job)
+
+def release_dead_leases(project, job):
+    ''' release the leases held by workers on this host whose process has
+    exited, e.g. a run_queue that crashed or was killed, so a new run doesn't
+    have to wait for them to expire. like an expired lease this counts as an
+    error for the entry '''
+    # checking a pid with signal 0 only works on posix
+    if os.name != 'posix':
+        return
+    host = socket.gethostname()
+    leases = (Queue.objects.filter(project__name=project)
+                           .filter(worker__startswith="%s:" % host)
+                           .values_list('id', 'worker'))
+    for queue_id, worker in leases:
+        try:
+            pid = int(worker.rsplit(":", 2)[1])
+        except (IndexError, ValueError):
+            continue
+        if pid == os.getpid():
+            continue
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            released = (Queue.objects.filter(id=queue_id, worker=worker)
+                                     .update(worker=None, lease_expires=None, 
+                                             error=F('error') + 1))
+            if released == 1:
+                write_debug("Released the lease on queue entry %s held by %s, which is no longer running." % (queue_id, worker), job, project)
+        except PermissionError:
+            # running as another user
+            continue
+
+def run_step(queue, searchsetting, worker, job):
+    ''' run the next step for a claimed entry, keeping the lease alive while
+    it runs and releasing it afterwards '''
+    project = queue.project.name
+    
+    # taking over from a worker that died counts as an error, so the entry
+    # may now be over the retry limit
+    if queue.error >= 1 + settings.max_retries:
+        write_debug("Project: %s, filename %s has an error status of %s or higher. Reset error to continue." % (project, queue.filename, (1 + settings.max_retries)), job, project)
+        queue.release(worker)
+        return True
+        
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=renew_lease, 
+                                 args=(queue, worker, job, stop),
+                                 daemon=True)
+    heartbeat.start()
+    try:
+        if queue.status in STAGES:
+            with stage_metrics(queue, STAGES[queue.status]):
+                return process_queue(queue, searchsetting, job)
+        return process_queue(queue, searchsetting, job)
+    finally:
+        stop.set()
+        heartbeat.join()
+        queue.release(worker)
+
+def renew_lease(queue, worker, job, stop):
+    ''' renew the lease on queue until stop is set '''
+    while not stop.wait(LEASE_SECONDS / 3):
+        if queue.renew_lease(worker, LEASE_SECONDS) == False:
+            write_debug("Lost the lease on %s to another worker." % queue.filename, job, queue.project_id)
+            break
+    # this thread has its own database connection
+    connections.close_all()
+
+def process_queue(queue, searchsetting, job):
+    ''' run the next step for a single queue entry '''
+    filename = queue.filename
+    project = queue.project.name
+    install_folder = settings.install_folder
+    
+    # done with proteome step, so hold here
+    if queue.status == Queue.Status.FINISHED_PROT:
+        return False
+        
+    elif queue.status == Queue.Status.PROCESS_RESULTS_PROT:
+        write_debug("Starting process_results for project: %s, filename: %s, type: proteome." % (project, filename), job, project)
+        if process_results(queue.id, "proteome") == True:
+            queue.status = Queue.Status.FINISHED_PROT
+            queue.date_finished_proteome = timezone.now()
+            # calculate the runtime now
+            write_debug("Calculating total runtime for project: %s, filename: %s, type: proteome." % (project, filename), job, project)
+            runtimex = RunTime.objects.get(queue=queue)
+            runtime = (runtimex.msconvert
+                       + runtimex.searchgui_profile
+                       + runtimex.peptideshaker_profile
+                       + runtimex.reporter_profile
+                       + runtimex.mzmine_profile
+                       + runtimex.read_results_profile
+                       + runtimex.process_results_profile
+                       + runtimex.searchgui_proteome
+                       + runtimex.peptideshaker_proteome
+                       + runtimex.reporter_proteome
+                       + runtimex.mzmine_proteome
+                       + runtimex.read_results_proteome
+                       + runtimex.process_results_proteome
+                       )
+            queue.total_runtime = runtime
+            queue.save()
+            write_debug("Finished process_results for project: %s, filename: %s, type: proteome." % (project, filename), job, project)
+        else:
+            write_debug("Failed process_results for project: %s, filename: %s, type: proteome." % (project, filename), job, project)
+            queue.error += 1
+            queue.save()
+          
+    elif queue.status == Queue.Status.READ_RESULTS_PROT:
+        write_debug("Starting read_results for project: %s, filename: %s, type: proteome." % (project, filename), job, project)
+        if read_results(queue.id, "proteome") == True:
+            queue.status = Queue.Status.PROCESS_RESULTS_PROT
+            queue.error = 0
+            queue.save()
+            write_debug("Finished read_results for project: %s, filename: %s, type: proteome." % (project, filename), job, project)
+        else:
+            write_debug("Failed read_results for project: %s, filename: %s, type: proteome." % (project, filename), job, project)
+            queue.error += 1 
+            queue.save()
 
-        elif queue.status == Queue.Status.PEPTIDESHAKER_PROT:
-            # peptideshaker needs to be run for reporter
-            write_debug("Starting run_peptideshaker for project: %s, filename: %s, type: proteome." % (project, filename), job, project)
-            if run_peptideshaker(queue.id) == True:
-                queue.status = Queue.Status.REPORTER_PROT
+    elif queue.status == Queue.Status.MZMINE_PROT:
+        if searchsetting.mzmine_run_mzmine == True:
+            write_debug("Starting run_mzmine for project: %s, filename: %s, type: proteome." % (project, filename), job, project)
+            if run_mzmine(queue.id, job) == True:
+                queue.status = Queue.Status.READ_RESULTS_PROT
                 queue.error = 0
                 queue.save()
-                write_debug("Finished run_peptideshaker for project: %s, filename: %s, type: proteome." % (project, filename), job, project)
+                write_debug("Finished run_mzmine for project: %s, filename: %s, type: proteome." % (project, filename), job, project)
             else:
-                write_debug("Failed run_peptideshaker for project: %s, filename: %s, type: proteome." % (project, filename), job, project)
+                write_debug("Failed run_mzmine for project: %s, filename: %s, type: proteome." % (project, filename), job, project)
                 queue.error += 1
                 queue.save()
-
-        elif queue.status == Queue.Status.SEARCHGUI_PROT:
-            write_debug("Starting run_searchgui for project: %s, filename: %s, type: proteome." % (project, filename), job, project)
-            if run_searchgui(queue.id) == True:
-                queue.status = Queue.Status.PEPTIDESHAKER_PROT
+        else:
+            queue.status = Queue.Status.READ_RESULTS_PROT
+            queue.save()
+            
+    elif queue.status == Queue.Status.REPORTER_PROT:
+        # reporter is only needed for multiplexed
+        if searchsetting.multiplex == True:
+            write_debug("Starting run_reporter for project: %s, filename: %s, type: proteome." % (project, filename), job, project)
+            if run_reporter(queue.id, job) == True:
+                queue.status = Queue.Status.MZMINE_PROT
                 queue.error = 0
                 queue.save()
-                write_debug("Finished run_searchgui for project: %s, filename: %s, type: proteome." % (project, filename), job, project)
+                write_debug("Finished run_reporter for project: %s, filename: %s, type: proteome." % (project, filename), job, project)
             else:
-                write_debug("Failed run_searchgui for project: %s, filename: %s, type: proteome." % (project, filename), job, project)
+                write_debug("Failed run_reporter for project: %s, filename: %s, type: proteome." % (project, filename), job, project)
                 queue.error += 1
                 queue.save()
+        else:
+            queue.status = Queue.Status.MZMINE_PROT
+            queue.save()
 
-        # all this status indicates is that the file is done, so nothing should be done
-        # this shouldn't be selected though but is here for reference
-        elif queue.status == Queue.Status.FINISHED_PROF:
-            return
+    elif queue.status == Queue.Status.PEPTIDESHAKER_PROT:
+        # peptideshaker needs to be run for reporter
+        write_debug("Starting run_peptideshaker for project: %s, filename: %s, type: proteome." % (project, filename), job, project)
+        if run_peptideshaker(queue.id, job) == True:
+            queue.status = Queue.Status.REPORTER_PROT
+            queue.error = 0
+            queue.save()
+            write_debug("Finished run_peptideshaker for project: %s, filename: %s, type: proteome." % (project, filename), job, project)
+        else:
+            write_debug("Failed run_peptideshaker for project: %s, filename: %s, type: proteome." % (project, filename), job, project)
+            queue.error += 1
+            queue.save()
+
+    elif queue.status == Queue.Status.SEARCHGUI_PROT:
+        write_debug("Starting run_searchgui for project: %s, filename: %s, type: proteome." % (project, filename), job, project)
+        if run_searchgui(queue.id, job) == True:
+            queue.status = Queue.Status.PEPTIDESHAKER_PROT
+            queue.error = 0
+            queue.save()
+            write_debug("Finished run_searchgui for project: %s, filename: %s, type: proteome." % (project, filename), job, project)
+        else:
+            write_debug("Failed run_searchgui for project: %s, filename: %s, type: proteome." % (project, filename), job, project)
+            queue.error += 1
+            queue.save()
+
+    # all this status indicates is that the file is done, so nothing should be done
+    # this shouldn't be selected though but is here for reference
+    elif queue.status == Queue.Status.FINISHED_PROF:
+        return False
+        
+    elif queue.status == Queue.Status.PROCESS_RESULTS_PROF:
+        write_debug("Starting process_results for project: %s, filename: %s" % (project, filename), job, project)
+        if process_results(queue.id, "profile") == True:
+            queue.status = Queue.Status.FINISHED_PROF
+            queue.date_finished_profile = timezone.now()
+            # calculate the runtime now
+            runtimex = RunTime.objects.get(queue=queue)
+            runtime = (runtimex.msconvert
+                       + runtimex.searchgui_profile
+                       + runtimex.peptideshaker_profile
+                       + runtimex.reporter_profile
+                       + runtimex.mzmine_profile
+                       + runtimex.read_results_profile
+                       + runtimex.process_results_profile
+                       )
+            queue.total_runtime = runtime
+            queue.save()
+            queue.date_finished_profile = timezone.now()
+            write_debug("Finished process_results for project: %s, filename: %s, type: profile." % (project, filename), job, project)
+        else:
+            write_debug("Failed process_results for project: %s, filename: %s, type: profile." % (project, filename), job, project)
+            queue.error += 1
+            queue.save()
             
-        elif queue.status == Queue.Status.PROCESS_RESULTS_PROF:
-            write_debug("Starting process_results for project: %s, filename: %s" % (project, filename), job, project)
-            if process_results(queue.id, "profile") == True:
-                queue.status = Queue.Status.FINISHED_PROF
-                queue.date_finished_profile = timezone.now()
-                # calculate the runtime now
-                runtimex = RunTime.objects.get(queue=queue)
-                runtime = (runtimex.msconvert
-                           + runtimex.searchgui_profile
-                           + runtimex.peptideshaker_profile
-                           + runtimex.reporter_profile
-                           + runtimex.mzmine_profile
-                           + runtimex.read_results_profile
-                           + runtimex.process_results_profile
-                           )
-                queue.total_runtime = runtime
-                queue.save()
-                queue.date_finished_profile = timezone.now()
-                write_debug("Finished process_results for project: %s, filename: %s, type: profile." % (project, filename), job, project)
-            else:
-                write_debug("Failed process_results for project: %s, filename: %s, type: profile." % (project, filename), job, project)
-                queue.error += 1
-                queue.save()
-                
-        elif queue.status == Queue.Status.READ_RESULTS_PROF:
-            if searchsetting.custom_fasta == True:
-                fasta_type = "custom"
-            else:
-                fasta_type = "profile"        
-            write_debug("Starting read_results for project: %s, filename: %s, type: %s." % (project, filename, fasta_type), job, project)
-            if read_results(queue.id, fasta_type) == True:
-                queue.status = Queue.Status.PROCESS_RESULTS_PROF
-                queue.error = 0
-                queue.save()
-                write_debug("Finished read_results for project: %s, filename: %s, type: %s." % (project, filename, fasta_type), job, project)
-            else:
-                write_debug("Failed read_results for project: %s, filename: %s, type: %s." % (project, filename, fasta_type), job, project)
-                queue.error += 1 
-                queue.save()
+    elif queue.status == Queue.Status.READ_RESULTS_PROF:
+        if searchsetting.custom_fasta == True:
+            fasta_type = "custom"
+        else:
+            fasta_type = "profile"        
+        write_debug("Starting read_results for project: %s, filename: %s, type: %s." % (project, filename, fasta_type), job, project)
+        if read_results(queue.id, fasta_type) == True:
+            queue.status = Queue.Status.PROCESS_RESULTS_PROF
+            queue.error = 0
+            queue.save()
+            write_debug("Finished read_results for project: %s, filename: %s, type: %s." % (project, filename, fasta_type), job, project)
+        else:
+            write_debug("Failed read_results for project: %s, filename: %s, type: %s." % (project, filename, fasta_type), job, project)
+            queue.error += 1 
+            queue.save()
 
-        elif queue.status == Queue.Status.MZMINE_PROF:
-            if searchsetting.custom_fasta == True:
-                fasta_type = "custom"
-            else:
-                fasta_type = "profile"
-            if searchsetting.mzmine_run_mzmine == True:
-                write_debug("Starting run_mzmine for project: %s, filename: %s, type: %s." % (project, filename, fasta_type), job, project)
-                if run_mzmine(queue.id) == True:
-                    queue.status = Queue.Status.READ_RESULTS_PROF
-                    queue.error = 0
-                    queue.save()
-                    write_debug("Finished run_mzmine for project: %s, filename: %s, type: %s." % (project, filename, fasta_type), job, project)
-                else:
-                    write_debug("Failed run_mzmine for project: %s, filename: %s, type: %s." % (project, filename, fasta_type), job, project)
-                    queue.error += 1
-                    queue.save()
-            else:
+    elif queue.status == Queue.Status.MZMINE_PROF:
+        if searchsetting.custom_fasta == True:
+            fasta_type = "custom"
+        else:
+            fasta_type = "profile"
+        if searchsetting.mzmine_run_mzmine == True:
+            write_debug("Starting run_mzmine for project: %s, filename: %s, type: %s." % (project, filename, fasta_type), job, project)
+            if run_mzmine(queue.id, job) == True:
                 queue.status = Queue.Status.READ_RESULTS_PROF
-                queue.save()
-                
-        elif queue.status == Queue.Status.REPORTER_PROF:
-            # reporter is only needed for multiplexed
-            if searchsetting.multiplex == True:
-                write_debug("Starting run_reporter for project: %s, filename: %s" % (project, filename), job, project)
-                if run_reporter(queue.id) == True:
-                    queue.status = Queue.Status.MZMINE_PROF
-                    queue.error = 0
-                    queue.save()
-                    write_debug("Starting run_reporter for project: %s, filename: %s" % (project, filename), job, project)
-                else:
-                    write_debug("Finished run_reporter for project: %s, filename: %s, type: profile." % (project, filename), job, project)
-                    queue.error += 1
-                    queue.save()
-            else:
-                queue.status = Queue.Status.MZMINE_PROF
-                queue.save()
-                
-        elif queue.status == Queue.Status.PEPTIDESHAKER_PROF:
-            if searchsetting.custom_fasta == True:
-                fasta_type = "custom"
-            else:
-                fasta_type = "profile"        
-            # peptideshaker needs to be run for reporter
-            write_debug("Starting run_peptideshaker for project: %s, filename: %s, type: %s." % (project, filename, fasta_type), job, project)
-            if run_peptideshaker(queue.id) == True:
-                queue.status = Queue.Status.REPORTER_PROF
                 queue.error = 0
                 queue.save()
-                write_debug("Finished run_peptideshaker for project: %s, filename: %s, type: %s." % (project, filename, fasta_type), job, project)
+                write_debug("Finished run_mzmine for project: %s, filename: %s, type: %s." % (project, filename, fasta_type), job, project)
             else:
-                write_debug("Failed run_peptideshaker for project: %s, filename: %s, type: %s." % (project, filename, fasta_type), job, project)
+                write_debug("Failed run_mzmine for project: %s, filename: %s, type: %s." % (project, filename, fasta_type), job, project)
                 queue.error += 1
                 queue.save()
-                
-        elif queue.status == Queue.Status.SEARCHGUI_PROF:
-            if searchsetting.custom_fasta == True:
-                fasta_type = "custom"
-            else:
-                fasta_type = "profile"         
-
-            write_debug("Starting run_searchgui for project: %s, filename: %s, type: %s." % (project, filename, fasta_type), job, project)
-            if run_searchgui(queue.id) == True:
-                queue.status = Queue.Status.PEPTIDESHAKER_PROF
-                queue.error = 0
-                queue.save()
-                write_debug("Finished run_searchgui for project: %s, filename: %s, type: %s." % (project, filename, fasta_type), job, project)
-            else:
-                write_debug("Failed run_searchgui for project: %s, filename: %s, type: %s." % (project, filename, fasta_type), job, project)
-                queue.error += 1
-                queue.save()
-                
-        # this only needs to be done once per file
-        elif queue.status == Queue.Status.THERMO:
-            if searchsetting.custom_fasta == True:
-                fasta_type = "custom"
-            else:
-                fasta_type = "profile"         
-                
-            write_debug("Starting run_msconvert for project: %s, filename: %s, type: %s." % (project, filename, fasta_type), job, project)
-            if run_msconvert(queue.id) == True:
-                if searchsetting.profile == True:
-                    queue.status = Queue.Status.SEARCHGUI_PROF
-                else:
-                    queue.status = Queue.Status.SEARCHGUI_PROT
+        else:
+            queue.status = Queue.Status.READ_RESULTS_PROF
+            queue.save()
+            
+    elif queue.status == Queue.Status.REPORTER_PROF:
+        # reporter is only needed for multiplexed
+        if searchsetting.multiplex == True:
+            write_debug("Starting run_reporter for project: %s, filename: %s" % (project, filename), job, project)
+            if run_reporter(queue.id, job) == True:
+                queue.status = Queue.Status.MZMINE_PROF
                 queue.error = 0
                 queue.save()
-                write_debug("Finished run_msconvert for project: %s, filename: %s, type: %s." % (project, filename, fasta_type), job, project)                
+                write_debug("Starting run_reporter for project: %s, filename: %s" % (project, filename), job, project)
             else:
-                write_debug("Failed run_msconvert for project: %s, filename: %s, type: %s." % (project, filename, fasta_type), job, project)
+                write_debug("Finished run_reporter for project: %s, filename: %s, type: profile." % (project, filename), job, project)
                 queue.error += 1
                 queue.save()
-                
-        # clean up/set up
-        # wipe existing outputs and make sure the proper dirs exist
-        # also wipe up the database
-        elif queue.status == Queue.Status.FILE_ADDED:
-            if searchsetting.custom_fasta == True:
-                fasta_type = "custom"
-            else:
-                fasta_type = "profile"        
-
-            write_debug("Cleaning up existing entries for project: %s, filename: %s, type: %s." % (project, filename, fasta_type), job, project)
-            delete = Protein.objects.filter(queue=queue).delete()
-            delete = Peptide.objects.filter(queue=queue).delete()
-            delete = Psm.objects.filter(queue=queue).delete()
-            delete = PsmRatio.objects.filter(psm__queue=queue).delete()
-            delete = RunTime.objects.filter(queue=queue).delete()
-            delete = SpeciesFileSummary.objects.filter(queue=queue).delete()
-            delete = EngineStatus.objects.filter(queue=queue).delete()
-            # create the runtimex table
-            runtimex = RunTime(queue=queue)
-            runtimex.save()
-            
-            # create the enginestatus table
-            enginestatus = EngineStatus(queue=queue)
-            enginestatus.save()
-            
-            if os.path.exists(os.path.join(settings.data_folder, project, "out", filename)):
-                shutil.rmtree(os.path.join(settings.data_folder, project, "out", filename))
-                
-            os.makedirs(os.path.join(settings.data_folder, project, "out", filename))
+        else:
+            queue.status = Queue.Status.MZMINE_PROF
+            queue.save()
             
-            if searchsetting.custom_fasta == True:
-                os.makedirs(os.path.join(settings.data_folder, project, "out", filename, "custom"))
-            else:
-                os.makedirs(os.path.join(settings.data_folder, project, "out", filename, "profile"))
+    elif queue.status == Queue.Status.PEPTIDESHAKER_PROF:
+        if searchsetting.custom_fasta == True:
+            fasta_type = "custom"
+        else:
+            fasta_type = "profile"        
+        # peptideshaker needs to be run for reporter
+        write_debug("Starting run_peptideshaker for project: %s, filename: %s, type: %s." % (project, filename, fasta_type), job, project)
+        if run_peptideshaker(queue.id, job) == True:
+            queue.status = Queue.Status.REPORTER_PROF
+            queue.error = 0
+            queue.save()
+            write_debug("Finished run_peptideshaker for project: %s, filename: %s, type: %s." % (project, filename, fasta_type), job, project)
+        else:
+            write_debug("Failed run_peptideshaker for project: %s, filename: %s, type: %s." % (project, filename, fasta_type), job, project)
+            queue.error += 1
+            queue.save()
             
-                os.makedirs(os.path.join(settings.data_folder, project, "out", filename, "proteome"))
+    elif queue.status == Queue.Status.SEARCHGUI_PROF:
+        if searchsetting.custom_fasta == True:
+            fasta_type = "custom"
+        else:
+            fasta_type = "profile"         
 
-            # clean up the temp dir
-            if os.path.exists(os.path.join(install_folder, "temp", project, str(job))):
-                shutil.rmtree(os.path.join(install_folder, "temp", project, str(job)))
-                     
-            queue.date_finished_profile = None
-            queue.date_finished_proteome = None
-            queue.status = Queue.Status.THERMO
+        write_debug("Starting run_searchgui for project: %s, filename: %s, type: %s." % (project, filename, fasta_type), job, project)
+        if run_searchgui(queue.id, job) == True:
+            queue.status = Queue.Status.PEPTIDESHAKER_PROF
             queue.error = 0
-            queue.total_runtime = 0
+            queue.save()
+            write_debug("Finished run_searchgui for project: %s, filename: %s, type: %s." % (project, filename, fasta_type), job, project)
+        else:
+            write_debug("Failed run_searchgui for project: %s, filename: %s, type: %s." % (project, filename, fasta_type), job, project)
+            queue.error += 1
             queue.save()
             
+    # this only needs to be done once per file
+    elif queue.status == Queue.Status.THERMO:
+        if searchsetting.custom_fasta == True:
+            fasta_type = "custom"
         else:
-            write_debug("Invalid status for project: %s, filename: %s" % (project, filename), job, project)
-            queue.error = 1 + settings.max_retries
+            fasta_type = "profile"         
+            
+        write_debug("Starting run_msconvert for project: %s, filename: %s, type: %s." % (project, filename, fasta_type), job, project)
+        if run_msconvert(queue.id, job) == True:
+            if searchsetting.profile == True:
+                queue.status = Queue.Status.SEARCHGUI_PROF
+            else:
+                queue.status = Queue.Status.SEARCHGUI_PROT
+            queue.error = 0
             queue.save()
+            write_debug("Finished run_msconvert for project: %s, filename: %s, type: %s." % (project, filename, fasta_type), job, project)                
+        else:
+            write_debug("Failed run_msconvert for project: %s, filename: %s, type: %s." % (project, filename, fasta_type), job, project)
+            queue.error += 1
+            queue.save()
+            
+    # clean up/set up
+    # wipe existing outputs and make sure the proper dirs exist
+    # also wipe up the database
+    elif queue.status == Queue.Status.FILE_ADDED:
+        if searchsetting.custom_fasta == True:
+            fasta_type = "custom"
+        else:
+            fasta_type = "profile"        
+
+        write_debug("Cleaning up existing entries for project: %s, filename: %s, type: %s." % (project, filename, fasta_type), job, project)
+        delete = Protein.objects.filter(queue=queue).delete()
+        delete = Peptide.objects.filter(queue=queue).delete()
+        delete = Psm.objects.filter(queue=queue).delete()
+        delete = PsmRatio.objects.filter(psm__queue=queue).delete()
+        delete = RunTime.objects.filter(queue=queue).delete()
+        delete = StageMetric.objects.filter(queue=queue).delete()
+        delete = SpeciesFileSummary.objects.filter(queue=queue).delete()
+        delete = EngineStatus.objects.filter(queue=queue).delete()
+        # create the runtimex table
+        runtimex = RunTime(queue=queue)
+        runtimex.save()
+        
+        # create the enginestatus table
+        enginestatus = EngineStatus(queue=queue)
+        enginestatus.save()
+        
+        if os.path.exists(os.path.join(settings.data_folder, project, "out", filename)):
+            shutil.rmtree(os.path.join(settings.data_folder, project, "out", filename))
+            
+        os.makedirs(os.path.join(settings.data_folder, project, "out", filename))
+        
+        if searchsetting.custom_fasta == True:
+            os.makedirs(os.path.join(settings.data_folder, project, "out", filename, "custom"))
+        else:
+            os.makedirs(os.path.join(settings.data_folder, project, "out", filename, "profile"))
+        
+            os.makedirs(os.path.join(settings.data_folder, project, "out", filename, "proteome"))
+
+        # clean up the temp dir
+        if os.path.exists(os.path.join(install_folder, "temp", project, str(job))):
+            shutil.rmtree(os.path.join(install_folder, "temp", project, str(job)))
+                 
+        queue.date_finished_profile = None
+        queue.date_finished_proteome = None
+        queue.status = Queue.Status.THERMO
+        queue.error = 0
+        queue.total_runtime = 0
+        queue.save()
+        
+    else:
+        write_debug("Invalid status for project: %s, filename: %s" % (project, filename), job, project)
+        queue.error = 1 + settings.max_retries
+        queue.save()
+        
+    return True
 
 # once we run update_queue final, wipe the old files
 # we no longer remove files needed for other steps so they can be re-run
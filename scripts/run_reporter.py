@@ -15,6 +15,7 @@ from projects.models import (
 )
 
 from .run_command import run_command, write_debug, settings, write_error
+from .tool_runtime import clone_software
 
 def run(*args):
     parser = argparse.ArgumentParser()
@@ -26,7 +27,7 @@ def run(*args):
         
     run_reporter(queue_id)
 
-def run_reporter(queue_id):
+def run_reporter(queue_id, job=None):
     ''' runs reporter for multiplexed data to get the psm ratios '''
     try:
         queue = Queue.objects.get(id=queue_id)
@@ -38,7 +39,10 @@ def run_reporter(queue_id):
     project = queue.project.name
     
     install_folder = settings.install_folder
-    job = queue.job
+    # run_queue passes the job of the worker running the step so workers
+    # running entries of the same job don't share a temp folder
+    if job is None:
+        job = queue.job
     
     start = time.time()
     
@@ -64,13 +68,9 @@ def run_reporter(queue_id):
     if os.path.exists(os.path.join(install_folder, "temp", project, str(job), "temp", "Reporter")):
         shutil.rmtree(os.path.join(install_folder, "temp", project, str(job), "temp", "Reporter"))
         
-    # copy reporter into temp
-    if os.path.exists(os.path.join(install_folder, "temp", project, str(job), "software", "Reporter-%s" % settings.reporter_ver)):
-        shutil.rmtree(os.path.join(install_folder, "temp", project, str(job), "software", "Reporter-%s" % settings.reporter_ver))
-        
-    shutil.copytree(os.path.join(install_folder, "software", "Reporter-%s" % settings.reporter_ver), 
-                    os.path.join(install_folder, "temp", project, str(job), "software", 
-                    "Reporter-%s" % settings.reporter_ver))
+    # clone reporter into temp
+    clone_software("Reporter-%s" % settings.reporter_ver, 
+                   os.path.join(install_folder, "temp", project, str(job), "software"))
 
     # remove the old output if it exists
     if os.path.exists(os.path.join(settings.data_folder, project, "out", filename, type, "%s_reporter.psdb" % filename)):
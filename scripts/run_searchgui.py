@@ -4,12 +4,25 @@ import psutil
 import argparse
 import time
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
 from django.core.exceptions import ObjectDoesNotExist
 
 from projects.models import Setting, Queue, SearchSetting, ModChoice, EnzymeChoice, RunTime, EngineStatus
 
-from .run_command import run_command, write_debug, settings
+from .run_command import run_command, write_debug, settings, split_memory
+from .tool_runtime import clone_software, clean_job_temp
+
+# searchgui option, output file and log name for each search engine
+SEARCH_ENGINES = {
+    'xtandem': ('-xtandem', '%s.t.xml.gz', 'XTandem'),
+    'msgf': ('-msgf', '%s.msgf.mzid.gz', 'MSGF+'),
+    'omssa': ('-omssa', '%s.omx.gz', 'OMSSA'),
+    'comet': ('-comet', '%s.comet.pep.xml.gz', 'Comet'),
+    'metamorpheus': ('-meta_morpheus', '%s.mzID.gz', 'Metamorpheus'),
+    'myrimatch': ('-myrimatch', '%s.myrimatch.mzid.gz', 'MyriMatch'),
+    'sage': ('-sage', '%s.sage.tsv.gz', 'Sage'),
+}
 
 def run(*args):
     parser = argparse.ArgumentParser()
@@ -21,14 +34,17 @@ def run(*args):
         
     run_searchgui(queue_id)
 
-def run_searchgui(queue_id):
+def run_searchgui(queue_id, job=None):
     try:
         queue = Queue.objects.get(id=queue_id)
     except ObjectDoesNotExist:
         print("searchgui missing queue_id: %s" % queue_id)
         return False
     
-    job = queue.job
+    # run_queue passes the job of the worker running the step so workers
+    # running entries of the same job don't share a temp folder
+    if job is None:
+        job = queue.job
     filename = queue.filename
     project = queue.project.name
     
@@ -75,18 +91,13 @@ def run_searchgui(queue_id):
     enzyme_list_specificity = ",".join([str(enzyme.specificity) for enzyme in enzymechoice])
     enzyme_list_mc = ",".join([str(enzyme.mc) for enzyme in enzymechoice])
 
-    # remove the temp dir to prepare for running the programs
-    if os.path.exists(os.path.join(install_folder, "temp", project, str(job))):
-        shutil.rmtree(os.path.join(install_folder, "temp", project, str(job)))
-    os.makedirs(os.path.join(install_folder, "temp", project, str(job)))
-
-    # remake the temp software folder
-    if not os.path.exists(os.path.join(install_folder, "temp", project, str(job), "software")):
-        os.makedirs(os.path.join(install_folder, "temp", project, str(job), "software"))
+    # clear the temp dir to prepare for running the programs
+    # the software clones are kept so they can be reused
+    clean_job_temp(project, job)
         
-    # copy searchgui into temp
-    shutil.copytree(os.path.join(install_folder, "software", "SearchGUI-%s" % settings.searchgui_ver), 
-                    os.path.join(install_folder, "temp", project, str(job), "software", "SearchGUI-%s" % settings.searchgui_ver))
+    # clone searchgui into temp
+    searchgui = clone_software("SearchGUI-%s" % settings.searchgui_ver, 
+                               os.path.join(install_folder, "temp", project, str(job), "software"))
     
     # remove the parameter file
     if os.path.exists("%s%s%s_%s.par" % (os.path.join(settings.data_folder, project, "out", filename, fasta_type), os.sep, project, fasta_type)):
@@ -100,17 +111,21 @@ def run_searchgui(queue_id):
     if os.path.exists(os.path.join(settings.data_folder, project, "out", filename, fasta_type, "searchgui_out.zip")):
         os.remove(os.path.join(settings.data_folder, project, "out", filename, fasta_type, "searchgui_out.zip"))
 
+    # the paths are saved in the searchgui clone so each clone needs this
+    def path_settings(searchgui, temp_folder):
+        return run_command(["timeout", "86400", 
+                        "java", "-Xms%s" % settings.memory, "-Xmx%s" % settings.memory, 
+                        "-cp", os.path.join(searchgui, "SearchGUI-%s.jar" % settings.searchgui_ver), 
+                        "eu.isas.searchgui.cmd.PathSettingsCLI",
+                        "-temp_folder", "%s" % temp_folder,
+                        "-identification_parameters", "%s" % temp_folder,
+                        "-gene_mapping", "%s" % temp_folder,
+                        "-pride_annotation", "%s" % temp_folder,
+                        "-use_log_folder", "0"
+                        ], job, project) 
+
     write_debug("Starting SearchGUI PathSettingsCLI: %s" % (os.path.join(settings.data_folder, project)), job, project)
-    success = run_command(["timeout", "86400", 
-                    "java", "-Xms%s" % settings.memory, "-Xmx%s" % settings.memory, 
-                    "-cp", os.path.join(install_folder, "temp", project, str(job), "software", "SearchGUI-%s" % settings.searchgui_ver, "SearchGUI-%s.jar" % settings.searchgui_ver), 
-                    "eu.isas.searchgui.cmd.PathSettingsCLI",
-                    "-temp_folder", "%s" % os.path.join(install_folder, "temp", project, str(job), "temp", "SearchGUI"),
-                    "-identification_parameters", "%s" % os.path.join(install_folder, "temp", project, str(job), "temp", "SearchGUI"),
-                    "-gene_mapping", "%s" % os.path.join(install_folder, "temp", project, str(job), "temp", "SearchGUI"),
-                    "-pride_annotation", "%s" % os.path.join(install_folder, "temp", project, str(job), "temp", "SearchGUI"),
-                    "-use_log_folder", "0"
-                    ], job, project) 
+    success = path_settings(searchgui, os.path.join(install_folder, "temp", project, str(job), "temp", "SearchGUI"))
 
     if (success == 0):
             write_debug("SearchGUI PathSettingsCLI failed", job, project)
@@ -252,195 +267,98 @@ def run_searchgui(queue_id):
     
     enginestatus.save()
     
-    def run_search(**engine):
-        success = run_command(["timeout", "172800", 
-                                "java", "-Xms%s" % settings.memory, "-Xmx%s" % settings.memory, 
-                                "-cp", os.path.join(install_folder, "temp", project, str(job), "software", "SearchGUI-%s" % settings.searchgui_ver, "SearchGUI-%s.jar" % settings.searchgui_ver), 
-                                "eu.isas.searchgui.cmd.SearchCLI",
-                                "-spectrum_files", "%s.mzML" % (os.path.join(settings.data_folder, project, "out", filename, filename)),
-                                "-output_folder", "%s" % (os.path.join(settings.data_folder, project, "out", filename, fasta_type)),
-                                "-id_params", "%s%s%s_%s.par" % (os.path.join(settings.data_folder, project, "out", filename, fasta_type), os.sep, project, fasta_type),
-                                "-fasta_file", "%s" % fasta_file,
-                                "-xtandem", "%s" % engine['xtandem'],
-                                "-msgf", "%s" % engine['msgf'],
-                                "-omssa", "%s" % engine['omssa'],
-                                "-comet", "%s" % engine['comet'],
-                                "-meta_morpheus", "%s" % engine['metamorpheus'],
-                                "-myrimatch", "%s" % engine['myrimatch'],
-                                "-ms_amanda", "%s" % engine['ms_amanda'],
-                                "-sage", "%s" % engine['sage'],
-                                "-tide", "%s" % engine['tide'],
-                                "-output_option", "3",
-                                "-output_data", "0",
-                                "-output_date", "0",
-                                "-threads", "%s" % threads
-                            ], job, project)
-                            
-        if (engine['comet'] == 1):
-            if not os.path.exists(
-                os.path.join(settings.data_folder, project, "out", filename, 
-                    fasta_type, "%s.comet.pep.xml.gz" % filename)
-            ):
-                write_debug("Missing Comet output from run_searchgui.", 
-                    job, project)
-                enginestatus.comet_tries += 1
-                enginestatus.save()
-                
-                if enginestatus.comet_tries < settings.max_retries:
-                    run_search(xtandem=0, msgf=0, comet=1, omssa=0, metamorpheus=0, myrimatch=0, sage=0, ms_amanda=0, tide=0)
-                    
-            else:
-                enginestatus.comet_tries = 0
-                if fasta_type == "profile":                
-                    enginestatus.comet_profile = True
-                elif fasta_type == "proteome":
-                    enginestatus.comet_proteome = True
-                enginestatus.save()
+    output_folder = os.path.join(settings.data_folder, project, "out", filename, fasta_type)
+    engines = [engine for engine, selected in (('xtandem', xtandem), ('msgf', msgf), ('comet', comet), 
+                                                ('omssa', omssa), ('metamorpheus', metamorpheus), 
+                                                ('myrimatch', myrimatch), ('sage', sage)) if selected == 1]
 
-        if (engine['msgf'] == 1):
-            if not os.path.exists(
-                os.path.join(settings.data_folder, project, "out", filename, 
-                    fasta_type, "%s.msgf.mzid.gz" % filename)
-            ):
-                write_debug("Missing MSGF+ output from run_searchgui.", 
-                    job, project)
-                enginestatus.msgf_tries += 1
-                enginestatus.save()
-                
-                if enginestatus.msgf_tries < settings.max_retries:
-                    run_search(xtandem=0, msgf=1, comet=0, omssa=0, metamorpheus=0, myrimatch=0, sage=0, ms_amanda=0, tide=0)
-                    
-            else:
-                enginestatus.msgf_tries = 0
-                if fasta_type == "profile":                
-                    enginestatus.msgf_profile = True
-                elif fasta_type == "proteome":
-                    enginestatus.msgf_proteome = True                
-                enginestatus.save()
-                
- 
-        if (engine['xtandem'] == 1):
-            if not os.path.exists(
-                os.path.join(settings.data_folder, project, "out", filename, 
-                    fasta_type, "%s.t.xml.gz" % filename)
-            ):
-                write_debug("Missing XTandem output from run_searchgui.", 
-                    job, project)
-                enginestatus.xtandem_tries += 1
-                enginestatus.save()
-                
-                if enginestatus.xtandem_tries < settings.max_retries:
-                    run_search(xtandem=1, msgf=0, comet=0, omssa=0, metamorpheus=0, myrimatch=0, sage=0, ms_amanda=0, tide=0)
-                    
-            else:
-                enginestatus.xtandem_tries = 0
-                if fasta_type == "profile":                
-                    enginestatus.xtandem_profile = True
-                elif fasta_type == "proteome":
-                    enginestatus.xtandem_proteome = True
-                enginestatus.save()
- 
-        if (engine['omssa'] == 1):
-            if not os.path.exists(
-                os.path.join(settings.data_folder, project, "out", filename, 
-                    fasta_type, "%s.omx.gz" % filename)
-            ):
-                write_debug("Missing OMSSA output from run_searchgui.", 
-                    job, project)
-                enginestatus.omssa_tries += 1
-                enginestatus.save()
-                
-                if enginestatus.omssa_tries < settings.max_retries:
-                    run_search(xtandem=0, msgf=0, comet=0, omssa=1, metamorpheus=0, myrimatch=0, sage=0, ms_amanda=0, tide=0)
-                    
-            else:
-                enginestatus.omssa_tries = 0
-                if fasta_type == "profile":                
-                    enginestatus.omssa_profile = True
-                elif fasta_type == "proteome":
-                    enginestatus.omssa_proteome = True
-                enginestatus.save()
+    def run_search(search_engines, folder, search_threads, searchgui=searchgui, memory=settings.memory):
+        command = ["timeout", "172800", 
+                   "java", "-Xms%s" % memory, "-Xmx%s" % memory, 
+                   "-cp", os.path.join(searchgui, "SearchGUI-%s.jar" % settings.searchgui_ver), 
+                   "eu.isas.searchgui.cmd.SearchCLI",
+                   "-spectrum_files", "%s.mzML" % (os.path.join(settings.data_folder, project, "out", filename, filename)),
+                   "-output_folder", "%s" % folder,
+                   "-id_params", "%s%s%s_%s.par" % (output_folder, os.sep, project, fasta_type),
+                   "-fasta_file", "%s" % fasta_file
+                  ]
+        for engine, (option, output, name) in SEARCH_ENGINES.items():
+            command.extend([option, "%s" % int(engine in search_engines)])
+        command.extend(["-ms_amanda", "%s" % ms_amanda,
+                        "-tide", "%s" % tide,
+                        "-output_option", "3",
+                        "-output_data", "0",
+                        "-output_date", "0",
+                        "-threads", "%s" % search_threads
+                       ])
+        return run_command(command, job, project)
 
-        if (engine['myrimatch'] == 1):
-            if not os.path.exists(
-                os.path.join(settings.data_folder, project, "out", filename, 
-                    fasta_type, "%s.myrimatch.mzid.gz" % filename)
-            ):
-                write_debug("Missing MyriMatch output from run_searchgui.", 
-                    job, project)
-                enginestatus.myrimatch_tries += 1
-                enginestatus.save()
-                
-                if enginestatus.myrimatch_tries < settings.max_retries:
-                    run_search(xtandem=0, msgf=0, comet=0, omssa=0, metamorpheus=0, myrimatch=1, sage=0, ms_amanda=0, tide=0)
-                    
-            else:
-                enginestatus.myrimatch_tries = 0
-                if fasta_type == "profile":
-                    enginestatus.myrimatch_profile = True
-                elif fasta_type == "proteome":
-                    enginestatus.myrimatch_proteome = True
-                enginestatus.save()
+    # runs a single engine with its own searchgui clone, temp and output 
+    # folder so it can run alongside other engines, then moves the output 
+    # into the usual output folder. the clones are under software so 
+    # clean_job_temp keeps them for the next search
+    def run_engine(engine, search_threads, search_memory):
+        engine_searchgui = clone_software("SearchGUI-%s" % settings.searchgui_ver, 
+                                          os.path.join(install_folder, "temp", project, str(job), "software", "searchgui_%s" % engine))
+        success = path_settings(engine_searchgui, os.path.join(install_folder, "temp", project, str(job), "temp", "SearchGUI_%s" % engine))
+        if success == 0:
+            write_debug("SearchGUI PathSettingsCLI failed for %s." % SEARCH_ENGINES[engine][2], job, project)
+            return
 
-        if (engine['metamorpheus'] == 1):
-            if not os.path.exists(
-                os.path.join(settings.data_folder, project, "out", filename, 
-                    fasta_type, "%s.mzID.gz" % filename)
-            ):
-                write_debug("Missing Metamorpheus output from run_searchgui.", 
-                    job, project)
-                enginestatus.metamorpheus_tries += 1
-                enginestatus.save()
-                
-                if enginestatus.metamorpheus_tries < settings.max_retries:
-                    run_search(xtandem=0, msgf=0, comet=0, omssa=0, metamorpheus=1, myrimatch=0, sage=0, ms_amanda=0, tide=0)
-                    
-            else:
-                enginestatus.metamorpheus_tries = 0
-                if fasta_type == "profile":                
-                    enginestatus.metamorpheus_profile = True
-                elif fasta_type == "proteome":
-                    enginestatus.metamorpheus_proteome = True
-                enginestatus.save()
+        engine_folder = os.path.join(output_folder, "engine_%s" % engine)
+        if os.path.exists(engine_folder):
+            shutil.rmtree(engine_folder)
+        os.makedirs(engine_folder)
 
-        if (engine['sage'] == 1):
-            if not os.path.exists(
-                os.path.join(settings.data_folder, project, "out", filename, 
-                    fasta_type, "%s.sage.tsv.gz" % filename)
-            ):
-                write_debug("Missing Sage output from run_searchgui.", 
-                    job, project)
-                enginestatus.sage_tries += 1
-                enginestatus.save()
-                
-                if enginestatus.sage_tries < settings.max_retries:
-                    run_search(xtandem=0, msgf=0, comet=0, omssa=0, metamorpheus=0, myrimatch=0, sage=1, ms_amanda=0, tide=0)
-                    
-            else:
-                enginestatus.sage_tries = 0
-                enginestatus.sage_profile=True
-                enginestatus.save()
-                
-    if xtandem == 1:
-        run_search(xtandem=1, msgf=0, comet=0, omssa=0, metamorpheus=0, myrimatch=0, sage=0, ms_amanda=0, tide=0)
-        
-    if msgf == 1:
-        run_search(xtandem=0, msgf=1, comet=0, omssa=0, metamorpheus=0, myrimatch=0, sage=0, ms_amanda=0, tide=0)
-        
-    if comet == 1:
-        run_search(xtandem=0, msgf=0, comet=1, omssa=0, metamorpheus=0, myrimatch=0, sage=0, ms_amanda=0, tide=0)
-        
-    if omssa == 1:
-        run_search(xtandem=0, msgf=0, comet=0, omssa=1, metamorpheus=0, myrimatch=0, sage=0, ms_amanda=0, tide=0)
-        
-    if metamorpheus == 1:
-        run_search(xtandem=0, msgf=0, comet=0, omssa=0, metamorpheus=1, myrimatch=0, sage=0, ms_amanda=0, tide=0)
-        
-    if myrimatch == 1:
-        run_search(xtandem=0, msgf=0, comet=0, omssa=0, metamorpheus=0, myrimatch=1, sage=0, ms_amanda=0, tide=0)
-        
-    if sage == 1:
-        run_search(xtandem=0, msgf=0, comet=0, omssa=0, metamorpheus=0, myrimatch=0, sage=1, ms_amanda=0, tide=0)
+        run_search([engine], engine_folder, search_threads, engine_searchgui, search_memory)
+
+        output = SEARCH_ENGINES[engine][1] % filename
+        if os.path.exists(os.path.join(engine_folder, output)):
+            os.replace(os.path.join(engine_folder, output), os.path.join(output_folder, output))
+        shutil.rmtree(engine_folder)
+
+    # check for success and update the status table
+    def check_output(engine):
+        option, output, name = SEARCH_ENGINES[engine]
+        if os.path.exists(os.path.join(output_folder, output % filename)):
+            setattr(enginestatus, "%s_tries" % engine, 0)
+            if fasta_type == "profile" or fasta_type == "proteome":
+                setattr(enginestatus, "%s_%s" % (engine, fasta_type), True)
+            enginestatus.save()
+            return True
+
+        write_debug("Missing %s output from run_searchgui." % name, 
+            job, project)
+        setattr(enginestatus, "%s_tries" % engine, getattr(enginestatus, "%s_tries" % engine) + 1)
+        enginestatus.save()
+        return False
+
+    # the selected engines are searched together so the jvm startup, FASTA
+    # indexing and spectrum loading only happen once. otherwise each engine is
+    # searched on its own
+    if searchsetting.searchgui_combined == True and len(engines) > 1:
+        write_debug("Running %s in one SearchGUI search." % ", ".join([SEARCH_ENGINES[engine][2] for engine in engines]), job, project)
+        searches = [engines]
+    else:
+        searches = [[engine] for engine in engines]
+
+    # if an engine has no output, try that engine again until max retries
+    while len(searches) > 0:
+        if searchsetting.searchgui_parallel_retries == True and len(searches) > 1:
+            # the engines share the threads and memory
+            write_debug("Running %s at the same time." % ", ".join([SEARCH_ENGINES[search[0]][2] for search in searches]), job, project)
+            search_threads = max(1, threads // len(searches))
+            search_memory = split_memory(settings.memory, len(searches))
+            with ThreadPoolExecutor(max_workers=len(searches)) as executor:
+                list(executor.map(run_engine, [search[0] for search in searches], 
+                                  [search_threads] * len(searches), [search_memory] * len(searches)))
+        else:
+            for search in searches:
+                run_search(search, output_folder, threads)
+
+        searches = [[engine] for search in searches for engine in search 
+                    if check_output(engine) == False 
+                    and getattr(enginestatus, "%s_tries" % engine) < settings.max_retries]
 
     end = time.time()
     runtime = end-start
@@ -0,0 +1,77 @@
+# records the cpu time, memory, disk io and database use of each queue step
+# in StageMetric so the slow steps can be compared across many files. the
+# wall time is also still saved in RunTime by the steps themselves. steps run
+# for the whole project are recorded without a queue entry
+
+import time
+import resource
+from contextlib import contextmanager
+
+from django.db import connection
+
+from projects.models import StageMetric, Project
+
+from .run_command import command_usage
+
+@contextmanager
+def stage_metrics(queue, stage, project=None):
+    ''' record the resource use of the block as stage for queue, or for
+    project if queue is None '''
+    if queue is not None:
+        project = queue.project_id
+    queries = {'count': 0, 'time': 0}
+
+    def count_queries(execute, sql, params, many, context):
+        query_start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            queries['count'] += 1
+            queries['time'] += time.perf_counter() - query_start
+
+    # drop anything run before this step
+    command_usage()
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.time()
+    try:
+        with connection.execute_wrapper(count_queries):
+            yield
+    finally:
+        wall_time = time.time() - start
+        after = resource.getrusage(resource.RUSAGE_SELF)
+        commands = command_usage()
+
+        # the memory of a step that runs commands is the memory of the
+        # commands. otherwise it's the peak of this process, which is the 
+        # peak so far rather than just for this step
+        if commands['commands'] > 0:
+            peak_rss = commands['peak_rss']
+        else:
+            peak_rss = after.ru_maxrss / 1024
+
+        # a project step may have stopped because the project doesn't exist
+        if queue is not None or Project.objects.filter(name=project).exists():
+            # queue steps are looked up by queue since older ones have no project
+            if queue is not None:
+                lookup = {'queue': queue, 'stage': stage}
+            else:
+                lookup = {'queue': None, 'project_id': project, 'stage': stage}
+
+            StageMetric.objects.update_or_create(
+                **lookup,
+                defaults={
+                    'project_id': project,
+                    'wall_time': wall_time,
+                    'cpu_time': (after.ru_utime - before.ru_utime 
+                                 + after.ru_stime - before.ru_stime 
+                                 + commands['cpu_time']),
+                    'peak_rss': peak_rss,
+                    'read_mb': ((after.ru_inblock - before.ru_inblock) * 512 / 1024**2 
+                                + commands['read_mb']),
+                    'write_mb': ((after.ru_oublock - before.ru_oublock) * 512 / 1024**2 
+                                 + commands['write_mb']),
+                    'commands': commands['commands'],
+                    'db_queries': queries['count'],
+                    'db_time': queries['time'],
+                }
+            )
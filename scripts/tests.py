@@ -0,0 +1,302 @@
+import os
+import time
+import gzip
+import tempfile
+import threading
+import unittest
+import contextlib
+from unittest import mock
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pandas as pd
+
+from django.db import connections
+from django.test import SimpleTestCase, TransactionTestCase
+
+from projects.models import Project, SearchSetting, Queue, RunTime
+
+from .pemm_deqms import compare_tables
+from .generate_fasta import download_file, download_files, load_manifest
+from .run_command import settings
+from .run_queue import remaining_queue, run_step, run_worker, worker_name, LEASE_SECONDS
+from .tool_runtime import clean_job_temp
+
+TESTDATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "testdata")
+
+# the R fixture is what the R engine writes for fixture_peptides_initial.tsv
+# (two plexes of 3 Normal, 3 Tumor and a Reference channel, 60 proteins of
+# which the first 10 are up in Tumor). to make it, create a multiplexed project
+# called fixture with the tags Normal (Control), Tumor (Treatment) and
+# Reference (Reference), an imputation threshold of 50 and the R engine, copy
+# fixture_peptides_initial.tsv to <data_folder>/fixture/results/ and run
+#   python3 manage.py runscript analyze_results --script-args fixture --from-initial
+# then copy fixture_peptides_final.tsv, fixture_proteins_final.tsv and
+# fixture_DEqMS_results_final_Tumor.tsv from the results folder to here
+PEMM_DEQMS = os.path.join(TESTDATA, "pemm_deqms")
+PEMM_DEQMS_TABLES = ["fixture_peptides_final.tsv", "fixture_proteins_final.tsv",
+                     "fixture_DEqMS_results_final_Tumor.tsv"]
+# largest allowed difference from R for each column. the normalization, PEMM
+# and limma columns are deterministic and have to match to within TOLERANCE.
+# the sca columns depend on the loess fit of the variance on the PSM count,
+# which R evaluates by interpolating over a kd tree (surface = "interpolate")
+# while loess_fit evaluates it exactly at each count, so they get
+# LOESS_TOLERANCE
+TOLERANCE = 1e-6
+LOESS_TOLERANCE = 1e-3
+TOLERANCES = {
+    "sca.t": LOESS_TOLERANCE,
+    "sca.P.Value": LOESS_TOLERANCE,
+    "sca.adj.pval": LOESS_TOLERANCE,
+}
+
+class PemmDeqmsTest(SimpleTestCase):
+    @unittest.skipUnless(all(os.path.exists(os.path.join(PEMM_DEQMS, name)) for name in PEMM_DEQMS_TABLES),
+                         "no R output in testdata/pemm_deqms, see the comment above")
+    def test_matches_r(self):
+        ''' the NumPy/SciPy tables are within the tolerances of the R ones '''
+        peptides_initial = pd.read_csv(os.path.join(PEMM_DEQMS, "fixture_peptides_initial.tsv"), sep="\t")
+        differences = compare_tables(PEMM_DEQMS, "fixture", peptides_initial, True,
+                                     ["Reference"], ["Normal"], ["Tumor"], 50)
+        for name in PEMM_DEQMS_TABLES:
+            rows, rows_r, matched, columns = differences[name]
+            self.assertEqual(rows, rows_r, name)
+            self.assertEqual(matched, rows_r, name)
+            for column in columns:
+                tolerance = TOLERANCES.get(column, TOLERANCE)
+                self.assertLessEqual(columns[column], tolerance, "%s %s" % (name, column))
+
+class DownloadHandler(BaseHTTPRequestHandler):
+    ''' serves server.files, honouring Range requests. the test sets
+    server.truncate to a number of bytes to cut the next response short at '''
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, self.headers.get('Range')))
+        body = server.files.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+
+        start = 0
+        if self.headers.get('Range') is not None and server.ranges == True:
+            start = int(self.headers['Range'][len("bytes="):].rstrip("-"))
+            if start >= len(body):
+                self.send_response(416)
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', "bytes %s-%s/%s" % (start, len(body) - 1, len(body)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body) - start))
+        self.end_headers()
+
+        if server.truncate is not None:
+            self.wfile.write(body[start:start + server.truncate])
+            server.truncate = None
+            self.close_connection = True
+            return
+        self.wfile.write(body[start:])
+
+    def log_message(self, format, *args):
+        pass
+
+class DownloadTest(SimpleTestCase):
+    ''' download_file and download_files against a local server, with the
+    retry backoff turned off '''
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), DownloadHandler)
+        self.server.files = {}
+        self.server.requests = []
+        self.server.ranges = True
+        self.server.truncate = None
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.folder = folder.name
+
+        sleep = mock.patch("scripts.generate_fasta.time.sleep")
+        sleep.start()
+        self.addCleanup(sleep.stop)
+
+        # a compressed FASTA big enough to be sent in several chunks
+        self.body = gzip.compress(b"".join(b">sp|P%05d|\n%s\n" % (i, os.urandom(60).hex().encode())
+                                           for i in range(20000)))
+        self.server.files["/UP1.fasta.gz"] = self.body
+
+    def url(self, path):
+        return "http://127.0.0.1:%s%s" % (self.server.server_address[1], path)
+
+    def test_resume(self):
+        ''' a .part file is continued with a Range request and moved into place '''
+        path = os.path.join(self.folder, "UP1.fasta.gz")
+        with open(path + ".part", "wb") as f:
+            f.write(self.body[:1000])
+
+        entry = download_file(self.url("/UP1.fasta.gz"), path)
+
+        self.assertEqual(self.server.requests, [("/UP1.fasta.gz", "bytes=1000-")])
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), self.body)
+        self.assertFalse(os.path.exists(path + ".part"))
+        self.assertEqual(entry['size'], len(self.body))
+
+    def test_resume_ignored(self):
+        ''' a server that ignores the range sends the whole file again '''
+        self.server.ranges = False
+        path = os.path.join(self.folder, "UP1.fasta.gz")
+        with open(path + ".part", "wb") as f:
+            f.write(b"x" * 1000)
+
+        download_file(self.url("/UP1.fasta.gz"), path)
+
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), self.body)
+
+    def test_truncated(self):
+        ''' a response cut short is resumed from where it stopped '''
+        self.server.truncate = len(self.body) // 2
+        path = os.path.join(self.folder, "UP1.fasta.gz")
+
+        download_file(self.url("/UP1.fasta.gz"), path, attempts=2)
+
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.server.requests[1], ("/UP1.fasta.gz", "bytes=%s-" % (len(self.body) // 2)))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), self.body)
+
+    def test_truncated_gives_up(self):
+        ''' nothing is moved into place when every attempt is cut short '''
+        self.server.truncate = len(self.body) // 2
+        path = os.path.join(self.folder, "UP1.fasta.gz")
+
+        with self.assertRaises(Exception):
+            download_file(self.url("/UP1.fasta.gz"), path, attempts=1)
+        self.assertFalse(os.path.exists(path))
+
+    def test_corrupt_gzip(self):
+        ''' a gzip that fails its crc is thrown away instead of resumed '''
+        # the crc32 is the 8th to 5th last bytes of a gzip
+        corrupt = bytearray(self.body)
+        corrupt[-8] ^= 0xff
+        self.server.files["/UP1.fasta.gz"] = bytes(corrupt)
+        path = os.path.join(self.folder, "UP1.fasta.gz")
+
+        with self.assertRaises(IOError):
+            download_file(self.url("/UP1.fasta.gz"), path, attempts=1)
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(path + ".part"))
+
+        # the next attempt downloads it from the start
+        self.server.files["/UP1.fasta.gz"] = self.body
+        download_file(self.url("/UP1.fasta.gz"), path, attempts=1)
+        self.assertEqual(self.server.requests[-1], ("/UP1.fasta.gz", None))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), self.body)
+
+    def test_download_files(self):
+        ''' downloaded files go in the manifest and aren't downloaded again,
+        while failures are returned '''
+        downloads = {"UP1.fasta.gz": self.url("/UP1.fasta.gz"),
+                     "UP2.fasta.gz": self.url("/UP2.fasta.gz")}
+        with mock.patch.object(settings, "install_folder", self.folder):
+            failed = download_files(downloads, self.folder, "test", threads=2)
+            self.assertEqual(failed, ["UP2.fasta.gz"])
+            self.assertEqual(load_manifest(self.folder)["UP1.fasta.gz"]["size"], len(self.body))
+
+            requests = len(self.server.requests)
+            download_files({"UP1.fasta.gz": downloads["UP1.fasta.gz"]}, self.folder, "test")
+            self.assertEqual(len(self.server.requests), requests)
+
+class RunQueueTest(TransactionTestCase):
+    ''' workers running entries of the same job at the same time, with the
+    tools replaced by fake_tool '''
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        for name, value in (("install_folder", folder.name), ("threads", 4), ("memory", "4G")):
+            patch = mock.patch.object(settings, name, value)
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        project = Project.objects.create(name="queuetest")
+        SearchSetting.objects.create(project=project)
+        self.queues = []
+        for i in range(2):
+            queue = Queue.objects.create(project=project, filename="file%s" % i, job=0,
+                                         status=Queue.Status.SEARCHGUI_PROF)
+            RunTime.objects.create(queue=queue)
+            self.queues.append(queue)
+        self.calls = []
+
+    def fake_tool(self, queue_id, job=None):
+        ''' clean the job temp folder like the tools do, then check nothing
+        else cleaned it while the tool was running '''
+        queue = Queue.objects.get(id=queue_id)
+        if job is None:
+            job = queue.job
+        clean_job_temp(queue.project.name, job)
+        folder = os.path.join(settings.install_folder, "temp", queue.project.name, str(job))
+        marker = os.path.join(folder, "running_%s" % queue_id)
+        open(marker, "w").close()
+        self.calls.append((queue_id, job, folder))
+        time.sleep(0.5)
+        return os.path.exists(marker)
+
+    def test_claimed_temp_folders(self):
+        ''' two workers claiming entries of the same job use their own temp
+        folders '''
+        searchsetting = SearchSetting.objects.get(project="queuetest")
+        claimed = []
+        for job in (10, 11):
+            queue = remaining_queue("queuetest").filter(job=0).claim(worker_name(job), LEASE_SECONDS)
+            claimed.append((queue, job))
+        self.assertNotEqual(claimed[0][0].id, claimed[1][0].id)
+
+        with mock.patch("scripts.run_queue.run_searchgui", side_effect=self.fake_tool):
+            for queue, job in claimed:
+                run_step(queue, searchsetting, worker_name(job), job)
+
+        self.assertEqual([call[1] for call in self.calls], [10, 11])
+        self.assertNotEqual(self.calls[0][2], self.calls[1][2])
+        for queue in self.queues:
+            self.assertEqual(Queue.objects.get(id=queue.id).job, 0)
+
+    def test_concurrent_workers(self):
+        ''' two cpu workers and a db worker take both entries through the
+        profile steps at the same time without cleaning each other's temp
+        folders '''
+        errors = []
+        def worker(job, resource, count):
+            try:
+                run_worker("queuetest", job, resource, count)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connections.close_all()
+
+        # the resource use isn't checked here, and its update_or_create can
+        # deadlock between threads on sqlite
+        with mock.patch("scripts.run_queue.stage_metrics", lambda queue, stage: contextlib.nullcontext()), \
+             mock.patch("scripts.run_queue.WORKER_SLEEP", 0.1), \
+             mock.patch("scripts.run_queue.run_searchgui", side_effect=self.fake_tool), \
+             mock.patch("scripts.run_queue.run_peptideshaker", side_effect=self.fake_tool), \
+             mock.patch("scripts.run_queue.read_results", return_value=True), \
+             mock.patch("scripts.run_queue.process_results", return_value=True):
+            workers = [threading.Thread(target=worker, args=args)
+                       for args in ((10, 'cpu', 2), (11, 'cpu', 2), (12, 'db', 1))]
+            for thread in workers:
+                thread.start()
+            for thread in workers:
+                thread.join(60)
+
+        self.assertEqual(errors, [])
+        # each cpu worker ran a SearchGUI step at the same time as the other
+        self.assertEqual(set(job for queue_id, job, folder in self.calls[:2]), {10, 11})
+        for queue in self.queues:
+            queue = Queue.objects.get(id=queue.id)
+            self.assertEqual(queue.status, Queue.Status.FINISHED_PROF)
+            self.assertEqual(queue.error, 0)
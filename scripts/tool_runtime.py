@@ -0,0 +1,149 @@
+# the java/mono tools are run from a per-job clone of the shared install in
+# install_folder/software. on filesystems with copy-on-write (btrfs, xfs,
+# zfs) the files are reflinked, so making a clone barely touches the disk
+# but a tool rewriting a file in its clone gets its own copy of the blocks.
+# elsewhere the files are copied. files are never hardlinked since a tool
+# rewriting one in place would change the shared install for every job.
+# clones are kept in the job temp folder and reused by later steps
+
+import os
+import shutil
+import time
+import argparse
+
+from .run_command import settings
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# the FICLONE ioctl from linux/fs.h
+FICLONE = 0x40049409
+
+# written once a clone is complete so a partial clone is never reused. the
+# version in it changes when the way clones are made changes, e.g. clones
+# with hardlinks into the install are made again
+CLONE_MARKER = ".metaprod_clone"
+CLONE_VERSION = "2"
+
+def run(*args):
+    ''' compare copying against cloning a tool, e.g.
+    python3 manage.py runscript tool_runtime --script-args SearchGUI-4.1.24 '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('software', type=str)
+    args2 = parser.parse_args(args)
+
+    benchmark_clone(args2.software)
+
+def clone_software(software, folder):
+    ''' clone install_folder/software/<software> into folder, reusing an
+    existing clone. returns the path of the clone '''
+    source = os.path.join(settings.install_folder, "software", software)
+    clone = os.path.join(folder, software)
+
+    if clone_version(clone) == CLONE_VERSION:
+        return clone
+
+    if os.path.exists(clone):
+        shutil.rmtree(clone)
+
+    shutil.copytree(source, clone, copy_function=reflink_or_copy)
+    with open(os.path.join(clone, CLONE_MARKER), 'w') as f:
+        f.write(CLONE_VERSION)
+
+    return clone
+
+def clone_version(clone):
+    ''' the version in the marker of a clone, or None if it isn't complete '''
+    try:
+        with open(os.path.join(clone, CLONE_MARKER), 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def reflink(src, dst):
+    ''' make dst a copy-on-write clone of src. returns False if the platform
+    or filesystem can't, e.g. ext4 or a clone on another filesystem '''
+    if fcntl is None:
+        return False
+    try:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError:
+        if os.path.exists(dst):
+            os.remove(dst)
+        return False
+    shutil.copystat(src, dst)
+    return True
+
+def reflink_or_copy(src, dst):
+    if reflink(src, dst):
+        return dst
+    return shutil.copy2(src, dst)
+
+def clean_job_temp(project, job):
+    ''' empty the temp folder of a job except for the software clones '''
+    job_folder = os.path.join(settings.install_folder, "temp", project, str(job))
+    if not os.path.exists(job_folder):
+        os.makedirs(job_folder)
+
+    for entry in os.listdir(job_folder):
+        if entry == "software":
+            continue
+        path = os.path.join(job_folder, entry)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+    if not os.path.exists(os.path.join(job_folder, "software")):
+        os.makedirs(os.path.join(job_folder, "software"))
+
+def benchmark_clone(software):
+    ''' print the time and bytes written to copy vs clone software '''
+    source = os.path.join(settings.install_folder, "software", software)
+    if not os.path.exists(source):
+        print("Missing install: %s" % source)
+        return False
+
+    total_bytes = 0
+    files = 0
+    largest = None
+    for root, dirs, filenames in os.walk(source):
+        for filename in filenames:
+            size = os.path.getsize(os.path.join(root, filename))
+            total_bytes += size
+            files += 1
+            if largest is None or size > largest[0]:
+                largest = (size, os.path.join(root, filename))
+
+    folder = os.path.join(settings.install_folder, "temp", "benchmark")
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.makedirs(folder)
+
+    # whether this filesystem can reflink decides what a clone writes
+    reflinks = largest is not None and reflink(largest[1], os.path.join(folder, "reflink_test"))
+    copied_bytes = 0 if reflinks else total_bytes
+
+    start = time.time()
+    shutil.copytree(source, os.path.join(folder, "copy", software))
+    copy_time = time.time() - start
+
+    start = time.time()
+    clone_software(software, os.path.join(folder, "clone"))
+    clone_time = time.time() - start
+
+    start = time.time()
+    clone_software(software, os.path.join(folder, "clone"))
+    reuse_time = time.time() - start
+
+    shutil.rmtree(folder)
+
+    print("%s: %s files, %.1f MB" % (software, files, total_bytes / 1024**2))
+    print("reflinks: %s" % ("supported" if reflinks else "not supported, clones are copies"))
+    print("copytree: %.2f s, %.1f MB written" % (copy_time, total_bytes / 1024**2))
+    print("clone: %.2f s, %.1f MB written" % (clone_time, copied_bytes / 1024**2))
+    print("reused clone: %.2f s, 0.0 MB written" % reuse_time)
+    print("saved per step: %.1f MB" % ((total_bytes - copied_bytes) / 1024**2))
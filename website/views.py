@@ -3,7 +3,7 @@ from django.http import HttpResponse
 from django.views import generic
 from django.http import Http404
 from django.shortcuts import get_list_or_404
-from django.db.models import Sum, Count
+from django.db.models import Sum, Count, Max, Q
 from django_tables2.export.views import ExportMixin
 from django_tables2.export.export import TableExport
 
@@ -11,7 +11,7 @@ from django_tables2.views import SingleTableMixin, MultiTableMixin
 from django_tables2 import SingleTableView
 from django_filters.views import FilterView
 
-from projects.models import Project, Queue, RunTime, SearchSetting
+from projects.models import Project, Queue, RunTime, SearchSetting, StageMetric
 from results.models import (
     Protein, 
     Peptide, 
@@ -301,6 +301,24 @@ def summary(request, project):
                    'pro_cust': total_pro_cust, 'pro_prof': total_pro_prof, 'pro_prot': total_pro_prot,
                   }
     
+    # resource use per step over all files, in the order of the steps
+    stage_order = [field.name for field in RunTime._meta.fields if field.name not in ('id', 'queue')]
+    stage_metrics = (
+        StageMetric.objects.filter(Q(queue__project__name=project, queue__skip=False) 
+                                   | Q(queue=None, project=project))
+                           .values('stage')
+                           .annotate(files=Count('queue', distinct=True),
+                                     wall_time=Sum('wall_time'),
+                                     cpu_time=Sum('cpu_time'),
+                                     peak_rss=Max('peak_rss'),
+                                     read_mb=Sum('read_mb'),
+                                     write_mb=Sum('write_mb'),
+                                     db_queries=Sum('db_queries'),
+                                     db_time=Sum('db_time'))
+    )
+    stage_metrics = sorted(stage_metrics, key=lambda x: stage_order.index(x['stage']) 
+                                                        if x['stage'] in stage_order else len(stage_order))
+    
     # omit this for custom because it's not necessarily possible
     top_x_ppid_psm_profile = (
         Protein.objects.filter(fasta_type='profile')
@@ -341,6 +359,7 @@ def summary(request, project):
          'top_x_ppid_nsaf_profile': top_x_ppid_nsaf_profile,
          'top_x_ppid_nsaf_proteome': top_x_ppid_nsaf_proteome,
          'runtimes': runtime_dict,
+         'stage_metrics': stage_metrics,
          'totals': totals_dict
         }
     )